@@ -0,0 +1,146 @@
+"""
+Import Time Benchmark
+~~~~~~~~~~~~~~~~~~~~~
+测量各入口模块的冷启动导入耗时，并检查不该在启动时加载的重型依赖。
+
+每次测量都在新的子进程中进行，避免模块缓存影响结果；取多次运行的中位数。
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --runs 5 --output import_time.json
+    python benchmarks/import_time.py --top 15 --entry cli
+
+超出时间预算或加载了禁止的模块时退出码为 1，可放在 CI 中防止启动变慢。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# 入口模块 -> (时间预算秒数, 启动时不应加载的模块)
+ENTRY_POINTS = {
+    'cli': (0.5, ['gradio', 'datasets', 'pydantic_ai', 'openai', 'httpx', 'pyarrow']),
+    'core.dataset_creator': (1.5, ['gradio', 'datasets', 'pydantic_ai', 'openai', 'httpx', 'pyarrow']),
+    # gradio 本身就很重，界面入口只要求不额外拉入数据集和模型相关的库
+    'ui.app': (12.0, ['datasets', 'pydantic_ai', 'openai']),
+}
+
+# 在子进程中执行：导入模块并输出耗时和已加载的禁止模块
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+forbidden = {forbidden!r}
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in forbidden if m in sys.modules]}}))
+"""
+
+
+def _child_env() -> Dict[str, str]:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(ROOT), env.get('PYTHONPATH')]))
+    # 不写字节码缓存，保证每次测量条件一致
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+    return env
+
+
+def measure(module: str, forbidden: List[str], runs: int = 3) -> Dict:
+    """在新进程中多次导入模块
+
+    Args:
+        module: 模块名
+        forbidden: 导入后不应出现在 sys.modules 中的模块
+        runs: 测量次数
+
+    Returns:
+        Dict: 中位数、最小值、各次耗时和加载了的禁止模块
+    """
+    code = _PROBE.format(module=module, forbidden=forbidden)
+    times = []
+    loaded = set()
+    for _ in range(max(1, runs)):
+        proc = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=_child_env(),
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"导入 {module} 失败:\n{proc.stderr.strip()}")
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        loaded.update(result['loaded'])
+    return {
+        'median': statistics.median(times),
+        'min': min(times),
+        'runs': times,
+        'forbidden_loaded': sorted(loaded),
+    }
+
+
+def slowest_imports(module: str, top: int = 10) -> List[Dict]:
+    """用 -X importtime 列出累计耗时最多的模块
+
+    Returns:
+        List[Dict]: 模块名和累计微秒数，按耗时降序
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=ROOT, env=_child_env(), capture_output=True, text=True)
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        # 格式: "import time:  自身耗时 |  累计耗时 |  模块名"
+        self_us, cumulative_us, name = (part.strip() for part in line[len('import time:'):].split('|'))
+        entries.append({'module': name, 'cumulative_us': int(cumulative_us), 'self_us': int(self_us)})
+    entries.sort(key=lambda e: e['cumulative_us'], reverse=True)
+    return entries[:top]
+
+
+def run(entries: List[str], runs: int, top: int, budget_scale: float) -> Dict:
+    results = {}
+    for module in entries:
+        budget, forbidden = ENTRY_POINTS[module]
+        result = measure(module, forbidden, runs)
+        result['budget'] = budget * budget_scale
+        result['ok'] = result['median'] <= result['budget'] and not result['forbidden_loaded']
+        if top:
+            result['slowest'] = slowest_imports(module, top)
+        results[module] = result
+    return results
+
+
+def print_report(results: Dict) -> None:
+    for module, result in results.items():
+        status = "ok" if result['ok'] else "FAIL"
+        print(f"{module:<24} {result['median']:.3f}s (min {result['min']:.3f}s, "
+              f"预算 {result['budget']:.2f}s) {status}")
+        if result['forbidden_loaded']:
+            print(f"    启动时加载了: {', '.join(result['forbidden_loaded'])}")
+        for entry in result.get('slowest', []):
+            print(f"    {entry['cumulative_us'] / 1000:>8.1f} ms  {entry['module']}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="测量入口模块的导入耗时")
+    parser.add_argument('--entry', action='append', choices=sorted(ENTRY_POINTS),
+                        help="只测量指定入口，可重复，默认全部")
+    parser.add_argument('--runs', type=int, default=3, help="每个入口的测量次数")
+    parser.add_argument('--top', type=int, default=0, help="列出累计耗时最多的前 N 个模块")
+    parser.add_argument('--budget-scale', type=float, default=1.0,
+                        help="时间预算倍数，较慢的机器上可以调大")
+    parser.add_argument('--output', help="把结果写入 JSON 文件")
+    args = parser.parse_args(argv)
+
+    results = run(args.entry or list(ENTRY_POINTS), args.runs, args.top, args.budget_scale)
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'python': sys.version.split()[0], 'results': results}, f, ensure_ascii=False, indent=2)
+    return 0 if all(r['ok'] for r in results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""
+Mock OpenAI-Compatible API
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+本地模拟的 /chat/completions 接口，延迟可控，供基准测试和离线调试使用。
+
+按系统提示词区分请求：文本分析返回约 chunk_chars 字符、在段落或句号处断开的前缀，
+标题生成返回短标题，格式化返回 instruction/input/output JSON，其余（图片描述）返回固定描述。
+延迟为 latency 加上 [0, jitter] 内的均匀抖动，随机数种子固定，多次运行的延迟分布一致。
+支持 max_tokens（按约 2 字符一个 token 截断）、stop 和 stream=True（SSE，每段约一个 token，
+段间隔 token_interval 秒）。
+
+    python benchmarks/mock_api.py --port 8777 --latency 0.2 --jitter 0.1
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# 文本分析 agent 断句时优先选择的位置，越靠前越优先
+_BREAKS = ("\n\n", "\n", "。", "！", "？", ".")
+_FORMAT_PROMPT = re.compile(r"标题：(.*?)\n\s*原文：(.*)\n\s*请按指定格式生成JSON。", re.S)
+
+
+def _content_text(content) -> str:
+    """消息内容可能是字符串或多模态分段列表"""
+    if isinstance(content, str):
+        return content
+    return "".join(part.get('text', '') for part in content or [] if isinstance(part, dict))
+
+
+class MockAPIServer:
+    """在后台线程中运行的模拟接口"""
+
+    def __init__(self, port: int = 0, latency: float = 0.05, jitter: float = 0.0, fail_rate: float = 0.0,
+                 chunk_chars: int = 1500, seed: int = 0, host: str = "127.0.0.1", token_interval: float = 0.0):
+        """初始化模拟接口
+
+        Args:
+            port: 监听端口，0 为自动分配
+            latency: 每个请求的基础延迟（秒）
+            jitter: 额外的均匀随机延迟上限（秒）
+            fail_rate: 返回 HTTP 500 的概率
+            chunk_chars: 文本分析请求返回的分块长度（字符）
+            seed: 随机数种子
+            host: 监听地址
+            token_interval: 流式回复中相邻两段之间的间隔（秒）
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.chunk_chars = chunk_chars
+        self.token_interval = token_interval
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockAPIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockAPIServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'requests': self.requests, 'failures': self.failures,
+                    'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+    def _draw(self) -> tuple:
+        """取本次请求的延迟和是否失败，加锁保证同一种子下的序列固定"""
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter) if self.jitter else self.latency
+            failed = self._random.random() < self.fail_rate
+            self.requests += 1
+            self.failures += failed
+        return delay, failed
+
+    def reply(self, messages: List[Dict]) -> str:
+        """根据系统提示词生成回复内容"""
+        system = " ".join(_content_text(m.get('content')) for m in messages if m.get('role') == 'system')
+        user = _content_text(messages[-1].get('content')) if messages else ""
+        if "文本分析" in system:
+            return self._split(user)
+        if "标题" in system and "格式化" not in system:
+            return user.strip()[:8] or "空白文本"
+        match = _FORMAT_PROMPT.search(user)
+        if "格式化" in system and match:
+            return json.dumps({'instruction': match.group(1).strip(), 'input': "", 'output': match.group(2).strip()},
+                              ensure_ascii=False)
+        return "一张测试图片：画面中央是一栋红色屋顶的建筑，前景有树木和行人，天空晴朗。"
+
+    @staticmethod
+    def limit(content: str, body: Dict) -> tuple:
+        """按请求中的 stop 和 max_tokens 截断回复，返回 (内容, finish_reason)"""
+        stops = body.get('stop') or []
+        for stop in [stops] if isinstance(stops, str) else stops:
+            index = content.find(stop)
+            if index != -1:
+                content = content[:index]
+        max_tokens = body.get('max_tokens')
+        if max_tokens and len(content) > max_tokens * 2:
+            return content[:max_tokens * 2], 'length'
+        return content, 'stop'
+
+    def _split(self, text: str) -> str:
+        if len(text) <= self.chunk_chars:
+            return text
+        window = text[:self.chunk_chars]
+        for mark in _BREAKS:
+            cut = window.rfind(mark)
+            if cut > self.chunk_chars // 2:
+                return window[:cut + len(mark)]
+        return window
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, payload: Dict) -> None:
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                with server._lock:
+                    server.bytes_out += len(data)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, body: Dict, content: str, finish_reason: str) -> None:
+                """以 SSE 分段发送回复，客户端提前断开时停止发送"""
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                base = {'id': f"chatcmpl-{server.requests}", 'object': 'chat.completion.chunk',
+                        'created': int(time.time()), 'model': body.get('model', 'mock')}
+                pieces = [content[i:i + 2] for i in range(0, len(content), 2)]
+                events = [{**base, 'choices': [{'index': 0, 'delta': {'role': 'assistant', 'content': piece},
+                                                'finish_reason': None}]} for piece in pieces]
+                events.append({**base, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': finish_reason}]})
+                try:
+                    for i, event in enumerate(events):
+                        if i and server.token_interval:
+                            time.sleep(server.token_interval)
+                        data = f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8')
+                        self.wfile.write(data)
+                        self.wfile.flush()
+                        with server._lock:
+                            server.bytes_out += len(data)
+                    self.wfile.write(b"data: [DONE]\n\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def do_GET(self):
+                if self.path.rstrip('/').endswith('/models'):
+                    self._send(200, {'object': 'list', 'data': [{'id': 'mock', 'object': 'model', 'owned_by': 'mock'}]})
+                else:
+                    self._send(404, {'error': {'message': 'not found'}})
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with server._lock:
+                    server.bytes_in += len(raw)
+                if not self.path.rstrip('/').endswith('/chat/completions'):
+                    self._send(404, {'error': {'message': 'not found'}})
+                    return
+                body = json.loads(raw or b'{}')
+                delay, failed = server._draw()
+                time.sleep(delay)
+                if failed:
+                    self._send(500, {'error': {'message': 'mock failure', 'type': 'server_error'}})
+                    return
+                content, finish_reason = server.limit(server.reply(body.get('messages', [])), body)
+                if body.get('stream'):
+                    self._stream(body, content, finish_reason)
+                    return
+                self._send(200, {
+                    'id': f"chatcmpl-{server.requests}",
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': body.get('model', 'mock'),
+                    'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content},
+                                 'finish_reason': finish_reason}],
+                    # 约 2 字符一个 token，足够用于成本和速度估算
+                    'usage': {'prompt_tokens': len(raw) // 2, 'completion_tokens': len(content) // 2,
+                              'total_tokens': (len(raw) + len(content)) // 2},
+                })
+
+        return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="本地模拟的 OpenAI 兼容接口")
+    parser.add_argument('--port', type=int, default=8777)
+    parser.add_argument('--latency', type=float, default=0.05, help="基础延迟（秒）")
+    parser.add_argument('--jitter', type=float, default=0.0, help="随机抖动上限（秒）")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="返回 HTTP 500 的概率")
+    parser.add_argument('--chunk-chars', type=int, default=1500, help="文本分析返回的分块长度")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--token-interval', type=float, default=0.0, help="流式回复的段间隔（秒）")
+    args = parser.parse_args()
+    server = MockAPIServer(args.port, args.latency, args.jitter, args.fail_rate, args.chunk_chars, args.seed,
+                           token_interval=args.token_interval)
+    print(f"模拟接口: {server.base_url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == '__main__':
+    main()
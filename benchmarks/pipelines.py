@@ -0,0 +1,449 @@
+"""
+Pipeline Benchmarks
+~~~~~~~~~~~~~~~~~~~
+在本地模拟接口（benchmarks/mock_api.py）上运行文本和图片流水线以及各导出格式，
+记录吞吐、请求延迟分位数、峰值内存和写出字节数。
+
+语料由 input/ 中的示例文本和图片按规模参数放大生成；模拟接口的延迟和随机数种子固定，
+每个场景在新的子进程中运行，峰值内存互不影响。结果写成 JSON，可与其他提交的结果对比：
+
+    python benchmarks/pipelines.py
+    python benchmarks/pipelines.py --scenario text --text-scale 4 --latency 0.2
+    python benchmarks/pipelines.py --runs 3 --compare benchmarks/results/pipelines_<commit>.json
+
+对比时有指标变差超过阈值则退出码为 1。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from mock_api import MockAPIServer  # noqa: E402
+
+TEXT_SOURCES = ["小王子前十章.txt", "民法典前一章.txt"]
+IMAGE_SOURCE = ROOT / "input"
+API_KEY = "sk-benchmark-00000000000000"
+
+# 指标后缀 -> 数值越大越好（True）或越小越好（False），对比时据此判断是否变差
+DIRECTIONS = {
+    '_per_sec': True,
+    '_ms': False,
+    'seconds': False,
+    'peak_rss_mb': False,
+    'bytes_written': False,
+}
+
+
+# ---------- 子进程中运行的场景 ----------
+
+def _rss_peak_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 以字节为单位，Linux 以 KB 为单位
+    return round(peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def _dir_bytes(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _SpanCollector(logging.Handler):
+    """从 pretuning.trace 日志中收集指定 span 的耗时"""
+
+    def __init__(self, names: set):
+        super().__init__(logging.DEBUG)
+        self.names = names
+        self.durations: List[float] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if getattr(record, 'span', None) in self.names:
+            self.durations.append(record.duration_ms)
+
+    def summary(self) -> Dict:
+        if not self.durations:
+            return {}
+        return {
+            'requests': len(self.durations),
+            'latency_p50_ms': round(_percentile(self.durations, 0.5), 2),
+            'latency_p99_ms': round(_percentile(self.durations, 0.99), 2),
+        }
+
+
+def _creator(config: Dict):
+    from core.dataset_creator import DatasetCreator
+
+    creator = DatasetCreator(temp_dir="temp_dataset", memory_limit_mb=config['memory_limit'])
+    message = creator.set_api_config(config['base_url'], API_KEY, "mock")
+    if "✅" not in message:
+        raise RuntimeError(message)
+    return creator
+
+
+def _image_files(config: Dict) -> List[SimpleNamespace]:
+    """把示例图片循环复制为指定数量的输入文件"""
+    samples = sorted(p for p in IMAGE_SOURCE.iterdir() if p.suffix.lower() in ('.jpg', '.jpeg', '.png'))
+    images_dir = Path("images")
+    images_dir.mkdir(exist_ok=True)
+    files = []
+    for i in range(config['images']):
+        source = samples[i % len(samples)]
+        target = images_dir / f"{i:05d}{source.suffix.lower()}"
+        shutil.copyfile(source, target)
+        # 与 Gradio 上传的文件对象一样通过 name 取路径
+        files.append(SimpleNamespace(name=str(target.absolute())))
+    return files
+
+
+def _corpus(config: Dict) -> Dict[str, str]:
+    """按 text_scale 重复示例文本，得到各来源文件的合成语料"""
+    corpus = {}
+    for name in TEXT_SOURCES:
+        text = (IMAGE_SOURCE / name).read_text(encoding='utf-8').strip()
+        corpus[name] = "\n\n".join([text] * config['text_scale'])
+    return corpus
+
+
+def bench_text(config: Dict, mode: str = "llm") -> Dict:
+    """TextProcessor.process_file：llm 为切块、标题、格式化三类 agent 请求，local 为本地切块和关键词指令"""
+    creator = _creator(config)
+    corpus = _corpus(config)
+    chunks = 0
+
+    async def run() -> None:
+        nonlocal chunks
+        for name, content in corpus.items():
+            processor = creator.new_text_processor(creator.api_handler)
+            processor.set_instruction_mode(mode)
+            async with processor:
+                _, message = await processor.process_file(content, name)
+            if not processor.text_results:
+                raise RuntimeError(message)
+            chunks += len(processor.text_results)
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    seconds = time.perf_counter() - start
+    chars = sum(len(c) for c in corpus.values())
+    return {'seconds': seconds, 'chunks': chunks, 'chunks_per_sec': chunks / seconds,
+            'chars_per_sec': chars / seconds}
+
+
+def bench_image_preprocess(config: Dict) -> Dict:
+    """DatasetCreator.process_images：解码、缩放、编码并写入临时目录"""
+    creator = _creator(config)
+    files = _image_files(config)
+    start = time.perf_counter()
+    _, text_data = creator.process_images(files)
+    seconds = time.perf_counter() - start
+    if len(text_data) != len(files):
+        raise RuntimeError(f"只处理了 {len(text_data)}/{len(files)} 张图片")
+    return {'seconds': seconds, 'images': len(files), 'images_per_sec': len(files) / seconds,
+            'bytes_written': _dir_bytes(Path("temp_dataset"))}
+
+
+def bench_image_describe(config: Dict) -> Dict:
+    """DatasetCreator.batch_generate_all：逐张请求图片描述"""
+    creator = _creator(config)
+    creator.process_images(_image_files(config))
+    start = time.perf_counter()
+    text_data, message = creator.batch_generate_all()
+    seconds = time.perf_counter() - start
+    done = sum(1 for p in creator.image_text_pairs if p['text'].strip())
+    if done != config['images']:
+        raise RuntimeError(message)
+    return {'seconds': seconds, 'images': done, 'images_per_sec': done / seconds}
+
+
+def bench_image_pipeline(config: Dict) -> Dict:
+    """DatasetCreator.pipeline_process：解码、编码、并发描述和增量写出重叠进行"""
+    creator = _creator(config)
+    files = _image_files(config)
+    start = time.perf_counter()
+    for _, _, message in creator.pipeline_process(files, describe_workers=config['workers'],
+                                                  output_dir="image_records"):
+        pass
+    seconds = time.perf_counter() - start
+    done = sum(1 for p in creator.image_text_pairs if p['text'].strip())
+    if done != len(files):
+        raise RuntimeError(message)
+    return {'seconds': seconds, 'images': done, 'images_per_sec': done / seconds,
+            'bytes_written': _dir_bytes(Path("image_records"))}
+
+
+def bench_export_image(export_format: str, config: Dict) -> Dict:
+    """DatasetCreator.create_dataset：描述直接填入，只测导出本身"""
+    from core.dataset_creator import DatasetCreator
+    # 导出模块在保存时才导入，提前导入以免计入导出耗时
+    import core.create_parquet  # noqa: F401
+    if export_format == "hf":
+        import datasets  # noqa: F401
+
+    creator = DatasetCreator(temp_dir="temp_dataset", memory_limit_mb=config['memory_limit'])
+    creator.process_images(_image_files(config))
+    for pair in creator.image_text_pairs:
+        pair['text'] = f"第 {pair['index']} 张测试图片的描述。" * 8
+    output = Path({"parquet": "image_dataset_parquet", "webdataset": "image_dataset_wds"}.get(export_format,
+                                                                                            "image_dataset"))
+    start = time.perf_counter()
+    message = creator.create_dataset(export_format)
+    seconds = time.perf_counter() - start
+    if "✅" not in message:
+        raise RuntimeError(message)
+    written = _dir_bytes(output)
+    rows = len(creator.image_text_pairs)
+    return {'seconds': seconds, 'rows': rows, 'rows_per_sec': rows / seconds, 'bytes_written': written,
+            'mb_per_sec': written / 2 ** 20 / seconds}
+
+
+def bench_export_text(export_format: str, config: Dict) -> Dict:
+    """DatasetCreator.save_text_dataset：语料按固定长度切块，循环取满 records 条记录后导出"""
+    from core.dataset_creator import DatasetCreator
+    import core.sequence_packing  # noqa: F401
+    import core.text_export  # noqa: F401
+
+    chunks = []
+    size = config['chunk_chars']
+    for name, content in _corpus(config).items():
+        chunks += [(name, offset, content[offset:offset + size]) for offset in range(0, len(content), size)]
+    creator = DatasetCreator(temp_dir="temp_dataset", memory_limit_mb=config['memory_limit'])
+    creator.text_processor = creator.new_text_processor()
+    for i in range(config['records']):
+        name, offset, chunk = chunks[i % len(chunks)]
+        # 每条记录使用独立的字符串，内存占用与真实语料一致
+        output = f"{chunk}\n（第 {i} 条）"
+        creator.text_processor.text_results.append({'instruction': chunk[:8], 'input': "", 'output': output})
+        creator.text_processor.chunk_meta.append({'source_file': name, 'chunk_offset': offset})
+    output = Path("text_dataset")
+    start = time.perf_counter()
+    message = creator.save_text_dataset(str(output), export_format)
+    seconds = time.perf_counter() - start
+    if not message.startswith("已"):
+        raise RuntimeError(message)
+    written = _dir_bytes(output)
+    rows = len(creator.text_processor.text_results)
+    return {'seconds': seconds, 'rows': rows, 'rows_per_sec': rows / seconds, 'bytes_written': written,
+            'mb_per_sec': written / 2 ** 20 / seconds}
+
+
+# 场景名 -> (函数, 需要统计延迟的 span)
+SCENARIOS: Dict[str, tuple] = {
+    'text': (bench_text, {'agent.run'}),
+    'text_local': (partial(bench_text, mode="local"), set()),
+    'image_preprocess': (bench_image_preprocess, set()),
+    'image_describe': (bench_image_describe, {'api.chat'}),
+    'image_pipeline': (bench_image_pipeline, {'api.chat'}),
+    'export_image_parquet': (partial(bench_export_image, "parquet"), set()),
+    'export_image_webdataset': (partial(bench_export_image, "webdataset"), set()),
+    'export_image_hf': (partial(bench_export_image, "hf"), set()),
+    'export_text_json': (partial(bench_export_text, "json"), set()),
+    'export_text_parquet': (partial(bench_export_text, "parquet"), set()),
+    'export_text_arrow': (partial(bench_export_text, "arrow"), set()),
+    'export_text_packed': (partial(bench_export_text, "packed"), set()),
+}
+
+
+def run_child(scenario: str, config: Dict, result_path: str) -> None:
+    """在子进程中运行单个场景，结果写到 result_path"""
+    fn, spans = SCENARIOS[scenario]
+    collector = _SpanCollector(spans)
+    trace_logger = logging.getLogger("pretuning.trace")
+    if spans:
+        trace_logger.setLevel(logging.DEBUG)
+        trace_logger.propagate = False
+        trace_logger.addHandler(collector)
+    result = fn(config)
+    result.update(collector.summary())
+    result['peak_rss_mb'] = _rss_peak_mb()
+    Path(result_path).write_text(json.dumps(result), encoding='utf-8')
+
+
+# ---------- 主进程：启动模拟接口、调度子进程、汇总和对比 ----------
+
+def _git(*args: str) -> Optional[str]:
+    try:
+        proc = subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return proc.stdout.strip() if proc.returncode == 0 else None
+
+
+def run_scenario(scenario: str, config: Dict, workdir: Path) -> Dict:
+    """启动一个新的模拟接口和子进程运行场景，附上接口侧的请求统计"""
+    run_dir = workdir / scenario
+    shutil.rmtree(run_dir, ignore_errors=True)
+    run_dir.mkdir(parents=True)
+    result_path = run_dir / "result.json"
+    with MockAPIServer(latency=config['latency'], jitter=config['jitter'], fail_rate=config['fail_rate'],
+                       chunk_chars=config['chunk_chars'], seed=config['seed']) as server:
+        child_config = dict(config, base_url=server.base_url)
+        proc = subprocess.run(
+            [sys.executable, str(Path(__file__).resolve()), '--child', scenario,
+             '--child-config', json.dumps(child_config), '--child-result', str(result_path)],
+            cwd=run_dir, capture_output=True, text=True,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT), os.environ.get('PYTHONPATH')]))),
+        )
+        api = server.stats()
+    if proc.returncode != 0 or not result_path.exists():
+        tail = "\n".join((proc.stderr or proc.stdout).strip().splitlines()[-15:])
+        raise RuntimeError(f"场景 {scenario} 失败:\n{tail}")
+    result = json.loads(result_path.read_text(encoding='utf-8'))
+    if api['requests']:
+        result['api_requests'] = api['requests']
+        result['api_bytes_in'] = api['bytes_in']
+    return result
+
+
+def _median(runs: List[Dict]) -> Dict:
+    merged = {}
+    for key in runs[0]:
+        values = [r[key] for r in runs if isinstance(r.get(key), (int, float))]
+        merged[key] = round(statistics.median(values), 4) if values else runs[0][key]
+    return merged
+
+
+def _direction(metric: str) -> Optional[bool]:
+    for suffix, higher_better in DIRECTIONS.items():
+        if metric.endswith(suffix):
+            return higher_better
+    return None
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """对比两次结果，返回变差超过阈值的指标说明"""
+    regressions = []
+    for scenario, metrics in current['scenarios'].items():
+        old = baseline.get('scenarios', {}).get(scenario)
+        if not old:
+            continue
+        for metric, value in metrics.items():
+            higher_better = _direction(metric)
+            before = old.get(metric)
+            if higher_better is None or not isinstance(before, (int, float)) or not before or value is None:
+                continue
+            change = (value - before) / before
+            worse = -change if higher_better else change
+            marker = "  <- 变差" if worse > threshold else ""
+            print(f"  {scenario:<26}{metric:<18}{before:>12.2f} -> {value:<12.2f}{change:+.1%}{marker}")
+            if marker:
+                regressions.append(f"{scenario}.{metric} {change:+.1%}")
+    return regressions
+
+
+def print_report(results: Dict) -> None:
+    for scenario, metrics in results['scenarios'].items():
+        print(f"{scenario}")
+        for key, value in metrics.items():
+            print(f"    {key:<18}{value}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="在本地模拟接口上测量文本、图片流水线和导出的性能")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help="只运行指定场景，可重复，默认全部")
+    parser.add_argument('--runs', type=int, default=1, help="每个场景的运行次数，结果取中位数")
+    parser.add_argument('--text-scale', type=int, default=1, help="示例文本重复的倍数")
+    parser.add_argument('--images', type=int, default=32, help="图片数量（循环使用示例图片）")
+    parser.add_argument('--records', type=int, default=2000, help="文本导出场景的记录数")
+    parser.add_argument('--workers', type=int, default=4, help="流水线模式的并发描述请求数")
+    parser.add_argument('--latency', type=float, default=0.05, help="模拟接口的基础延迟（秒）")
+    parser.add_argument('--jitter', type=float, default=0.02, help="模拟接口的随机抖动上限（秒）")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="模拟接口返回 HTTP 500 的概率")
+    parser.add_argument('--chunk-chars', type=int, default=1500, help="文本分块长度（字符）")
+    parser.add_argument('--seed', type=int, default=0, help="模拟接口的随机数种子")
+    parser.add_argument('--memory-limit', type=float, help="DatasetCreator 的内存上限（MB），测量落盘模式")
+    parser.add_argument('--output', help="结果 JSON 路径，默认 benchmarks/results/pipelines_<提交>.json")
+    parser.add_argument('--compare', help="与之前的结果 JSON 对比")
+    parser.add_argument('--threshold', type=float, default=0.15, help="对比时判定为变差的相对变化")
+    parser.add_argument('--keep', action='store_true', help="保留各场景的工作目录")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--child-config', help=argparse.SUPPRESS)
+    parser.add_argument('--child-result', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        run_child(args.child, json.loads(args.child_config), args.child_result)
+        return 0
+
+    config = {
+        'text_scale': args.text_scale, 'images': args.images, 'records': args.records, 'workers': args.workers,
+        'latency': args.latency, 'jitter': args.jitter, 'fail_rate': args.fail_rate,
+        'chunk_chars': args.chunk_chars, 'seed': args.seed, 'memory_limit': args.memory_limit,
+    }
+    commit = _git('rev-parse', '--short', 'HEAD')
+    dirty = bool(_git('status', '--porcelain', '--untracked-files=no'))
+    results = {
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': config,
+        'scenarios': {},
+    }
+
+    workdir = Path(tempfile.mkdtemp(prefix="pretuning_bench_"))
+    failed = []
+    try:
+        for scenario in args.scenario or list(SCENARIOS):
+            print(f"运行 {scenario} ...", flush=True)
+            try:
+                runs = [run_scenario(scenario, config, workdir) for _ in range(max(1, args.runs))]
+            except RuntimeError as e:
+                print(e, file=sys.stderr)
+                failed.append(scenario)
+                continue
+            results['scenarios'][scenario] = _median(runs)
+    finally:
+        if args.keep:
+            print(f"工作目录: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results)
+    output = Path(args.output) if args.output else (
+        ROOT / "benchmarks" / "results" / f"pipelines_{commit or 'unknown'}{'-dirty' if dirty else ''}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding='utf-8')
+    print(f"结果已写入 {output}")
+
+    regressions = []
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding='utf-8'))
+        if baseline.get('config') != config:
+            print("注意: 对比的两次结果使用了不同的参数")
+        print(f"与 {args.compare}（{baseline.get('commit')}）对比:")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"变差超过 {args.threshold:.0%}: {', '.join(regressions)}")
+    return 1 if failed or regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
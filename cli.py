@@ -0,0 +1,645 @@
+"""
+AI Dataset Creator - Command Line Entry
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+不启动界面批量处理图片和文本，适合在服务器上通过 cron 或调度器运行大任务。
+
+    python cli.py image input/ --prompt-file prompt.txt --workers 8 --format parquet
+    python cli.py text corpus/ --format packed --target-length 4096
+    python cli.py verify image_dataset/image_dataset_parquet --deep
+    python cli.py --profile image input/ --format parquet   # 报告写到输出目录下的 profile_* 中
+
+多进程 / 多机：协调者建队列，任意多个工作进程（共享存储上的多台机器）处理，最后按输入顺序合并。
+
+    python cli.py queue init /shared/q image input/ --prompt-file prompt.txt
+    python cli.py queue work /shared/q --threads 8      # 每台机器各运行若干个
+    python cli.py queue merge /shared/q --format parquet
+
+退出码：0 全部成功，1 部分条目失败，2 参数或配置错误，130 被中断。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from tqdm import tqdm
+
+EXIT_OK = 0
+EXIT_PARTIAL = 1
+EXIT_USAGE = 2
+EXIT_INTERRUPTED = 130
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tiff'}
+IMAGE_FORMATS = ("hf", "parquet", "webdataset")
+
+
+class UsageError(Exception):
+    """参数或配置错误"""
+
+
+def _read_prompt(text: Optional[str], path: Optional[str]) -> Optional[str]:
+    if path:
+        return Path(path).read_text(encoding='utf-8')
+    return text
+
+
+def _collect_images(inputs: List[str]) -> List[str]:
+    """展开输入路径，目录按文件名排序取其中的图片"""
+    files = []
+    for value in inputs:
+        path = Path(value)
+        if path.is_dir():
+            files += sorted(str(p.absolute()) for p in path.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+        elif path.is_file():
+            files.append(str(path.absolute()))
+        else:
+            raise UsageError(f"输入不存在: {value}")
+    return files
+
+
+def _stream_records(output_dir: Path) -> List[Dict]:
+    """读取 output_dir 下所有 stream_* 目录中已完成的记录，按编号排序"""
+    records = []
+    for records_file in sorted(output_dir.glob("stream_*/records.jsonl")):
+        with open(records_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 中断时可能留下写了一半的最后一行
+                    continue
+                record['image_file'] = str(records_file.parent / record['image_file'])
+                records.append(record)
+    return sorted(records, key=lambda r: r['index'])
+
+
+def _iter_pairs(records: List[Dict]) -> Iterator[Dict]:
+    """把记录转换为导出用的图片文本对，图片字节按需读取"""
+    seen: Set[str] = set()
+    for record in records:
+        source = record.get('source')
+        if source:
+            if source in seen:
+                continue
+            seen.add(source)
+        with open(record['image_file'], 'rb') as f:
+            data = f.read()
+        yield {
+            'index': record['index'],
+            'image_bytes': data,
+            'image_format': Path(record['image_file']).suffix.lstrip('.'),
+            'image_path': record['image_file'],
+            'text': record['text']
+        }
+
+
+def _configure_api(creator, args) -> None:
+    base_url = args.base_url or os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+    api_key = args.api_key or os.getenv("OPENAI_API_KEY", "")
+    model = args.model or os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+    stage_models = args.stage_models or os.getenv("PRETUNING_STAGE_MODELS", "")
+    message = creator.set_api_config(base_url, api_key, model, stage_models)
+    if not creator.api_handler:
+        raise UsageError(message)
+
+
+def _export_images(creator, records: List[Dict], export_format: str) -> str:
+    from core.create_parquet import DatasetProcessor
+
+    if export_format == "parquet":
+        output_dir = creator.image_dataset_dir("parquet")
+        manifest = DatasetProcessor(creator.fs_handler).export_parquet(_iter_pairs(records), output_dir)
+        return f"Parquet 数据集共 {manifest['num_rows']} 条，{len(manifest['shards'])} 个分片，位于 {output_dir}"
+    if export_format == "webdataset":
+        output_dir = creator.image_dataset_dir("webdataset")
+        index = DatasetProcessor(creator.fs_handler).export_webdataset(_iter_pairs(records), output_dir)
+        return f"WebDataset 共 {index['num_samples']} 条，{len(index['shards'])} 个 tar 分片，位于 {output_dir}"
+    # save_to_disk 需要全部条目；设置了内存上限时超出部分只保留图片文件路径
+    creator.image_text_pairs = [creator.track_pair(pair) for pair in _iter_pairs(records)]
+    return creator.create_dataset("hf")
+
+
+def run_image(args) -> int:
+    from core.dataset_creator import DatasetCreator
+
+    files = _collect_images(args.inputs)
+    if not files:
+        raise UsageError("没有找到图片")
+    # 导出的数据集写在 --output-dir 下，与增量记录放在一起
+    creator = DatasetCreator(memory_limit_mb=args.memory_limit, output_root=args.output_dir)
+    _configure_api(creator, args)
+    message = creator.set_generation_options(args.stream, args.max_tokens, args.stop)
+    if args.stop and len(args.stop) > 4:
+        raise UsageError(message)
+    prompt = _read_prompt(args.prompt, args.prompt_file)
+    if prompt:
+        creator.api_handler.set_system_prompt(prompt)
+
+    output_dir = Path(args.output_dir).absolute()
+    completed = _stream_records(output_dir) if args.resume else []
+    done_sources = {r.get('source') for r in completed}
+    todo = [f for f in files if f not in done_sources]
+    start_index = max((r['index'] for r in completed), default=-1) + 1
+    if completed:
+        print(f"续跑：已完成 {len(files) - len(todo)} 张，剩余 {len(todo)} 张", file=sys.stderr)
+
+    failed: Dict[int, Dict] = {}
+    errors = 0
+    if not todo:
+        print("没有需要处理的新图片", file=sys.stderr)
+    else:
+        errors = _describe_images(creator, todo, start_index, output_dir, failed, args)
+
+    for item in failed.values():
+        result = item['result']
+        print(f"图片 {item['index']} ({item['source_path']}) 描述失败 [{result.error_class}]: {result.error}",
+              file=sys.stderr)
+
+    if args.format != "none":
+        print(_export_images(creator, _stream_records(output_dir), args.format), file=sys.stderr)
+    return EXIT_PARTIAL if failed or errors else EXIT_OK
+
+
+def _describe_images(creator, todo: List[str], start_index: int, output_dir: Path,
+                     failed: Dict[int, Dict], args) -> int:
+    """运行描述流水线并重试失败项，返回无法解码的图片数"""
+    from core.api_handler import speed_summary
+    from core.image_pipeline import ImagePipeline, RecordWriter
+    from core.retry_queue import DeadLetterQueue
+
+    errors = 0
+    results = []
+    dead_letters = DeadLetterQueue(base_delay=creator.api_handler.config.retry_delay,
+                                   max_attempts=args.retries + 1)
+    writer = RecordWriter(str(output_dir))
+    try:
+        pipeline = ImagePipeline(creator.api_handler, creator.fs_handler, describe_workers=args.workers,
+                                 detail_policy=args.detail)
+        with tqdm(total=len(todo), unit="img", desc="描述", disable=args.quiet) as bar:
+            for item in pipeline.run(todo, start_index):
+                if 'error' in item:
+                    errors += 1
+                    bar.write(item['error'])
+                    bar.update(1)
+                    continue
+                results.append(item['result'])
+                if item['result'].ok:
+                    writer.write(item)
+                else:
+                    failed[item['index']] = item
+                    dead_letters.add(item['index'])
+                bar.update(1)
+                bar.set_postfix(failed=len(failed) + errors)
+
+        if failed and args.retries:
+            def retry_one(index: int) -> bool:
+                item = failed[index]
+                result = creator.api_handler.describe_image(item['image_path'], item.get('detail'))
+                if result.ok:
+                    item['text'] = result.text
+                    writer.write(item)
+                    failed.pop(index)
+                return result.ok
+
+            print(f"重试 {len(failed)} 张描述失败的图片...", file=sys.stderr)
+            dead_letters.drain(retry_one)
+    finally:
+        writer.close()
+    speed = speed_summary(results)
+    print(f"完成 {writer.count}/{len(todo)} 张，记录写入 {writer.output_path}{'，' + speed if speed else ''}",
+          file=sys.stderr)
+    return errors
+
+
+def _merge_text_outputs(directory: Path, output_dir: str, processor) -> None:
+    """按文件名顺序把语料目录中各文件的输出（json、parquet 或 arrow）合并到 processor 的结果中"""
+    from core.ingest_manifest import IngestManifest
+    from core.text_export import read_text_output
+
+    manifest = IngestManifest(Path(output_dir) / "ingest_manifest.json")
+    processor.text_results.clear()
+    processor.chunk_meta.clear()
+    for file in sorted(directory.glob("*.txt")):
+        entry = manifest.entries.get(str(file.absolute()))
+        if not entry or not os.path.exists(entry['output']):
+            continue
+        items, meta = read_text_output(entry['output'], file.name)
+        # 逐个文件追加，超出内存上限的部分随即落盘
+        processor.text_results.extend(items)
+        processor.chunk_meta.extend(meta)
+
+
+def run_text(args) -> int:
+    from core.dataset_creator import DatasetCreator
+
+    directory = Path(args.input)
+    if not directory.is_dir():
+        raise UsageError(f"语料目录不存在: {args.input}")
+    if args.format == "tokens" and not args.tokenizer:
+        raise UsageError("tokens 格式需要 --tokenizer")
+    creator = DatasetCreator(memory_limit_mb=args.memory_limit)
+    if args.instructions == "local":
+        creator.set_instruction_mode("local")
+    else:
+        _configure_api(creator, args)
+
+    failures = []
+    bar = tqdm(unit="file", desc="处理", disable=args.quiet)
+
+    def progress(done: int, total: int, name: str, ok: bool) -> None:
+        bar.total = total
+        bar.update(1)
+        if not ok:
+            failures.append(name)
+            bar.set_postfix(failed=len(failures))
+
+    try:
+        message = asyncio.run(creator.process_text_directory(
+            str(directory),
+            _read_prompt(None, args.analyzer_prompt_file),
+            _read_prompt(None, args.title_prompt_file),
+            _read_prompt(None, args.format_prompt_file),
+            output_dir=args.output_dir,
+            export_format=args.format,
+            resume=args.resume,
+            progress=progress
+        ))
+    finally:
+        bar.close()
+    print(message, file=sys.stderr)
+
+    # 整个语料的导出格式在逐文件输出之后统一合并生成
+    if args.format in ("packed", "tokens"):
+        _merge_text_outputs(directory, args.output_dir, creator.text_processor)
+        print(creator.save_text_dataset(args.output_dir, args.format, target_length=args.target_length,
+                                        separator=args.separator, tokenizer_path=args.tokenizer),
+              file=sys.stderr)
+    if failures:
+        print(f"失败的文件: {', '.join(failures)}", file=sys.stderr)
+        return EXIT_PARTIAL
+    return EXIT_OK
+
+
+def run_verify(args) -> int:
+    from core.dataset_verifier import verify_dataset
+
+    if not Path(args.path).exists():
+        raise UsageError(f"数据集不存在: {args.path}")
+    report = verify_dataset(args.path, deep=args.deep, workers=args.workers)
+    print(report.summary())
+    return EXIT_OK if report.ok else EXIT_PARTIAL
+
+
+def _split_text(content: str, max_chars: int) -> List[Tuple[int, str]]:
+    """在段落边界把长文本切成不超过 max_chars 的段，返回 (偏移, 文本)，max_chars 为 0 时不切分"""
+    if not max_chars or len(content) <= max_chars:
+        return [(0, content)]
+    segments = []
+    start = 0
+    while start < len(content):
+        end = min(start + max_chars, len(content))
+        if end < len(content):
+            # 优先在空行处断开，其次是换行，找不到时硬切
+            cut = content.rfind("\n\n", start, end)
+            if cut <= start:
+                cut = content.rfind("\n", start, end)
+            if cut > start:
+                end = cut
+        segments.append((start, content[start:end]))
+        start = end
+        while start < len(content) and content[start] == "\n":
+            start += 1
+    return [(offset, text) for offset, text in segments if text.strip()]
+
+
+def _queue_items(args) -> Iterator[Tuple[str, Dict]]:
+    if args.kind == "image":
+        for path in _collect_images(args.inputs):
+            yield path, {'path': path}
+        return
+    files = []
+    for value in args.inputs:
+        path = Path(value)
+        if not path.exists():
+            raise UsageError(f"输入不存在: {value}")
+        files += sorted(path.glob("*.txt")) if path.is_dir() else [path]
+    for file in files:
+        file = file.absolute()
+        content = file.read_text(encoding='utf-8')
+        for offset, text in _split_text(content, args.split_chars):
+            yield f"{file}#{offset}", {'source_file': file.name, 'offset': offset, 'text': text}
+
+
+def run_queue_init(args) -> int:
+    from core.work_queue import WorkQueue
+
+    work_queue = WorkQueue(args.queue)
+    meta = work_queue.meta()
+    if meta.get('kind', args.kind) != args.kind:
+        raise UsageError(f"队列已用于 {meta['kind']} 任务")
+    config = {'kind': args.kind}
+    if args.kind == "image":
+        config.update(prompt=_read_prompt(args.prompt, args.prompt_file), detail=args.detail)
+    else:
+        config.update(analyzer_prompt=_read_prompt(None, args.analyzer_prompt_file),
+                      title_prompt=_read_prompt(None, args.title_prompt_file),
+                      format_prompt=_read_prompt(None, args.format_prompt_file),
+                      instructions=args.instructions)
+    work_queue.set_meta(**config)
+    added = work_queue.enqueue(_queue_items(args))
+    if args.retry_failed:
+        print(f"重新排队 {work_queue.requeue_failed()} 个失败的工作项", file=sys.stderr)
+    print(f"加入 {added} 个工作项，队列状态: {work_queue.stats()}", file=sys.stderr)
+    return EXIT_OK
+
+
+def _image_task(creator, work_queue, meta: Dict):
+    """图片工作项：预处理、描述，并把导出用的图片字节写到队列目录"""
+    from core.image_processor import ImageProcessor
+
+    if meta.get('prompt'):
+        creator.api_handler.set_system_prompt(meta['prompt'])
+    policy = meta.get('detail', "auto")
+    images_dir = work_queue.queue_dir / "images"
+    images_dir.mkdir(exist_ok=True)
+
+    def process(item) -> Dict:
+        img, data, ext = ImageProcessor.preprocess_to_bytes(item.payload['path'], policy)
+        detail = ImageProcessor.choose_detail(img.size, policy)
+        payload, mime_type = ImageProcessor.encode_for_vision(data, detail)
+        result = creator.api_handler.describe(payload, mime_type, detail=detail)
+        if not result.ok:
+            raise RuntimeError(f"[{result.error_class}] {result.error}")
+        image_file = images_dir / f"{item.seq:09d}.{ext}"
+        tmp_file = images_dir / f".{image_file.name}.{item.lease_token}.tmp"
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, image_file)
+        return {'text': result.text, 'image_file': image_file.name, 'detail': detail}
+
+    return process
+
+
+def _text_task(creator, meta: Dict):
+    """文本工作项：用 TextProcessor 切块并生成指令数据，每个工作项使用独立的处理器"""
+    from core.text_processor import TextProcessor
+
+    prompts = [meta.get('analyzer_prompt'), meta.get('title_prompt'), meta.get('format_prompt')]
+
+    def process(item) -> Dict:
+        processor = TextProcessor(creator.api_handler)
+        processor.set_instruction_mode(meta.get('instructions', "llm"))
+
+        async def run() -> str:
+            if any(prompts):
+                await processor.update_prompts(*prompts)
+            async with processor:
+                _, message = await processor.process_file(item.payload['text'], item.payload['source_file'])
+            return message
+
+        message = asyncio.run(run())
+        if message != "处理完成":
+            raise RuntimeError(message)
+        meta_rows = [{'source_file': m['source_file'], 'chunk_offset': item.payload['offset'] + m['chunk_offset']}
+                     for m in processor.chunk_meta]
+        return {'records': list(processor.text_results), 'meta': meta_rows}
+
+    return process
+
+
+def run_queue_work(args) -> int:
+    from core.dataset_creator import DatasetCreator
+    from core.work_queue import QueueWorker, WorkQueue
+
+    work_queue = WorkQueue(args.queue, lease_seconds=args.lease, max_attempts=args.max_attempts)
+    meta = work_queue.meta()
+    if 'kind' not in meta:
+        raise UsageError(f"队列未初始化: {args.queue}")
+    creator = DatasetCreator(memory_limit_mb=args.memory_limit)
+    if meta['kind'] == "image" or meta.get('instructions') != "local":
+        _configure_api(creator, args)
+    if meta['kind'] == "image":
+        process = _image_task(creator, work_queue, meta)
+    else:
+        process = _text_task(creator, meta)
+
+    worker = QueueWorker(work_queue, process, worker_id=args.worker_id, threads=args.threads)
+    counts = worker.run(wait=args.wait, max_items=args.max_items)
+    print(f"工作进程 {worker.worker_id}: 提交 {counts['processed']} 个，失败 {counts['failed']} 个，"
+          f"队列状态: {work_queue.stats()}", file=sys.stderr)
+    return EXIT_PARTIAL if counts['failed'] else EXIT_OK
+
+
+def run_queue_status(args) -> int:
+    from core.work_queue import WorkQueue
+
+    work_queue = WorkQueue(args.queue)
+    stats = work_queue.stats()
+    print(json.dumps({'meta': {'kind': work_queue.meta().get('kind')}, 'items': stats}, ensure_ascii=False))
+    for failure in work_queue.failures():
+        print(f"失败 {failure['key']}（尝试 {failure['attempts']} 次）: {failure['error']}", file=sys.stderr)
+    return EXIT_PARTIAL if stats['failed'] else EXIT_OK
+
+
+def run_queue_merge(args) -> int:
+    from core.dataset_creator import DatasetCreator
+    from core.work_queue import WorkQueue
+
+    work_queue = WorkQueue(args.queue)
+    kind = work_queue.meta().get('kind')
+    stats = work_queue.stats()
+    unfinished = stats['pending'] + stats['leased'] + stats['expired']
+    if unfinished and not args.partial:
+        raise UsageError(f"还有 {unfinished} 个工作项未完成，可使用 --partial 只合并已完成的部分")
+    creator = DatasetCreator(memory_limit_mb=args.memory_limit, output_root=args.output_dir or ".")
+    # 按协调者分配的序号合并，结果与工作进程数量和完成顺序无关
+    if kind == "image":
+        if args.format not in IMAGE_FORMATS:
+            raise UsageError(f"图片队列不支持 {args.format} 格式")
+        images_dir = work_queue.queue_dir / "images"
+        records = [{'index': seq, 'image_file': str(images_dir / result['image_file']),
+                    'text': result['text'], 'source': payload['path']}
+                   for seq, payload, result in work_queue.results()]
+        print(_export_images(creator, records, args.format), file=sys.stderr)
+    elif kind == "text":
+        if args.format in IMAGE_FORMATS and args.format != "parquet":
+            raise UsageError(f"文本队列不支持 {args.format} 格式")
+        if args.format == "tokens" and not args.tokenizer:
+            raise UsageError("tokens 格式需要 --tokenizer")
+
+        creator.text_processor = creator.new_text_processor()
+        for _, _, result in work_queue.results():
+            creator.text_processor.text_results.extend(result['records'])
+            creator.text_processor.chunk_meta.extend(result['meta'])
+        print(creator.save_text_dataset(args.output_dir or "text_dataset", args.format,
+                                        target_length=args.target_length, separator=args.separator,
+                                        tokenizer_path=args.tokenizer),
+              file=sys.stderr)
+    else:
+        raise UsageError(f"队列未初始化: {args.queue}")
+    return EXIT_PARTIAL if stats['failed'] else EXIT_OK
+
+
+def _add_api_options(parser: argparse.ArgumentParser) -> None:
+    group = parser.add_argument_group("API 设置（默认读取 OPENAI_BASE_URL / OPENAI_API_KEY / OPENAI_MODEL）")
+    group.add_argument("--base-url", help="API 基础 URL")
+    group.add_argument("--api-key", help="API 密钥")
+    group.add_argument("--model", help="模型名称")
+    group.add_argument("--stage-models", metavar="SPEC",
+                       help="分阶段的模型级联，如 '*=gpt-4o-mini>gpt-4o;title=gpt-4o-mini'，"
+                            "先用便宜模型，结果未通过校验时升级（默认读取 PRETUNING_STAGE_MODELS）")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="pretuning", description="Pretuning 数据集批处理命令行")
+    parser.add_argument("-v", "--verbose", action="store_true", help="输出详细日志")
+    parser.add_argument("-q", "--quiet", action="store_true", help="不显示进度条")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text", help="日志格式")
+    parser.add_argument("--trace", action="store_true", help="输出每个处理步骤的 span 日志")
+    parser.add_argument("--metrics-port", type=int, help="在本机该端口提供 Prometheus 指标 /metrics")
+    parser.add_argument("--memory-limit", type=float, metavar="MB",
+                        help="结果数据的内存上限，超出后记录和图片写入临时目录，导出时流式读回")
+    parser.add_argument("--profile", action="store_true", help="记录调用栈采样和各步骤的内存分配")
+    parser.add_argument("--profile-dir", help="性能分析报告目录，默认为输出目录（队列命令为队列目录）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    image = sub.add_parser("image", help="为图片生成描述并导出数据集")
+    image.add_argument("inputs", nargs="+", help="图片文件或目录")
+    image.add_argument("--prompt", help="描述提示词")
+    image.add_argument("--prompt-file", help="从文件读取描述提示词")
+    image.add_argument("--workers", type=int, default=4, help="并发描述请求数")
+    image.add_argument("--detail", choices=["auto", "low", "high"], default="auto", help="视觉细节策略")
+    image.add_argument("--retries", type=int, default=2, help="失败图片的额外重试次数")
+    image.add_argument("--stream", action="store_true", help="流式接收描述，记录首 token 耗时和生成速度")
+    image.add_argument("--max-tokens", type=int, help="每条描述的最大输出 token 数")
+    image.add_argument("--stop", action="append", metavar="SEQ",
+                       help="停止序列，可重复指定（最多 4 个），流式时命中后立即断开")
+    image.add_argument("--output-dir", default="image_dataset",
+                       help="增量记录的输出目录，--format 导出的数据集也写在其下")
+    image.add_argument("--format", choices=["hf", "parquet", "webdataset", "none"], default="parquet",
+                       help="处理完成后的导出格式")
+    image.add_argument("--no-resume", dest="resume", action="store_false",
+                       help="忽略已完成的记录，重新处理所有图片")
+    _add_api_options(image)
+    image.set_defaults(func=run_image)
+
+    text = sub.add_parser("text", help="增量处理语料目录中的 .txt 文件")
+    text.add_argument("input", help="语料目录")
+    text.add_argument("--analyzer-prompt-file", help="分析器提示词文件")
+    text.add_argument("--title-prompt-file", help="标题生成器提示词文件")
+    text.add_argument("--format-prompt-file", help="格式化器提示词文件")
+    text.add_argument("--instructions", choices=["llm", "local"], default="llm",
+                      help="指令生成方式：llm 调用模型；local 在本地切块并按关键词生成，不需要 API")
+    text.add_argument("--output-dir", default="text_dataset", help="输出目录")
+    text.add_argument("--format", choices=["json", "parquet", "arrow", "packed", "tokens"], default="json",
+                      help="导出格式")
+    text.add_argument("--target-length", type=int, default=2048, help="packed 格式的目标序列长度")
+    text.add_argument("--separator", default="\n\n", help="packed 格式的样本分隔符")
+    text.add_argument("--tokenizer", help="tokens 格式使用的 tokenizer.json")
+    text.add_argument("--no-resume", dest="resume", action="store_false",
+                      help="忽略增量清单，重新处理所有文件")
+    _add_api_options(text)
+    text.set_defaults(func=run_text)
+
+    verify = sub.add_parser("verify", help="校验已导出的数据集")
+    verify.add_argument("path", help="数据集目录")
+    verify.add_argument("--deep", action="store_true", help="完整解码每张图片")
+    verify.add_argument("--workers", type=int, help="校验进程数")
+    verify.set_defaults(func=run_verify)
+
+    queue = sub.add_parser("queue", help="多进程 / 多机工作队列")
+    queue_sub = queue.add_subparsers(dest="queue_command", required=True)
+
+    init = queue_sub.add_parser("init", help="协调者：把输入拆成工作项加入队列，可重复运行追加新输入")
+    init.add_argument("queue", help="队列目录（多机使用时放在共享存储上）")
+    init.add_argument("kind", choices=["image", "text"], help="任务类型")
+    init.add_argument("inputs", nargs="+", help="图片文件或目录；文本文件或语料目录")
+    init.add_argument("--split-chars", type=int, default=20000,
+                      help="文本在段落边界切分为不超过该字符数的工作项，0 为每个文件一个")
+    init.add_argument("--prompt", help="图片描述提示词")
+    init.add_argument("--prompt-file", help="从文件读取图片描述提示词")
+    init.add_argument("--detail", choices=["auto", "low", "high"], default="auto", help="视觉细节策略")
+    init.add_argument("--analyzer-prompt-file", help="分析器提示词文件")
+    init.add_argument("--title-prompt-file", help="标题生成器提示词文件")
+    init.add_argument("--format-prompt-file", help="格式化器提示词文件")
+    init.add_argument("--instructions", choices=["llm", "local"], default="llm",
+                      help="文本指令生成方式，local 时工作进程不需要 API")
+    init.add_argument("--retry-failed", action="store_true", help="把已失败的工作项重新放回队列")
+    init.set_defaults(func=run_queue_init)
+
+    work = queue_sub.add_parser("work", help="工作进程：租用并处理工作项，可在多台机器上同时运行")
+    work.add_argument("queue", help="队列目录")
+    work.add_argument("--threads", type=int, default=4, help="本进程同时处理的工作项数")
+    work.add_argument("--lease", type=float, default=600, help="租约秒数，崩溃进程的工作项在此之后被接手")
+    work.add_argument("--max-attempts", type=int, default=3, help="每个工作项最多尝试次数")
+    work.add_argument("--max-items", type=int, help="处理该数量后退出")
+    work.add_argument("--worker-id", help="工作进程标识，默认为 主机名:进程号")
+    work.add_argument("--no-wait", dest="wait", action="store_false",
+                      help="只剩其他进程持有的工作项时立即退出，不等待接手")
+    _add_api_options(work)
+    work.set_defaults(func=run_queue_work)
+
+    status = queue_sub.add_parser("status", help="查看队列各状态的工作项数")
+    status.add_argument("queue", help="队列目录")
+    status.set_defaults(func=run_queue_status)
+
+    merge = queue_sub.add_parser("merge", help="按输入顺序合并已完成的结果并导出数据集")
+    merge.add_argument("queue", help="队列目录")
+    merge.add_argument("--format", choices=["hf", "parquet", "webdataset", "json", "arrow", "packed", "tokens"],
+                       default="parquet", help="导出格式，图片队列为 hf/parquet/webdataset，文本队列为其余格式")
+    merge.add_argument("--output-dir",
+                       help="输出目录，文本队列默认 text_dataset，图片队列默认当前目录（数据集写在其下）")
+    merge.add_argument("--target-length", type=int, default=2048, help="packed 格式的目标序列长度")
+    merge.add_argument("--separator", default="\n\n", help="packed 格式的样本分隔符")
+    merge.add_argument("--tokenizer", help="tokens 格式使用的 tokenizer.json")
+    merge.add_argument("--partial", action="store_true", help="允许在仍有未完成工作项时合并")
+    merge.set_defaults(func=run_queue_merge)
+    return parser
+
+
+def _run_profiled(args: argparse.Namespace) -> int:
+    """在性能分析中运行子命令，结束后打印报告位置"""
+    from core.profiling import profile_job
+
+    output_dir = args.profile_dir or getattr(args, 'queue', None) or getattr(args, 'output_dir', None) or "."
+    name = "_".join(filter(None, [args.command, getattr(args, 'queue_command', None)]))
+    profile: Dict = {}
+    try:
+        with profile_job(output_dir, name) as profile:
+            return args.func(args)
+    finally:
+        if profile.get('path'):
+            print(f"性能分析报告: {profile['path']}", file=sys.stderr)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    from core.telemetry import configure_logging, start_metrics_server
+
+    args = build_parser().parse_args(argv)
+    configure_logging("INFO" if args.verbose else "WARNING", args.log_format, trace=args.trace)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    try:
+        if not args.profile:
+            return args.func(args)
+        return _run_profiled(args)
+    except UsageError as e:
+        print(f"错误: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    except KeyboardInterrupt:
+        print("已中断，已完成的记录保留在输出目录中，可直接重新运行续跑", file=sys.stderr)
+        return EXIT_INTERRUPTED
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,46 @@
 # config/api_config.py
-from dataclasses import dataclass
-import openai
+from dataclasses import dataclass, field
 import logging
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+# 可以单独配置模型级联的处理阶段：文本分块、标题、格式化、图片描述
+CASCADE_STAGES = ("analyzer", "title", "format", "image")
+
+
+def parse_stage_models(spec: str) -> Dict[str, List[str]]:
+    """解析分阶段的模型级联配置
+
+    格式为 "阶段=模型1>模型2;阶段=模型"，同一阶段先用排在前面的（便宜、快速的）模型，
+    结果未通过校验时依次升级到后面的模型。阶段写 * 时作用于所有未单独配置的阶段。
+
+    Args:
+        spec: 配置字符串，例如 "*=gpt-4o-mini>gpt-4o;title=gpt-4o-mini"
+
+    Returns:
+        Dict[str, List[str]]: 阶段到模型列表的映射
+
+    Raises:
+        ValueError: 格式错误或阶段名未知
+    """
+    stage_models: Dict[str, List[str]] = {}
+    for item in (spec or "").replace("\n", ";").split(";"):
+        if not item.strip():
+            continue
+        stage, sep, models = item.partition("=")
+        stage = stage.strip()
+        if not sep:
+            raise ValueError(f"分阶段模型配置缺少 '=': {item.strip()}")
+        if stage != "*" and stage not in CASCADE_STAGES:
+            raise ValueError(f"未知的处理阶段: {stage}（可选 {', '.join(CASCADE_STAGES)} 或 *）")
+        names = [m.strip() for m in models.split(">") if m.strip()]
+        if not names:
+            raise ValueError(f"阶段 {stage} 没有配置模型")
+        stage_models[stage] = names
+    return stage_models
+
+
 @dataclass
 class APIConfig:
     base_url: str
@@ -13,6 +48,29 @@ class APIConfig:
     model: str = "gpt-4-vision-preview"
     max_retries: int = 3
     retry_delay: int = 2
+    # 多图合并请求时的上下文预算
+    context_window: int = 128000
+    max_images_per_request: int = 8
+    output_tokens_per_image: int = 400
+    # 各阶段的模型级联，未配置的阶段只使用 model
+    stage_models: Dict[str, List[str]] = field(default_factory=dict)
+    # 图片描述的输出控制：max_tokens 为空时不限制，stop 为停止序列（接口最多接受 4 个）
+    max_tokens: Optional[int] = None
+    stop: List[str] = field(default_factory=list)
+    # 流式接收图片描述，边生成边显示，并记录首 token 耗时和生成速度
+    stream: bool = False
+
+    def models_for(self, stage: str) -> List[str]:
+        """返回某个阶段依次尝试的模型列表
+
+        Args:
+            stage: 处理阶段，见 CASCADE_STAGES
+
+        Returns:
+            List[str]: 去重后的模型名称，第一个最先调用
+        """
+        models = self.stage_models.get(stage) or self.stage_models.get("*") or [self.model]
+        return list(dict.fromkeys(models))
 
     def test_connection(self) -> Tuple[bool, str]:
         """测试API连接
@@ -20,6 +78,8 @@ class APIConfig:
         Returns:
             Tuple[bool, str]: (是否成功, 消息)
         """
+        import openai
+        
         try:
             if not self.validate()[0]:
                 return False, "API配置验证失败"
@@ -69,6 +129,10 @@ class APIConfig:
             # 验证API key格式（可以根据实际需求添加更多验证）
             if len(self.api_key) < 8:
                 return False, "API Key 格式无效"
+            
+            unknown = set(self.stage_models) - set(CASCADE_STAGES) - {"*"}
+            if unknown:
+                return False, f"未知的处理阶段: {', '.join(sorted(unknown))}"
                 
             return True, ""
             
@@ -1,12 +1,85 @@
 
 from pathlib import Path
-import openai
+import base64
 import time
-import httpx
-from typing import List, Dict
+import json
+import logging
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import Callable, List, Dict, Optional, Tuple
+from pydantic import BaseModel, TypeAdapter, ValidationError
 from config.api_config import APIConfig
+from core.cascade import check_description, record_cascade
 from core.image_processor import ImageProcessor
-from pydantic_ai.models.openai import OpenAIModel
+from core.telemetry import (API_IN_FLIGHT, API_LATENCY, API_TOKENS_PER_SECOND, API_TTFT, record_api_error,
+                            record_items, span)
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def transient_errors() -> tuple:
+    """可通过退避重试恢复的错误
+
+    openai 导入较慢，首次需要时才导入。
+    """
+    import openai
+    return (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+
+@dataclass
+class DescriptionResult:
+    """一次描述调用的结构化结果"""
+    text: str = ""
+    error_class: Optional[str] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    # 回复因达到输出 token 上限被截断
+    truncated: bool = False
+    # 本次请求的输出 token 数、首 token 耗时（仅流式）和生成速度
+    output_tokens: Optional[int] = None
+    ttft: Optional[float] = None
+    tokens_per_sec: Optional[float] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error_class is None
+
+    def as_text(self) -> str:
+        """兼容旧接口：失败时返回 "生成失败: ..." 字符串"""
+        return self.text if self.ok else f"生成失败: {self.error}"
+
+
+def speed_summary(results: List[DescriptionResult]) -> str:
+    """汇总一批请求的平均首 token 耗时和输出速度，没有可用数据时返回空字符串"""
+    ttfts = [r.ttft for r in results if r.ttft is not None]
+    speeds = [r.tokens_per_sec for r in results if r.tokens_per_sec]
+    parts = []
+    if ttfts:
+        parts.append(f"平均首 token {sum(ttfts) / len(ttfts) * 1000:.0f}ms")
+    if speeds:
+        parts.append(f"平均 {sum(speeds) / len(speeds):.1f} token/秒")
+    return "，".join(parts)
+
+
+class IndexedDescription(BaseModel):
+    """多图请求中按编号返回的单条描述"""
+    index: int
+    description: str
+
+
+_batch_adapter = TypeAdapter(List[IndexedDescription])
+
+BATCH_INSTRUCTION = """以下共有 {count} 张图片，每张图片前用 [图片 i] 标记编号（i 从 1 到 {count}）。
+请按上面的要求分别描述每一张图片，只返回 JSON 数组，不要包含其他内容：
+[{{"index": 1, "description": "第1张图片的描述"}}, ...]
+数组必须恰好包含 {count} 项，index 与图片编号一一对应。"""
+
 
 class APIHandler:
     def __init__(self, config: APIConfig):
@@ -15,6 +88,8 @@ class APIHandler:
         Args:
             config: API配置对象
         """
+        import openai
+        
         self.config = config
         
         self.client = openai.OpenAI(
@@ -22,28 +97,45 @@ class APIHandler:
             api_key=config.api_key
         )
         
+        # 异步客户端和 pydantic_ai 模型在首次使用时才创建
+        self._http_client = None
+        self._pydantic_model = None
         
-        self.http_client = httpx.AsyncClient(
-            base_url=config.base_url,
-            headers={"Authorization": f"Bearer {config.api_key}"},
-            timeout=30.0
-        )
-        
-        self.pydantic_model = OpenAIModel(
-            config.model,
-            api_key=config.api_key,
-            http_client=self.http_client
-        )
-        
-        self.max_retries = 3
-        self.retry_delay = 2
+        self.max_retries = config.max_retries
+        self.retry_delay = config.retry_delay
         self.system_prompt = "你是一个专业的图像识别专家。请详细描述这张医学图像。"
     
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.http_client.aclose()
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+            self._pydantic_model = None
+
+    @property
+    def http_client(self):
+        if self._http_client is None or self._http_client.is_closed:
+            import httpx
+            self._http_client = httpx.AsyncClient(
+                base_url=self.config.base_url,
+                headers={"Authorization": f"Bearer {self.config.api_key}"},
+                timeout=30.0
+            )
+            self._pydantic_model = None
+        return self._http_client
+
+    @property
+    def pydantic_model(self):
+        if self._pydantic_model is None:
+            from pydantic_ai.models.openai import OpenAIModel
+            self._pydantic_model = OpenAIModel(
+                self.config.model,
+                api_key=self.config.api_key,
+                http_client=self.http_client
+            )
+        return self._pydantic_model
         
     def set_system_prompt(self, prompt: str) -> None:
         """设置系统提示词
@@ -53,54 +145,400 @@ class APIHandler:
         """
         self.system_prompt = prompt
 
-    def generate_description(self, image_path: Path, retry_count: int = 0) -> str:
-        """生成图片描述
+    @staticmethod
+    def _image_part(base64_image: str, mime_type: Optional[str], detail: Optional[str]) -> Dict:
+        if not mime_type:
+            mime_type = ImageProcessor.guess_mime(base64.b64decode(base64_image[:16]))
+        image_url = {"url": f"data:{mime_type};base64,{base64_image}"}
+        if detail:
+            image_url["detail"] = detail
+        return {"type": "image_url", "image_url": image_url}
+
+    def build_messages(self, base64_image: str, mime_type: str = "image/jpeg", detail: Optional[str] = None) -> List[Dict]:
+        """构造图片描述请求的消息列表
         
         Args:
-            image_path: 图片路径
-            retry_count: 重试次数
+            base64_image: base64编码的图片
+            mime_type: 图片MIME类型
+            detail: 视觉细节等级 low/high，为空时由服务端决定
             
         Returns:
-            str: 生成的描述文本
+            List[Dict]: chat completion 消息列表
         """
-        try:
-            # 准备消息
-            messages = [
-                {
-                    "role": "system",
-                    "content": self.system_prompt
-                }
-            ]
-            
-            # 编码图片
-            base64_image = ImageProcessor.encode_image(image_path)
-            messages.append({
+        return [
+            {
+                "role": "system",
+                "content": self.system_prompt
+            },
+            {
                 "role": "user",
                 "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
+                    self._image_part(base64_image, mime_type, detail)
                 ]
-            })
+            }
+        ]
 
-            # 调用API
-            response = self.client.chat.completions.create(
-                model=self.config.model,
-                messages=messages
-            )
+    def describe(self, base64_image: str, mime_type: str = "image/jpeg", detail: Optional[str] = None,
+                 on_delta: Optional[Callable[[str], None]] = None) -> DescriptionResult:
+        """为已编码的图片生成描述，返回结构化结果
+        
+        速率限制、超时等临时错误按指数退避重试，其他错误直接返回失败。
+        配置了 image 阶段的模型级联时，失败、截断或描述未通过校验会升级到下一个模型。
+        
+        Args:
+            base64_image: base64编码的图片
+            mime_type: 图片MIME类型
+            detail: 视觉细节等级 low/high
+            on_delta: 流式接收时每收到一段文本调用一次，参数为目前为止的完整文本
             
-            return response.choices[0].message.content
-
-        except openai.RateLimitError as e:
-            # 达到速率限制时重试
-            if retry_count < self.max_retries:
-                time.sleep(self.retry_delay * (2 ** retry_count))
-                return self.generate_description(image_path, retry_count + 1)
-            return f"生成失败: {str(e)}"
+        Returns:
+            DescriptionResult: 描述文本或错误类型、尝试次数和最后的错误
+        """
+        result = self._chat_cascade(self.build_messages(base64_image, mime_type, detail), self._check_single,
+                                    on_delta)
+        if result.ok and not result.text.strip():
+            result = DescriptionResult(error_class="EmptyResponse", error="模型返回空描述", attempts=result.attempts)
+        record_items("image", ok=result.ok)
+        return result
+
+    @staticmethod
+    def _check_single(result: DescriptionResult) -> Optional[str]:
+        if not result.ok:
+            return result.error_class
+        if result.truncated:
+            return "truncated"
+        return check_description(result.text)
+
+    def _chat_cascade(self, messages: List[Dict], check: Callable[[DescriptionResult], Optional[str]],
+                      on_delta: Optional[Callable[[str], None]] = None) -> DescriptionResult:
+        """按 image 阶段配置的模型级联发送请求
+        
+        先调用排在前面的模型，请求失败或 check 不通过时升级到下一个模型，
+        最后一个模型的结果无论是否通过都直接返回。
+        
+        Args:
+            messages: 消息列表
+            check: 校验函数，返回不通过的原因，通过时返回 None
+            on_delta: 流式接收时的回调，升级模型后从头重新回调
             
+        Returns:
+            DescriptionResult: 被采用的回复，attempts 为所有模型的尝试次数之和
+        """
+        models = self.config.models_for("image")
+        attempts = 0
+        for i, model in enumerate(models):
+            result = self._chat(messages, model, on_delta)
+            attempts += result.attempts
+            final = i == len(models) - 1
+            if record_cascade("image", model, check(result), final) != "escalated":
+                return replace(result, attempts=attempts)
+
+    def _request_options(self) -> Dict:
+        """max_tokens 和停止序列等请求参数"""
+        options = {}
+        if self.config.max_tokens:
+            options['max_tokens'] = self.config.max_tokens
+        if self.config.stop:
+            options['stop'] = self.config.stop[:4]
+        return options
+
+    def _chat(self, messages: List[Dict], model: Optional[str] = None,
+              on_delta: Optional[Callable[[str], None]] = None) -> DescriptionResult:
+        """发送一次 chat completion，临时错误按指数退避重试
+        
+        Args:
+            messages: 消息列表
+            model: 使用的模型，为空时使用配置中的 model
+            on_delta: 流式接收时的回调，参数为目前为止的完整文本
+            
+        Returns:
+            DescriptionResult: 原始回复文本或错误信息
+        """
+        model = model or self.config.model
+        attempts = 0
+        while True:
+            attempts += 1
+            start = time.perf_counter()
+            outcome = "ok"
+            try:
+                with span("api.chat", model=model, attempt=attempts, stream=self.config.stream) as attrs, \
+                        API_IN_FLIGHT.track(kind="chat"):
+                    if self.config.stream:
+                        result = self._stream(messages, model, start, on_delta)
+                    else:
+                        response = self.client.chat.completions.create(
+                            model=model,
+                            messages=messages,
+                            **self._request_options()
+                        )
+                        choice = response.choices[0]
+                        usage = getattr(response, 'usage', None)
+                        result = DescriptionResult(text=choice.message.content or "",
+                                                   truncated=choice.finish_reason == "length",
+                                                   output_tokens=getattr(usage, 'completion_tokens', None))
+                    result.attempts = attempts
+                    if result.output_tokens:
+                        # 流式请求扣除首 token 耗时，只计生成阶段；非流式请求只能按整个请求耗时计算
+                        elapsed = time.perf_counter() - start - (result.ttft or 0)
+                        if elapsed > 0:
+                            result.tokens_per_sec = result.output_tokens / elapsed
+                            API_TOKENS_PER_SECOND.observe(result.tokens_per_sec, kind="chat")
+                    attrs.update(output_tokens=result.output_tokens, tokens_per_sec=result.tokens_per_sec,
+                                 ttft_ms=round(result.ttft * 1000, 1) if result.ttft is not None else None)
+                return result
+                
+            except transient_errors() as e:
+                outcome = type(e).__name__
+                retrying = attempts <= self.max_retries
+                record_api_error(e, retrying)
+                if retrying:
+                    time.sleep(self.retry_delay * (2 ** (attempts - 1)))
+                    continue
+                return DescriptionResult(error_class=type(e).__name__, error=str(e), attempts=attempts)
+                
+            except Exception as e:
+                outcome = type(e).__name__
+                record_api_error(e, False)
+                error_msg = str(e).encode('utf-8').decode('utf-8')
+                return DescriptionResult(error_class=type(e).__name__, error=error_msg, attempts=attempts)
+            
+            finally:
+                API_LATENCY.observe(time.perf_counter() - start, kind="chat", outcome=outcome)
+
+    def plan_batches(self, image_sizes: List[Tuple[int, int]], details: Optional[List[str]] = None) -> List[List[int]]:
+        """按上下文和图片 token 预算把图片分组
+        
+        每组的系统提示词、图片 token 与预留的输出 token 之和不超过模型上下文，
+        且图片数不超过 max_images_per_request。
+        
+        Args:
+            image_sizes: 每张图片的尺寸 (宽, 高)
+            details: 每张图片的细节等级，为空时按 high 估算
+            
+        Returns:
+            List[List[int]]: 每组图片在输入列表中的下标
+        """
+        # 中文提示词按每字约 1 token 粗略估算
+        fixed_tokens = len(self.system_prompt) + len(BATCH_INSTRUCTION)
+        budget = self.config.context_window - fixed_tokens
+        max_count = max(1, self.config.max_images_per_request)
+        
+        batches: List[List[int]] = []
+        current: List[int] = []
+        used = 0
+        for i, size in enumerate(image_sizes):
+            detail = details[i] if details else "high"
+            cost = ImageProcessor.estimate_image_tokens(size, detail) + self.config.output_tokens_per_image
+            if current and (len(current) >= max_count or used + cost > budget):
+                batches.append(current)
+                current, used = [], 0
+            current.append(i)
+            used += cost
+        if current:
+            batches.append(current)
+        return batches
+
+    def build_batch_messages(self, payloads: List[str], mime_type: Optional[str] = None,
+                             details: Optional[List[str]] = None) -> List[Dict]:
+        """构造一次请求多张图片的消息列表，每张图片前加编号标记
+        
+        Args:
+            payloads: base64编码的图片列表
+            mime_type: 图片MIME类型，为空时按每张图片的文件头判断
+            details: 每张图片的细节等级
+            
+        Returns:
+            List[Dict]: chat completion 消息列表
+        """
+        content = [{"type": "text", "text": BATCH_INSTRUCTION.format(count=len(payloads))}]
+        for i, payload in enumerate(payloads, 1):
+            content.append({"type": "text", "text": f"[图片 {i}]"})
+            content.append(self._image_part(payload, mime_type, details[i - 1] if details else None))
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": content}
+        ]
+
+    @staticmethod
+    def parse_batch_response(text: str, count: int) -> Optional[List[str]]:
+        """解析多图请求的回复
+        
+        Args:
+            text: 模型回复
+            count: 期望的描述条数
+            
+        Returns:
+            Optional[List[str]]: 按编号排列的描述，条数或编号不匹配时返回 None
+        """
+        json_str = text.replace('```json', '').replace('```', '').strip()
+        try:
+            items = _batch_adapter.validate_python(json.loads(json_str))
+        except (json.JSONDecodeError, ValidationError):
+            return None
+        by_index = {item.index: item.description.strip() for item in items}
+        if len(items) != count or sorted(by_index) != list(range(1, count + 1)):
+            return None
+        if not all(by_index.values()):
+            return None
+        return [by_index[i] for i in range(1, count + 1)]
+
+    def _stop_index(self, text: str, tail: int) -> Optional[int]:
+        """在新收到的末尾部分查找停止序列，返回截断位置"""
+        for stop in self.config.stop:
+            index = text.find(stop, max(0, len(text) - tail - len(stop)))
+            if index != -1:
+                return index
+        return None
+
+    def _stream(self, messages: List[Dict], model: str, start: float,
+                on_delta: Optional[Callable[[str], None]]) -> DescriptionResult:
+        """以流式接收回复
+        
+        每收到一段文本调用一次 on_delta。服务端不支持 stop 或 max_tokens 时也在本地检查：
+        命中停止序列或输出达到 max_tokens 后立即关闭连接，不再为剩余输出付费。
+        服务端未返回 usage 时按收到的文本段数估算输出 token 数（通常每段一个 token）。
+        
+        Args:
+            messages: 消息列表
+            model: 使用的模型
+            start: 请求开始时间（perf_counter），用于计算首 token 耗时
+            on_delta: 文本回调，参数为目前为止的完整文本
+            
+        Returns:
+            DescriptionResult: 回复文本、是否截断、输出 token 数和首 token 耗时
+        """
+        stream = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            **self._request_options()
+        )
+        text = ""
+        pieces = 0
+        usage_tokens = None
+        ttft = None
+        finish_reason = None
+        try:
+            for chunk in stream:
+                usage = getattr(chunk, 'usage', None)
+                if usage is not None:
+                    usage_tokens = usage.completion_tokens
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                delta = choice.delta.content if choice.delta else None
+                if not delta:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                    API_TTFT.observe(ttft, kind="chat")
+                pieces += 1
+                text += delta
+                cut = self._stop_index(text, len(delta)) if self.config.stop else None
+                if cut is not None:
+                    text, finish_reason = text[:cut], "stop"
+                    break
+                if on_delta:
+                    on_delta(text)
+                if self.config.max_tokens and pieces >= self.config.max_tokens:
+                    finish_reason = "length"
+                    break
+        finally:
+            stream.close()
+        if on_delta and finish_reason == "stop":
+            on_delta(text)
+        return DescriptionResult(text=text, truncated=finish_reason == "length",
+                                 output_tokens=usage_tokens or pieces, ttft=ttft)
+
+    def _check_batch(self, result: DescriptionResult, count: int) -> Optional[str]:
+        if not result.ok:
+            return result.error_class
+        descriptions = self.parse_batch_response(result.text, count)
+        if descriptions is None:
+            return "truncated" if result.truncated else "malformed"
+        for description in descriptions:
+            reason = check_description(description)
+            if reason:
+                return reason
+        return None
+
+    def describe_batch(self, payloads: List[str], mime_type: Optional[str] = None,
+                       details: Optional[List[str]] = None) -> List[DescriptionResult]:
+        """一次请求为多张图片生成描述
+        
+        回复条数不匹配或请求被拒绝时先按级联升级模型，仍不成功时把这一组拆成两半分别重试，
+        直到单张图片时退回 describe。
+        
+        Args:
+            payloads: base64编码的图片列表
+            mime_type: 图片MIME类型，为空时按每张图片的文件头判断
+            details: 每张图片的细节等级
+            
+        Returns:
+            List[DescriptionResult]: 与 payloads 一一对应的结果
+        """
+        details = details or [None] * len(payloads)
+        if len(payloads) == 1:
+            single_mime = mime_type or ImageProcessor.guess_mime(base64.b64decode(payloads[0][:16]))
+            return [self.describe(payloads[0], single_mime, details[0])]
+            
+        count = len(payloads)
+        result = self._chat_cascade(self.build_batch_messages(payloads, mime_type, details),
+                                    lambda r: self._check_batch(r, count))
+        if result.ok:
+            descriptions = self.parse_batch_response(result.text, len(payloads))
+            if descriptions is not None:
+                record_items("image", len(payloads))
+                return [DescriptionResult(text=d, attempts=result.attempts) for d in descriptions]
+        elif result.error_class != "BadRequestError":
+            record_items("image", len(payloads), ok=False)
+            return [replace(result) for _ in payloads]
+            
+        # 条数不匹配或超出上下文，拆分后重试
+        mid = len(payloads) // 2
+        return (self.describe_batch(payloads[:mid], mime_type, details[:mid]) +
+                self.describe_batch(payloads[mid:], mime_type, details[mid:]))
+
+    def describe_encoded(self, base64_image: str, mime_type: str = "image/jpeg") -> str:
+        """为已编码的图片生成描述
+        
+        Args:
+            base64_image: base64编码的图片
+            mime_type: 图片MIME类型
+            
+        Returns:
+            str: 生成的描述文本，失败时为 "生成失败: ..."
+        """
+        return self.describe(base64_image, mime_type).as_text()
+
+    def describe_image(self, image_path: Path, detail: Optional[str] = None,
+                       on_delta: Optional[Callable[[str], None]] = None) -> DescriptionResult:
+        """读取并编码图片后生成描述
+        
+        Args:
+            image_path: 图片路径
+            detail: 视觉细节等级 low/high
+            on_delta: 流式接收时的文本回调
+            
+        Returns:
+            DescriptionResult: 结构化的描述结果
+        """
+        try:
+            base64_image, mime_type = ImageProcessor.encode_for_vision(Path(image_path).read_bytes(),
+                                                                       detail or "auto")
         except Exception as e:
-            error_msg = str(e).encode('utf-8').decode('utf-8')
-            return f"生成失败: {error_msg}"
\ No newline at end of file
+            logger.error(f"图片编码失败: {str(e)}")
+            return DescriptionResult(error_class=type(e).__name__, error=str(e), attempts=0)
+        return self.describe(base64_image, mime_type, detail=detail, on_delta=on_delta)
+
+    def generate_description(self, image_path: Path) -> str:
+        """生成图片描述
+        
+        Args:
+            image_path: 图片路径
+            
+        Returns:
+            str: 生成的描述文本
+        """
+        return self.describe_image(image_path).as_text()
@@ -0,0 +1,137 @@
+import json
+import logging
+from typing import Callable, Dict, Optional
+
+from core.telemetry import CASCADE_CALLS
+
+logger = logging.getLogger(__name__)
+
+# 标题的最大字符数，提示词要求 10 字以内，留出余量
+TITLE_MAX_CHARS = 30
+# 图片描述的最小字符数
+DESCRIPTION_MIN_CHARS = 10
+# 出现在回复开头时视为模型拒绝或没有把握
+REFUSAL_MARKERS = ("抱歉", "对不起", "无法识别", "无法描述", "无法查看", "我无法", "我不能",
+                   "sorry", "i'm unable", "i am unable", "i can't", "i cannot", "unable to")
+# 只在回复开头检查拒绝用语，避免正文中的“无法辨认的字迹”之类误判
+_REFUSAL_WINDOW = 40
+
+
+def _compact(text: str, limit: int) -> str:
+    """去掉空白后取前 limit 个字符，用于比较模型回复与原文的开头"""
+    return "".join(text.split())[:limit]
+
+
+def check_split(text: str, source: str) -> Optional[str]:
+    """校验文本分析 agent 返回的分块
+
+    分块应是原文的开头一段：非空、不比原文长、开头与原文一致，
+    原文较长时分块不能过短（否则 process_file 会把剩余内容整体当作一块）。
+
+    Args:
+        text: 模型返回的分块
+        source: 待分块的原文
+
+    Returns:
+        Optional[str]: 不通过的原因，通过时为 None
+    """
+    if not text or not text.strip():
+        return "empty"
+    if len(text) > len(source) + 20:
+        return "too_long"
+    if len(source) > 100 and len(text.strip()) < 50:
+        return "too_short"
+    head = _compact(text, 20)
+    if not _compact(source, len(head) + 5).startswith(head):
+        return "not_prefix"
+    return None
+
+
+def check_title(text: str, source: str = "") -> Optional[str]:
+    """校验标题：非空、单行、不超过 TITLE_MAX_CHARS、不是 JSON"""
+    title = (text or "").strip()
+    if not title:
+        return "empty"
+    if len(title) > TITLE_MAX_CHARS:
+        return "too_long"
+    if "\n" in title or title.startswith(("{", "[", "```")):
+        return "malformed"
+    return None
+
+
+def check_format(text: str, source: str = "") -> Optional[str]:
+    """校验格式化结果：合法 JSON 对象，instruction 和 output 为非空字符串"""
+    json_str = (text or "").replace('```json', '').replace('```', '').strip()
+    if not json_str:
+        return "empty"
+    try:
+        data = json.loads(json_str)
+    except json.JSONDecodeError:
+        return "malformed"
+    if not isinstance(data, dict):
+        return "malformed"
+    for key in ("instruction", "output"):
+        value = data.get(key)
+        if not isinstance(value, str) or not value.strip():
+            return "malformed"
+    return None
+
+
+def check_description(text: str, source: str = "") -> Optional[str]:
+    """校验图片描述：非空、不过短、开头不是拒绝或没有把握的用语"""
+    description = (text or "").strip()
+    if not description:
+        return "empty"
+    if len(description) < DESCRIPTION_MIN_CHARS:
+        return "too_short"
+    head = description[:_REFUSAL_WINDOW].lower()
+    if any(marker in head for marker in REFUSAL_MARKERS):
+        return "low_confidence"
+    return None
+
+
+VALIDATORS: Dict[str, Callable[[str, str], Optional[str]]] = {
+    "analyzer": check_split,
+    "title": check_title,
+    "format": check_format,
+    "image": check_description,
+}
+
+
+def validate(stage: str, text: str, source: str = "") -> Optional[str]:
+    """按阶段校验模型回复
+
+    Args:
+        stage: 处理阶段，见 config.api_config.CASCADE_STAGES
+        text: 模型回复
+        source: 本次请求的原文，用于校验分块
+
+    Returns:
+        Optional[str]: 不通过的原因，通过或阶段没有校验规则时为 None
+    """
+    check = VALIDATORS.get(stage)
+    return check(text, source) if check else None
+
+
+def record_cascade(stage: str, model: str, reason: Optional[str], final: bool) -> str:
+    """记录级联中一次调用的结果
+
+    Args:
+        stage: 处理阶段
+        model: 本次调用的模型
+        reason: 未通过校验的原因，通过时为 None
+        final: 是否已是级联中的最后一个模型
+
+    Returns:
+        str: accepted（通过）、escalated（升级到下一个模型）或 rejected（最后一个模型仍未通过，照常使用）
+    """
+    if reason is None:
+        outcome = "accepted"
+    elif final:
+        outcome = "rejected"
+        logger.debug(f"{stage} 阶段模型 {model} 的调用未通过（{reason}），已无可升级的模型")
+    else:
+        outcome = "escalated"
+        logger.info(f"{stage} 阶段模型 {model} 的调用未通过（{reason}），升级到下一个模型")
+    CASCADE_CALLS.inc(stage=stage, model=model, outcome=outcome)
+    return outcome
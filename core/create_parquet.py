@@ -1,31 +1,322 @@
 # core/create_parquet.py
 from pathlib import Path
+import io
 import os
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 from PIL import Image
-from datasets import Dataset
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
-from typing import Optional, Dict, List
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Optional, Dict, List, Iterable, Iterator, Union
 import time
+import logging
 
 from core.image_processor import ImageProcessor
-from core.file_handler import FileSystemHandler
+from core.file_handler import FileSystemHandler, directory_lock
+from core.dataset_reader import LazyImageDataset
+from core.dataset_verifier import VerifyReport, file_sha256, record_checksum, verify_dataset, write_arrow_manifest
+from core.webdataset_export import TarShardWriter
+from core.telemetry import child_thread_name, traced
+
+if TYPE_CHECKING:
+    from datasets import Dataset
+
+logger = logging.getLogger(__name__)
+
+# 与 datasets 的 Image 特征兼容的列结构
+IMAGE_SCHEMA = pa.schema(
+    [
+        ('image', pa.struct([('bytes', pa.binary()), ('path', pa.string())])),
+        ('text', pa.string()),
+        ('image_crc32', pa.uint32()),
+    ],
+    metadata={
+        'huggingface': json.dumps({
+            'info': {
+                'features': {
+                    'image': {'_type': 'Image'},
+                    'text': {'dtype': 'string', '_type': 'Value'},
+                    'image_crc32': {'dtype': 'uint32', '_type': 'Value'},
+                }
+            }
+        })
+    }
+)
+
+MANIFEST_FILE = "manifest.json"
+
+
+class ParquetShardWriter:
+    """流式分片 Parquet 写入器
+
+    从生成器逐条读取记录，按行数或字节数切分分片，分片在线程池中并行压缩写出。
+    同时在内存中的分片不超过 max_workers + 1 个，导出 10 万张图片时内存占用有界。
+
+    每次写入的分片文件名带清单版本号，不会覆盖任何已有文件：新分片写完后替换清单，
+    再删除新清单不再引用的文件，读者在任何时刻看到的清单都与其引用的分片一致。
+    读清单到提交清单的整个过程持有目录锁，并发写入同一目录时依次进行。
+    """
+
+    def __init__(self, output_dir: str, rows_per_shard: int = 2000, row_group_size: int = 500,
+                 max_shard_bytes: int = 128 * 1024 * 1024, compression: str = "zstd",
+                 compression_level: Optional[int] = None, max_workers: int = 4):
+        """初始化写入器
+
+        Args:
+            output_dir: 输出目录
+            rows_per_shard: 每个分片的最大行数
+            row_group_size: 每个 row group 的行数
+            max_shard_bytes: 每个分片缓冲的最大图片字节数
+            compression: 压缩算法
+            compression_level: 压缩等级，为空时使用默认值
+            max_workers: 并行写出分片的线程数
+        """
+        self.output_dir = Path(output_dir).absolute()
+        self.rows_per_shard = max(1, rows_per_shard)
+        self.row_group_size = max(1, row_group_size)
+        self.max_shard_bytes = max_shard_bytes
+        self.compression = compression
+        self.compression_level = compression_level
+        self.max_workers = max(1, max_workers)
+
+    def _write_shard(self, version: int, shard_index: int, rows: Dict[str, list]) -> Dict:
+        filename = f"data-v{version:05d}-{shard_index:05d}.parquet"
+        tmp_path = self.output_dir / f".{filename}.tmp"
+        # 每条记录的图片字节校验和，与数据一起写入
+        rows['image_crc32'] = [record_checksum(cell['bytes']) for cell in rows['image']]
+        table = pa.Table.from_pydict(rows, schema=IMAGE_SCHEMA)
+        pq.write_table(
+            table,
+            tmp_path,
+            row_group_size=self.row_group_size,
+            compression=self.compression,
+            compression_level=self.compression_level
+        )
+        os.replace(tmp_path, self.output_dir / filename)
+        return {
+            'file': filename,
+            'num_rows': table.num_rows,
+            'bytes': (self.output_dir / filename).stat().st_size,
+            'sha256': file_sha256(self.output_dir / filename)
+        }
+
+    def load_manifest(self) -> Optional[Dict]:
+        """读取输出目录中已有的清单，不存在时返回 None"""
+        manifest_file = self.output_dir / MANIFEST_FILE
+        if not manifest_file.exists():
+            return None
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _commit_manifest(self, manifest: Dict) -> None:
+        # 先写临时文件再替换，读者只会看到完整的旧清单或新清单
+        tmp_file = self.output_dir / f".{MANIFEST_FILE}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.output_dir / MANIFEST_FILE)
+
+    def write(self, records: Union[Iterable[Dict], Callable[[int], Iterable[Dict]]], append: bool = False) -> Dict:
+        """写出所有记录
+
+        Args:
+            records: 记录生成器，每条包含 image_bytes、image_path 和 text；
+                也可以是接收已有行数、返回记录的函数，在加锁后调用，追加时编号不会与并发写入重复
+            append: 为 True 时在已有分片旁写入新分片并更新清单，已有分片不会被改写
+
+        Returns:
+            Dict: 写入的清单，包含各分片文件名、行数和字节数
+        """
+        with directory_lock(str(self.output_dir)):
+            return self._write_locked(records, append)
+
+    def _write_locked(self, records, append: bool) -> Dict:
+        start = time.time()
+        previous = self.load_manifest()
+        existing = previous.get('shards', []) if (append and previous) else []
+        version = (previous.get('version', 0) + 1) if previous else 1
+        if callable(records):
+            records = records(sum(s['num_rows'] for s in existing))
+        # 新分片编号接在已有分片之后，文件名带新版本号，不会与已有文件重名
+        first_index = len(existing)
+        slots = threading.Semaphore(self.max_workers)
+        futures: List[Future] = []
+
+        def submit(executor, shard_index, rows):
+            slots.acquire()
+            future = executor.submit(self._write_shard, version, shard_index, rows)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix=child_thread_name("parquet-shard")) as executor:
+            rows = {'image': [], 'text': []}
+            buffered = 0
+            for record in records:
+                image_bytes = record['image_bytes']
+                rows['image'].append({'bytes': image_bytes, 'path': record.get('image_path')})
+                rows['text'].append(record['text'])
+                buffered += len(image_bytes)
+                if len(rows['text']) >= self.rows_per_shard or buffered >= self.max_shard_bytes:
+                    submit(executor, first_index + len(futures), rows)
+                    rows = {'image': [], 'text': []}
+                    buffered = 0
+            if rows['text']:
+                submit(executor, first_index + len(futures), rows)
+            shards = [f.result() for f in futures]
+
+        manifest = {
+            'format': 'parquet',
+            'compression': self.compression,
+            'row_group_size': self.row_group_size,
+            'version': version,
+            'updated_at': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'num_rows': sum(s['num_rows'] for s in existing + shards),
+            'shards': existing + shards
+        }
+        self._commit_manifest(manifest)
+        
+        # 清单替换后再删除不再引用的分片，包括覆盖写入前的旧分片和此前中断的写入留下的分片
+        current = {s['file'] for s in manifest['shards']}
+        for path in self.output_dir.glob("data-*.parquet"):
+            if path.name not in current:
+                path.unlink(missing_ok=True)
+        logger.info(f"写出 {sum(s['num_rows'] for s in shards)} 条记录到 {len(shards)} 个新分片，"
+                    f"数据集共 {manifest['num_rows']} 条，耗时 {time.time() - start:.2f}s")
+        return manifest
 
 class DatasetProcessor:
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def features():
+        """hf 数据集的列类型
+
+        datasets 导入较慢，只有导出 hf 格式时才需要，因此在首次调用时导入。
+        image_crc32 与 Parquet 分片中的同名列一致，供校验时逐条核对图片字节。
+        """
+        from datasets import Features, Value
+        from datasets import Image as ImageFeature
+        return Features({'image': ImageFeature(), 'text': Value('string'), 'image_crc32': Value('uint32')})
+
+    @staticmethod
+    def save_to_disk(dataset: 'Dataset', output_path: Union[str, Path]) -> Dict:
+        """保存 hf 数据集并写出 Arrow 分片清单
+
+        Args:
+            dataset: 要保存的数据集
+            output_path: save_to_disk 输出目录
+
+        Returns:
+            Dict: 分片清单
+        """
+        dataset.save_to_disk(str(output_path))
+        return write_arrow_manifest(output_path)
+
     def __init__(self, fs_handler: Optional[FileSystemHandler] = None):
         self.fs_handler = fs_handler or FileSystemHandler()
 
-    def create_from_pairs(self, image_text_pairs: List[Dict], output_dir: str = "image_dataset") -> Dataset:  # 修改这里的默认值
+    @staticmethod
+    def encoded_image(pair: Dict) -> tuple:
+        """取出条目已有的编码字节和扩展名
+
+        上传时保留的字节原样返回；只有旧数据没有字节时才编码一次 PNG。
+
+        Returns:
+            tuple: (图片字节, 扩展名)
+        """
+        if pair.get('image_bytes'):
+            return pair['image_bytes'], pair.get('image_format', 'png')
+        buffer = io.BytesIO()
+        pair['image'].save(buffer, format='PNG')
+        return buffer.getvalue(), 'png'
+
+    @staticmethod
+    def image_cell(pair: Dict, i: int) -> Dict:
+        """构造 datasets Image 列的取值，字节原样写入"""
+        data, ext = DatasetProcessor.encoded_image(pair)
+        return {'bytes': data, 'path': f"image_{i:05d}.{ext}"}
+
+    @staticmethod
+    def iter_records(image_text_pairs: Iterable[Dict], start: int = 0) -> Iterator[Dict]:
+        """逐条生成写入 Parquet 的记录，图片字节不解码、不重新编码"""
+        for i, pair in enumerate(image_text_pairs, start):
+            cell = DatasetProcessor.image_cell(pair, i)
+            yield {
+                'image_bytes': cell['bytes'],
+                'image_path': cell['path'],
+                'text': pair['text']
+            }
+
+    @traced("export.parquet")
+    def export_parquet(self, image_text_pairs: Iterable[Dict], output_dir: str = "image_dataset_parquet",
+                       append: bool = False, **writer_options) -> Dict:
+        """把图片文本对流式导出为分片 Parquet
+
+        Args:
+            image_text_pairs: 图片文本对，可以是生成器
+            output_dir: 输出目录
+            append: 是否追加到已有数据集
+            **writer_options: 传给 ParquetShardWriter 的参数
+
+        Returns:
+            Dict: 写入的清单
+        """
+        writer = ParquetShardWriter(output_dir, **writer_options)
+        return writer.write(lambda start: self.iter_records(image_text_pairs, start), append=append)
+
+    @traced("export.webdataset")
+    def export_webdataset(self, image_text_pairs: Iterable[Dict], output_dir: str = "image_dataset_wds",
+                          **writer_options) -> Dict:
+        """把图片文本对导出为 WebDataset tar 分片
+
+        Args:
+            image_text_pairs: 图片文本对，可以是生成器
+            output_dir: 输出目录
+            **writer_options: 传给 TarShardWriter 的参数
+
+        Returns:
+            Dict: 分片索引
+        """
+        return TarShardWriter(output_dir, **writer_options).write(self.iter_records(image_text_pairs))
+
+    @traced("export.hf")
+    def create_from_pairs(self, image_text_pairs: List[Dict], output_dir: str = "image_dataset",
+                          preserve_bytes: bool = True) -> 'Dataset':  # 修改这里的默认值
+        """导出图片文件、metadata.json 和 HF 数据集
+
+        Args:
+            image_text_pairs: 图片文本对
+            output_dir: 输出目录
+            preserve_bytes: 为 True 时原样写出已编码的图片字节，不解码也不重新编码；
+                为 False 时沿用旧行为，把 PIL 图片重新保存为 PNG
+
+        Returns:
+            Dataset: 导出的数据集
+        """
         try:
             timestamp = time.strftime("%Y%m%d_%H%M%S")
             output_path = Path(output_dir) / f"dataset_{timestamp}"
             output_path.mkdir(parents=True, exist_ok=True)
             
             metadata = []
+            cells = []
             for i, pair in enumerate(image_text_pairs):
-                img_filename = f"image_{i:03d}.png"
-                img_path = output_path / img_filename
-                pair['image'].save(img_path)
+                if preserve_bytes:
+                    data, ext = self.encoded_image(pair)
+                    img_filename = f"image_{i:03d}.{ext}"
+                    with open(output_path / img_filename, 'wb') as f:
+                        f.write(data)
+                    cells.append({'bytes': data, 'path': img_filename})
+                else:
+                    img_filename = f"image_{i:03d}.png"
+                    pair['image'].save(output_path / img_filename)
+                    # 读回刚保存的 PNG，使 image 列与 image_crc32 对应同一份字节
+                    with open(output_path / img_filename, 'rb') as f:
+                        cells.append({'bytes': f.read(), 'path': img_filename})
                 
                 metadata.append({
                     'image_file': img_filename,
@@ -36,35 +327,41 @@ class DatasetProcessor:
             with open(metadata_file, 'w', encoding='utf-8') as f:
                 json.dump(metadata, f, ensure_ascii=False, indent=2)
             
+            from datasets import Dataset
             dataset = Dataset.from_dict({
-                'image': [pair['image'] for pair in image_text_pairs],
-                'text': [pair['text'] for pair in image_text_pairs]
-            })
+                'image': cells,
+                'text': [pair['text'] for pair in image_text_pairs],
+                'image_crc32': [record_checksum(cell['bytes']) for cell in cells]
+            }, features=self.features())
             
-            dataset.save_to_disk(output_path / "hf_dataset")
+            self.save_to_disk(dataset, output_path / "hf_dataset")
             return dataset
             
         except Exception as e:
             raise
 
     @staticmethod
-    def load_dataset(dataset_path: str) -> Dict:
+    def load_dataset(dataset_path: str, columns: Optional[List[str]] = None) -> Dict:
+        """懒加载数据集
+
+        只内存映射 Arrow/Parquet 数据并读取元信息，图片在访问样本时才解码。
+
+        Args:
+            dataset_path: 数据集目录
+            columns: 需要读取的列，例如只读文本时传入 ['text']
+
+        Returns:
+            Dict: samples 为支持随机访问和切片的 LazyImageDataset
+        """
         try:
             path = Path(dataset_path)
-            with open(path / "metadata.json", 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-                
-            dataset = []
-            for item in metadata:
-                img_path = path / item['image_file']
-                img = Image.open(img_path)
-                dataset.append({
-                    'image': img,
-                    'text': item['text']
-                })
+            metadata = None
+            if (path / "metadata.json").exists():
+                with open(path / "metadata.json", 'r', encoding='utf-8') as f:
+                    metadata = json.load(f)
                 
             return {
-                'samples': dataset,
+                'samples': LazyImageDataset(path, columns=columns),
                 'metadata': metadata,
                 'path': str(path)
             }
@@ -73,14 +370,28 @@ class DatasetProcessor:
             raise
 
     @staticmethod
-    def verify_dataset(dataset_path: str) -> None:
+    def verify_dataset(dataset_path: str, deep: bool = False, workers: Optional[int] = None) -> VerifyReport:
+        """校验数据集的清单、分片校验和与图片完整性
+
+        Args:
+            dataset_path: 数据集目录
+            deep: 是否完整解码每张图片
+            workers: 并行校验的进程数
+
+        Returns:
+            VerifyReport: 校验结果
+        """
         try:
             dataset = DatasetProcessor.load_dataset(dataset_path)
-            if dataset['samples']:
+            if len(dataset['samples']):
                 sample = dataset['samples'][0]
-                print(f"数据集路径: {dataset['path']}")
-                print(f"样本数量: {len(dataset['samples'])}")
-                print(f"图片尺寸: {sample['image'].size}")
+                logger.info(f"数据集路径: {dataset['path']}")
+                logger.info(f"样本数量: {len(dataset['samples'])}")
+                logger.info(f"图片尺寸: {sample['image'].size}")
+                
+            report = verify_dataset(dataset_path, deep=deep, workers=workers)
+            logger.info(report.summary())
+            return report
                 
         except Exception as e:
             raise
\ No newline at end of file
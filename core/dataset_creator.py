@@ -1,93 +1,182 @@
 # core/dataset_creator.py
 from pathlib import Path
-from typing import List, Tuple, Dict, Optional, Union
+from typing import Callable, List, Tuple, Dict, Optional, Union, Iterable, Iterator
 from PIL import Image
-from datasets import Dataset
+import os
 import time
 import json
+import hashlib
+import logging
 
 from core.text_processor import TextProcessor
 from core.image_processor import ImageProcessor
 from core.file_handler import FileSystemHandler
-from core.api_handler import APIHandler
-from config.api_config import APIConfig
+from core.api_handler import APIHandler, DescriptionResult, speed_summary
+from core.retry_queue import DeadLetterQueue, ItemStatus
+from core.image_pipeline import ImagePipeline, RecordWriter
+from core.ingest_manifest import IngestManifest, config_fingerprint
+from core.job_runner import report_progress
+from core.spill_store import ImageSpiller, MemoryBudget, image_size, write_json_array
+from core.telemetry import span
+from config.api_config import APIConfig, parse_stage_models
+
+logger = logging.getLogger(__name__)
 
 class DatasetCreator:
-    def __init__(self):
-        self.fs_handler = FileSystemHandler()
+    # 流式生成时表格刷新的最小间隔（秒）
+    STREAM_REFRESH = 0.3
+    # 各图片导出格式在输出根目录下的目录名
+    IMAGE_EXPORT_DIRS = {'hf': "image_dataset", 'parquet': "image_dataset_parquet", 'webdataset': "image_dataset_wds"}
+
+    def __init__(self, temp_dir: str = "temp_dataset", memory_limit_mb: Optional[float] = None,
+                 output_root: str = "."):
+        """初始化数据集创建器
+
+        Args:
+            temp_dir: 临时目录，保存预处理后的图片和超出内存上限的结果
+            memory_limit_mb: 结果数据的内存上限（MB），超出后文本记录写入磁盘、
+                图片只保留临时文件，导出时再流式读回；为空时不限制
+            output_root: 数据集的导出根目录，图片各格式写到其下的 IMAGE_EXPORT_DIRS 目录中，
+                文本数据集默认写到其下的 text_dataset
+        """
+        self.fs_handler = FileSystemHandler(temp_dir)
+        self.output_root = output_root
         self.image_text_pairs = []
         self.api_handler: Optional[APIHandler] = None
         self.example_count = 2
         self.text_processor = None
         self.text_results = []
+        self.dead_letters = DeadLetterQueue()
+        self.detail_policy = "auto"
+        # 图片描述的流式接收和输出控制，重新配置 API 时沿用
+        self.generation = {'stream': False, 'max_tokens': None, 'stop': []}
+        self.memory_budget = MemoryBudget(memory_limit_mb)
+        self.image_spiller = ImageSpiller(self.memory_budget)
 
-    def save_text_dataset(self, output_dir: str = "text_dataset") -> str:
-        try:
-            if not self.text_processor or not self.text_processor.text_results:
-                print("没有可保存的数据")
-                return "没有可保存的数据"
-                
-            # 确保输出目录存在
-            output_dir = os.path.abspath(output_dir)
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # 生成带时间戳的文件名
-            timestamp = time.strftime("%Y%m%d_%H%M%S")
-            output_file = f"dataset_{timestamp}.json"
-            output_path = os.path.join(output_dir, output_file)
-            
-            print(f"保存数据集到: {output_path}")
-            print(f"数据条数: {len(self.text_processor.text_results)}")
-            
-            # 保存文件
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(self.text_processor.text_results, f, ensure_ascii=False, indent=2)
-            print("文件保存成功")
-            
-            return f"已保存 {len(self.text_processor.text_results)} 条数据到 {output_path}"
-                
-        except Exception as e:
-            print(f"保存数据集过程出错: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
-            return f"保存失败: {str(e)}"
+    @property
+    def spill_dir(self) -> str:
+        return str(Path(self.fs_handler.temp_dir) / "spill")
+
+    def image_dataset_dir(self, export_format: str = "hf") -> str:
+        """图片数据集某种导出格式的目录"""
+        name = self.IMAGE_EXPORT_DIRS.get(export_format, self.IMAGE_EXPORT_DIRS['hf'])
+        return os.path.abspath(os.path.join(self.output_root, name))
+
+    def text_dataset_dir(self) -> str:
+        """文本数据集的默认输出目录"""
+        return os.path.abspath(os.path.join(self.output_root, "text_dataset"))
+
+    def new_text_processor(self, api_handler: Optional[APIHandler] = None) -> TextProcessor:
+        """创建共用本创建器内存上限和落盘目录的文本处理器"""
+        return TextProcessor(api_handler, self.spill_dir, self.memory_budget)
 
-    def set_api_config(self, base_url: str, api_key: str, model: str) -> str:
+    def track_pair(self, pair: Dict) -> Dict:
+        """登记图片文本对，超出内存上限时最早的图片只保留临时文件"""
+        return self.image_spiller.track(pair)
+
+    def set_api_config(self, base_url: str, api_key: str, model: str, stage_models: str = "") -> str:
         try:
-            print("开始配置API...")  # 添加调试信息
+            logger.debug("开始配置API...")
+            try:
+                cascade = parse_stage_models(stage_models)
+            except ValueError as e:
+                return f"{e} ❌"
             config = APIConfig(
                 base_url=base_url.strip(),
                 api_key=api_key.strip(),
-                model=model.strip()
+                model=model.strip(),
+                stage_models=cascade,
+                **self.generation
             )
             
             is_valid, error_msg = config.validate()
             if not is_valid:
-                print(f"API配置验证失败: {error_msg}")  # 添加调试信息
+                logger.error(f"API配置验证失败: {error_msg}")
                 return error_msg
                     
-            print("创建API处理器...")  # 添加调试信息
+            logger.debug("创建API处理器...")
             # 创建新的API处理器
             self.api_handler = APIHandler(config)
+            self.dead_letters.base_delay = config.retry_delay
             
-            print("更新文本处理器...")  # 添加调试信息
+            logger.debug("更新文本处理器...")
             # 更新或创建文本处理器
             if not self.text_processor:
-                self.text_processor = TextProcessor(self.api_handler)
-                print("创建了新的文本处理器")  # 添加调试信息
+                self.text_processor = self.new_text_processor(self.api_handler)
+                logger.debug("创建了新的文本处理器")
             else:
                 # 更新现有文本处理器的API处理器
                 self.text_processor.api_handler = self.api_handler
-                self.text_processor._initialize_agents()
-                print("更新了现有文本处理器")  # 添加调试信息
+                self.text_processor.reset_agents()
+                logger.debug("更新了现有文本处理器")
                     
             return "API配置已更新 ✅"
         except Exception as e:
-            import traceback
-            print(f"API配置失败: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception(f"API配置失败: {str(e)}")
             return f"API配置失败: {str(e)} ❌"
 
+    def set_generation_options(self, stream: bool = False, max_tokens: Optional[int] = None,
+                               stop: Union[str, List[str], None] = None) -> str:
+        """设置图片描述的流式接收和输出控制
+
+        Args:
+            stream: 是否流式接收，开启后表格中的描述随生成逐步更新
+            max_tokens: 每条描述的最大输出 token 数，为空或不大于 0 时不限制
+            stop: 停止序列，字符串时每行一个，\n 表示换行
+
+        Returns:
+            str: 状态消息
+        """
+        if isinstance(stop, str):
+            stop = [line.replace('\\n', '\n') for line in stop.splitlines() if line]
+        stop = list(stop or [])
+        if len(stop) > 4:
+            return "最多设置 4 个停止序列"
+        max_tokens = int(max_tokens) if max_tokens and max_tokens > 0 else None
+        self.generation = {'stream': bool(stream), 'max_tokens': max_tokens, 'stop': stop}
+        if self.api_handler:
+            for key, value in self.generation.items():
+                setattr(self.api_handler.config, key, value)
+        limits = [f"最多 {max_tokens} tokens"] if max_tokens else []
+        if stop:
+            limits.append(f"{len(stop)} 个停止序列")
+        return f"{'流式' if stream else '非流式'}生成描述{'，' + '，'.join(limits) if limits else ''}"
+
+    def _row_streamer(self, pair: Dict, status: str) -> Optional[Callable[[str], None]]:
+        """流式生成时把当前图片已收到的描述写进表格，通过任务进度推给界面"""
+        if not self.api_handler.config.stream:
+            return None
+        last = 0.0
+
+        def on_delta(text: str) -> None:
+            nonlocal last
+            now = time.monotonic()
+            if now - last < self.STREAM_REFRESH:
+                return
+            last = now
+            rows = [[p['index'], text if p is pair else p['text']] for p in self.image_text_pairs]
+            report_progress({'table': rows, 'status': status})
+
+        return on_delta
+
+    def set_instruction_mode(self, mode: str) -> str:
+        """设置文本指令的生成方式
+
+        Args:
+            mode: llm（标题和格式化 agent）或 local（本地关键词，不调用 API）
+
+        Returns:
+            str: 状态消息
+        """
+        try:
+            if not self.text_processor:
+                # 本地模式不需要先配置 API
+                self.text_processor = self.new_text_processor(self.api_handler)
+            self.text_processor.set_instruction_mode(mode)
+        except ValueError as e:
+            return str(e)
+        return "指令改为在本地按关键词生成，不调用 API" if mode == "local" else "指令由模型生成"
+
     def test_api_connection(self) -> str:
         if not self.api_handler:
             return "请先配置API设置"
@@ -104,72 +193,261 @@ class DatasetCreator:
                     # 使用 os.path 处理文件路径
                     import os
                     file_path = os.path.abspath(file.name)
-                    img = ImageProcessor.load_and_preprocess(file_path)
-                    img = ImageProcessor.resize_image(img)
+                    img, data, ext = ImageProcessor.preprocess_to_bytes(file_path, self.detail_policy)
                     
                     index = len(self.image_text_pairs)
-                    save_path = self.fs_handler.get_temp_path(f"image_{index}.png")
-                    self.fs_handler.save_temp_image(img, save_path)
+                    save_path = self.fs_handler.get_temp_path(f"image_{index}.{ext}")
+                    self.fs_handler.save_temp_bytes(data, save_path)
                     
-                    self.image_text_pairs.append({
+                    self.image_text_pairs.append(self.track_pair({
                         'index': int(index),
                         'image': img,
                         'image_path': save_path,
-                        'text': ""
-                    })
+                        'image_bytes': data,
+                        'image_format': ext,
+                        'text': "",
+                        'status': ItemStatus()
+                    }))
                     
-                    images.append(img)
+                    # 限制内存时画廊使用临时文件路径，不持有解码后的图片
+                    images.append(save_path if self.memory_budget.limited else img)
                     text_data.append([int(index), ""])
                     
                 except Exception as e:
-                    print(f"处理图片失败: {str(e)}")
+                    logger.error(f"处理图片失败: {str(e)}")
                     continue
             
             return images, text_data
             
         except Exception as e:
-            print(f"批量处理图片失败: {str(e)}")
+            logger.error(f"批量处理图片失败: {str(e)}")
             return [], []
 
-    def batch_generate_all(self, prompt_template: str = None) -> Tuple[List[List], str]:
+    def pipeline_process(self, files, prompt_template: str = None, describe_workers: int = 4,
+                         output_dir: Optional[str] = None) -> Iterator[Tuple[Optional[Image.Image], List[List], str]]:
+        """流水线处理上传的图片：解码、编码、生成描述和写出记录重叠进行
+        
+        Args:
+            files: 上传的文件列表
+            prompt_template: 用于生成描述的提示词模板
+            describe_workers: 并发描述请求的线程数
+            output_dir: 增量写出记录的目录，为空时使用 output_root 下的 image_dataset
+            
+        Yields:
+            Tuple[Optional[Image.Image], List[List], str]: 预览图片、[[index, description], ...] 列表和状态消息
+        """
+        if not self.api_handler:
+            yield None, [], "请先配置API设置"
+            return
+        if not files:
+            yield None, [], "请先上传图片"
+            return
+            
+        if prompt_template:
+            self.api_handler.set_system_prompt(prompt_template)
+            
+        import os
+        file_paths = [os.path.abspath(getattr(f, 'name', f)) for f in files]
+        start_index = len(self.image_text_pairs)
+        pipeline = ImagePipeline(self.api_handler, self.fs_handler, describe_workers=describe_workers,
+                                 detail_policy=self.detail_policy)
+        writer = RecordWriter(output_dir or os.path.join(self.output_root, "image_dataset"))
+        logger.info(f"流水线处理 {len(file_paths)} 张图片，记录写入: {writer.output_path}")
+        
+        done = 0
+        preview = None
+        for item in pipeline.run(file_paths, start_index, writer):
+            done += 1
+            if 'error' in item:
+                logger.error(item['error'])
+                continue
+            pair = {
+                'index': item['index'],
+                'image': item['image'],
+                'image_path': item['image_path'],
+                'image_bytes': item['image_bytes'],
+                'image_format': item['image_format'],
+                'text': "",
+                'status': ItemStatus()
+            }
+            self._apply_result(pair, item['result'])
+            self.image_text_pairs.append(self.track_pair(pair))
+            # 保持按编号排序，与表格行号对应
+            self.image_text_pairs.sort(key=lambda p: p['index'])
+            if preview is None:
+                preview = item['image_path'] if self.memory_budget.limited else item['image']
+            text_data = [[p['index'], p['text']] for p in self.image_text_pairs]
+            yield preview, text_data, f"已完成 {done}/{len(file_paths)} 张图片"
+            
+        text_data = [[p['index'], p['text']] for p in self.image_text_pairs]
+        message = f"流水线完成 {writer.count}/{len(file_paths)} 张，记录已写入 {writer.output_path}"
+        if len(self.dead_letters):
+            message += f"，{len(self.dead_letters)} 张描述失败，可点击“仅重试失败项”"
+        yield preview, text_data, message
+
+    def set_detail_policy(self, policy: str) -> str:
+        """设置视觉细节策略
+        
+        Args:
+            policy: auto/low/high
+            
+        Returns:
+            str: 状态消息，包含当前图片的预计 token 成本
+        """
+        if policy not in ImageProcessor.DETAIL_POLICIES:
+            return f"无效的细节策略: {policy}"
+        self.detail_policy = policy
+        return self.estimate_image_cost()
+
+    def _detail(self, pair: Dict) -> str:
+        return ImageProcessor.choose_detail(image_size(pair), self.detail_policy)
+
+    def estimate_image_cost(self) -> str:
+        """在生成描述前估算每张图片的输入 token 成本
+        
+        Returns:
+            str: 包含 low/high 张数、总 token 和每张平均 token 的报告
+        """
+        if not self.image_text_pairs:
+            return "请先上传图片"
+        counts = {"low": 0, "high": 0}
+        total = 0
+        for pair in self.image_text_pairs:
+            detail = self._detail(pair)
+            size = ImageProcessor.payload_size(image_size(pair), detail)
+            pair['estimated_tokens'] = ImageProcessor.estimate_image_tokens(size, detail)
+            counts[detail] += 1
+            total += pair['estimated_tokens']
+        count = len(self.image_text_pairs)
+        report = (f"细节策略 {self.detail_policy}: {count} 张图片（low {counts['low']} 张，high {counts['high']} 张），"
+                  f"预计图片输入 {total} tokens，平均每张 {total // count} tokens")
+        logger.info(report)
+        return report
+
+    def _generate_multi_image(self, pairs: List[Dict]) -> None:
+        """按上下文预算分组，每组图片合并为一次请求生成描述"""
+        details = [self._detail(p) for p in pairs]
+        sizes = [ImageProcessor.payload_size(image_size(p), d) for p, d in zip(pairs, details)]
+        batches = self.api_handler.plan_batches(sizes, details)
+        logger.info(f"{len(pairs)} 张图片合并为 {len(batches)} 次请求")
+        for batch in batches:
+            group = [pairs[i] for i in batch]
+            try:
+                payloads = [ImageProcessor.encode_for_vision(p['image_bytes'], details[i])[0]
+                            for p, i in zip(group, batch)]
+                results = self.api_handler.describe_batch(payloads, details=[details[i] for i in batch])
+            except Exception as e:
+                logger.error(f"处理图片 {[p['index'] for p in group]} 失败: {str(e)}")
+                results = [DescriptionResult(error_class=type(e).__name__, error=str(e)) for _ in group]
+            for pair, result in zip(group, results):
+                self._apply_result(pair, result)
+
+    def _apply_result(self, pair: Dict, result: DescriptionResult) -> None:
+        """把一次描述结果写回图片条目，失败的条目进入死信队列"""
+        pair.setdefault('status', ItemStatus()).record(result)
+        if result.ok:
+            pair['text'] = result.text
+            self.dead_letters.remove(pair['index'])
+        else:
+            pair['text'] = ""
+            self.dead_letters.add(pair['index'])
+            logger.warning(f"图片 {pair['index']} 描述失败 [{result.error_class}]: {result.error}")
+
+    def failure_report(self) -> List[Dict]:
+        """列出所有描述失败的条目及其状态"""
+        return [
+            {'index': p['index'], **p['status'].to_dict()}
+            for p in self.image_text_pairs
+            if p.get('status') and p['status'].failed
+        ]
+
+    def retry_failed(self, prompt_template: str = None) -> Tuple[List[List], str]:
+        """只重试死信队列中的失败条目，按指数退避等待
+        
+        Args:
+            prompt_template: 用于生成描述的提示词模板
+            
+        Returns:
+            Tuple[List[List], str]: 包含 [[index, description], ...] 的列表和状态消息
+        """
+        if not self.api_handler:
+            return [], "请先配置API设置"
+        if not len(self.dead_letters):
+            return [[p['index'], p['text']] for p in self.image_text_pairs], "没有失败的条目"
+            
+        if prompt_template:
+            self.api_handler.set_system_prompt(prompt_template)
+            
+        pairs = {p['index']: p for p in self.image_text_pairs}
+        
+        def retry_one(index: int) -> bool:
+            pair = pairs.get(index)
+            if pair is None:
+                self.dead_letters.remove(index)
+                return True
+            result = self.api_handler.describe_image(pair['image_path'], self._detail(pair),
+                                                     self._row_streamer(pair, f"正在重试图片 {index}"))
+            pair['status'].record(result)
+            if result.ok:
+                pair['text'] = result.text
+            return result.ok
+            
+        # 手动点击重试时，已用完自动重试次数的条目也重新处理
+        self.dead_letters.revive()
+        logger.info(f"重试 {len(self.dead_letters)} 个失败条目...")
+        stats = self.dead_letters.drain(retry_one)
+        text_data = [[p['index'], p['text']] for p in self.image_text_pairs]
+        message = f"重试 {stats['calls']} 次调用，成功 {stats['succeeded']} 张，仍失败 {stats['failed']} 张"
+        logger.info(message)
+        return text_data, message
+
+    def batch_generate_all(self, prompt_template: str = None, multi_image: bool = False) -> Tuple[List[List], str]:
         """批量为所有图片生成描述
         
         Args:
             prompt_template: 用于生成描述的提示词模板
+            multi_image: 是否把多张图片合并到一次请求中
             
         Returns:
             Tuple[List[List], str]: 包含 [[index, description], ...] 的列表和状态消息
         """
         try:
             if not self.api_handler:
-                print("错误: API处理器未初始化")
                 return [], "请先配置API设置"
                 
             if not self.image_text_pairs:
-                print("错误: 未找到图片数据")
                 return [], "请先上传图片"
 
             text_data = []
-            print(f"开始处理 {len(self.image_text_pairs)} 张图片...")
+            results = []
+            logger.info(f"开始处理 {len(self.image_text_pairs)} 张图片")
+            self.estimate_image_cost()
             
-            for pair in self.image_text_pairs:
-                try:
-                    index = pair['index']
-                    print(f"处理图片 {index}: {pair['image_path']}")
+            if multi_image:
+                if prompt_template:
+                    self.api_handler.set_system_prompt(prompt_template)
+                self._generate_multi_image(self.image_text_pairs)
+                text_data = [[p['index'], p['text']] for p in self.image_text_pairs]
+            else:
+                total = len(self.image_text_pairs)
+                for n, pair in enumerate(self.image_text_pairs, 1):
+                    try:
+                        index = pair['index']
                     
-                    # 如果提供了新的提示词，更新系统提示词
-                    if prompt_template:
-                        self.api_handler.set_system_prompt(prompt_template)
+                        # 如果提供了新的提示词，更新系统提示词
+                        if prompt_template:
+                            self.api_handler.set_system_prompt(prompt_template)
                     
-                    # 生成描述
-                    description = self.api_handler.generate_description(pair['image_path'])
-                    pair['text'] = description
-                    text_data.append([index, description])
-                    print(f"完成图片 {index} 的描述生成")
+                        # 生成描述
+                        on_delta = self._row_streamer(pair, f"正在生成第 {n}/{total} 张图片的描述")
+                        result = self.api_handler.describe_image(pair['image_path'], self._detail(pair), on_delta)
+                        results.append(result)
+                        self._apply_result(pair, result)
+                        text_data.append([index, pair['text']])
                     
-                except Exception as e:
-                    print(f"处理图片 {pair['index']} 失败: {str(e)}")
-                    text_data.append([pair['index'], ""])
+                    except Exception as e:
+                        logger.error(f"处理图片 {pair['index']} 失败: {str(e)}")
+                        text_data.append([pair['index'], ""])
             
             # 确保返回的数据列表长度为10
             while len(text_data) < 10:
@@ -177,16 +455,29 @@ class DatasetCreator:
                 
             success_count = sum(1 for item in text_data if item[1].strip())
             message = f"已完成 {success_count}/{len(text_data)} 张图片的描述生成"
-            print(message)
+            speed = speed_summary(results)
+            if speed:
+                message += f"（{speed}）"
+            if len(self.dead_letters):
+                message += f"，{len(self.dead_letters)} 张失败，可点击“仅重试失败项”"
+            logger.info(message)
             
             return text_data, message
             
         except Exception as e:
-            print(f"批量生成描述失败: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
+            logger.exception(f"批量生成描述失败: {str(e)}")
             return [], f"生成失败: {str(e)}"
-    def create_dataset(self) -> str:
+    def create_dataset(self, export_format: str = "hf", append: bool = False) -> str:
+        """保存图片数据集
+        
+        Args:
+            export_format: hf 为 datasets 的 save_to_disk 目录，parquet 为流式分片 Parquet，
+                webdataset 为可顺序读取的 tar 分片
+            append: 追加到已有的 Parquet 数据集，只写新分片并更新清单
+            
+        Returns:
+            str: 状态消息
+        """
         try:
             if not self.image_text_pairs:
                 return "没有数据可保存"
@@ -195,30 +486,87 @@ class DatasetCreator:
             if empty_texts:
                 return f"以下编号的图片缺少描述: {', '.join(empty_texts)}"
             
-            dataset_dict = {
-                'image': [pair['image'] for pair in self.image_text_pairs],
-                'text': [pair['text'] for pair in self.image_text_pairs]
-            }
+            if append and export_format != "parquet":
+                return "追加模式仅支持 Parquet 格式 ❌"
+            
+            # 导出模块依赖 pyarrow / datasets，保存时才导入，加快启动
+            from core.create_parquet import DatasetProcessor
+            
+            if export_format == "parquet":
+                manifest = DatasetProcessor(self.fs_handler).export_parquet(
+                    self.image_text_pairs, self.image_dataset_dir("parquet"), append=append
+                )
+                logger.info(f"数据集样本数: {manifest['num_rows']}，分片数: {len(manifest['shards'])}")
+                action = f"已追加 {len(self.image_text_pairs)} 条" if append else "保存成功"
+                return (f"Parquet 数据集{action}，共 {manifest['num_rows']} 条，{len(manifest['shards'])} 个分片，"
+                        f"位于 {self.image_dataset_dir('parquet')} ✅")
+            
+            if export_format == "webdataset":
+                index = DatasetProcessor(self.fs_handler).export_webdataset(
+                    self.image_text_pairs, self.image_dataset_dir("webdataset")
+                )
+                logger.info(f"数据集样本数: {index['num_samples']}，分片数: {len(index['shards'])}")
+                return (f"WebDataset 保存成功，共 {index['num_samples']} 条，{len(index['shards'])} 个 tar 分片，"
+                        f"位于 {self.image_dataset_dir('webdataset')} ✅")
             
-            dataset = Dataset.from_dict(dataset_dict)
+            from datasets import Dataset
+            from core.dataset_verifier import record_checksum
             # 使用 os.path 处理路径
             import os
-            output_path = os.path.abspath("image_dataset")
+            output_path = self.image_dataset_dir("hf")
             os.makedirs(output_path, exist_ok=True)
-            dataset.save_to_disk(output_path)
+            
+            if self.memory_budget.limited:
+                # 先流式写成 Parquet 分片，再由 datasets 转成内存映射的 Arrow，不在内存中构造整列
+                import shutil
+                staging = Path(self.spill_dir) / f"hf_staging_{time.strftime('%Y%m%d_%H%M%S')}"
+                try:
+                    manifest = DatasetProcessor(self.fs_handler).export_parquet(self.image_text_pairs, str(staging))
+                    dataset = Dataset.from_parquet(
+                        [str(staging / shard['file']) for shard in manifest['shards']],
+                        features=DatasetProcessor.features(), columns=['image', 'text', 'image_crc32'],
+                        cache_dir=str(staging / "cache")
+                    )
+                    DatasetProcessor.save_to_disk(dataset, output_path)
+                finally:
+                    shutil.rmtree(staging, ignore_errors=True)
+            else:
+                # 已编码的字节原样写入 image 列，不再重新编码
+                cells = [DatasetProcessor.image_cell(pair, i) for i, pair in enumerate(self.image_text_pairs)]
+                dataset_dict = {
+                    'image': cells,
+                    'text': [pair['text'] for pair in self.image_text_pairs],
+                    'image_crc32': [record_checksum(cell['bytes']) for cell in cells]
+                }
+                dataset = Dataset.from_dict(dataset_dict, features=DatasetProcessor.features())
+                DatasetProcessor.save_to_disk(dataset, output_path)
             
             self.verify_dataset()
             
-            return "数据集保存成功 ✅"
+            return f"数据集保存成功，位于 {output_path} ✅"
             
         except Exception as e:
             return f"保存数据集失败: {str(e)} ❌"
 
-    def verify_dataset(self) -> str:
+    def verify_dataset(self, export_format: str = "hf", deep: bool = False) -> str:
+        """校验已保存的数据集
+        
+        Args:
+            export_format: hf 校验 image_dataset，parquet 校验 image_dataset_parquet，webdataset 校验 image_dataset_wds，
+                均位于 output_root 下
+            deep: 是否完整解码每张图片
+            
+        Returns:
+            str: 校验报告
+        """
         try:
-            dataset = Dataset.load_from_disk("image_dataset")
-            print(f"数据集样本数: {len(dataset)}")
-            return "数据集验证完成 ✅"
+            path = self.image_dataset_dir(export_format)
+            from core.dataset_verifier import verify_dataset
+            report = verify_dataset(path, deep=deep)
+            logger.info(report.summary())
+            if not report.ok:
+                return f"{report.summary()} ❌"
+            return f"{report.summary()} ✅"
             
         except Exception as e:
             return f"验证失败: {str(e)} ❌"
@@ -229,11 +577,30 @@ class DatasetCreator:
                 for pair in self.image_text_pairs:
                     if pair['index'] == index:
                         pair['text'] = text
+                        # 手动填写的描述视为已修复
+                        if text.strip() and pair.get('status') and pair['status'].failed:
+                            pair['status'].state = "ok"
+                            self.dead_letters.remove(index)
             return "文本更新成功"
         except Exception as e:
             return f"更新失败: {str(e)}"
             
-    def save_text_dataset(self, output_dir: str = "text_dataset") -> str:
+    def save_text_dataset(self, output_dir: Optional[str] = None, export_format: str = "json",
+                          target_length: int = 2048, separator: str = "\n\n",
+                          tokenizer_path: Optional[str] = None) -> str:
+        """保存文本数据集
+        
+        Args:
+            output_dir: 输出目录，为空时使用 text_dataset_dir()
+            export_format: json 为缩进的 JSON 数组，parquet/arrow 为带类型列的 zstd 压缩列式文件，
+                packed 为装箱到固定长度的训练序列（JSONL），tokens 为预分词的 .bin/.idx 内存映射文件
+            target_length: packed 格式的目标序列长度（token）
+            separator: packed 格式中样本之间的分隔符
+            tokenizer_path: tokens 格式使用的本地 tokenizer.json 路径
+            
+        Returns:
+            str: 状态消息
+        """
         try:
             if not self.text_processor or not self.text_processor.text_results:
                 return "没有可保存的数据"
@@ -242,33 +609,176 @@ class DatasetCreator:
             import os
             
             # 确保输出目录存在
-            output_dir = os.path.abspath(output_dir)
+            output_dir = os.path.abspath(output_dir or self.text_dataset_dir())
             os.makedirs(output_dir, exist_ok=True)
             
             # 生成带时间戳的文件名
             timestamp = time.strftime("%Y%m%d_%H%M%S")
-            output_file = f"dataset_{timestamp}.json"
+            extension = {"packed": "packed.jsonl", "tokens": "bin"}.get(export_format, export_format)
+            output_file = f"dataset_{timestamp}.{extension}"
             output_path = os.path.join(output_dir, output_file)
             
-            print(f"保存数据集到: {output_path}")
-            print(f"数据条数: {len(self.text_processor.text_results)}")
+            logger.info(f"保存数据集到: {output_path}")
+            logger.debug(f"数据条数: {len(self.text_processor.text_results)}")
+            
+            if export_format == "tokens":
+                if not tokenizer_path or not os.path.exists(tokenizer_path):
+                    return "请提供有效的分词器文件路径 (tokenizer.json)"
+                from core.token_memmap import export_token_memmap
+                output_prefix = os.path.join(output_dir, f"dataset_{timestamp}")
+                stats = export_token_memmap(self.text_processor.text_results, output_prefix, tokenizer_path)
+                return (f"已预分词 {stats['samples']} 条数据，共 {stats['tokens']} 个 token（{stats['dtype']}），"
+                        f"保存到 {stats['bin_path']} 和 {stats['idx_path']}")
+            
+            if export_format == "packed":
+                from core.sequence_packing import export_packed
+                stats = export_packed(self.text_processor.text_results, output_path, int(target_length), separator)
+                return (f"已将 {stats['samples']} 条数据打包为 {stats['sequences']} 条 {stats['target_length']} token 序列，"
+                        f"填充率 {stats['fill_ratio']:.1%}，保存到 {output_path}")
+            
+            if export_format in ("parquet", "arrow"):
+                from core.text_export import TextColumnarWriter, text_rows
+                rows = text_rows(self.text_processor.text_results, self.text_processor.chunk_meta)
+                count = TextColumnarWriter(output_path, export_format).write(rows)
+                return f"已保存 {count} 条数据到 {output_path}"
             
             # 保存文件
             try:
-                with open(output_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.text_processor.text_results, f, ensure_ascii=False, indent=2)
-                print("文件保存成功")
+                with span("export.json"), open(output_path, 'w', encoding='utf-8') as f:
+                    write_json_array(self.text_processor.text_results, f)
+                logger.debug("文件保存成功")
                 return f"已保存 {len(self.text_processor.text_results)} 条数据到 {output_path}"
             except Exception as e:
-                print(f"保存文件失败: {str(e)}")
+                logger.error(f"保存文件失败: {str(e)}")
                 return f"保存失败: {str(e)}"
                 
         except Exception as e:
-            print(f"保存数据集过程出错: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
+            logger.exception(f"保存数据集过程出错: {str(e)}")
             return f"保存失败: {str(e)}"
 
+    async def process_text_directory(self, directory: str, analyzer_prompt: Optional[str], title_prompt: Optional[str],
+                                     format_prompt: Optional[str], output_dir: Optional[str] = None,
+                                     export_format: str = "json", resume: bool = True,
+                                     progress: Optional[Callable[[int, int, str, bool], None]] = None) -> str:
+        """增量处理语料目录中的 .txt 文件
+        
+        通过 ingest_manifest.json 记录每个文件的内容哈希、处理配置和输出位置，
+        未变化的文件只需一次 stat 即可跳过，只处理新增或修改过的文件。
+        导出格式不计入处理配置，只换格式时从已有输出转换，不重新调用模型。
+        本地指令模式（见 set_instruction_mode）不需要配置 API。
+        
+        Args:
+            directory: 语料目录
+            analyzer_prompt: 分析器提示词
+            title_prompt: 标题生成器提示词
+            format_prompt: 格式化器提示词
+                为空的提示词使用 TextProcessor 内置的提示词
+            output_dir: 输出目录，每个输入文件对应 incremental/ 下的一个输出文件，为空时使用 text_dataset_dir()
+            export_format: json、parquet 或 arrow
+            resume: 为 False 时忽略清单，重新处理所有文件
+            progress: 每处理完一个文件调用一次，参数为 (已完成数, 待处理总数, 文件名, 是否成功)
+            
+        Returns:
+            str: 处理摘要
+        """
+        local = bool(self.text_processor) and self.text_processor.instruction_mode == "local"
+        if not self.text_processor or not (self.api_handler or local):
+            return "请先配置API设置"
+        directory = Path(directory).absolute()
+        if not directory.is_dir():
+            return f"目录不存在: {directory}"
+            
+        # 打包序列和预分词文件需要整个语料，按文件的增量输出只支持逐条格式
+        if export_format not in ("json", "parquet", "arrow"):
+            export_format = "json"
+        start = time.time()
+        output_dir = output_dir or self.text_dataset_dir()
+        manifest = IngestManifest(Path(output_dir) / "ingest_manifest.json")
+        config_hash = config_fingerprint(
+            model="local" if local else self.api_handler.config.model,
+            analyzer_prompt=(analyzer_prompt or "").strip(),
+            title_prompt=(title_prompt or "").strip(),
+            format_prompt=(format_prompt or "").strip()
+        )
+        incremental_dir = Path(output_dir).absolute() / "incremental"
+        
+        files = sorted(directory.glob("*.txt"))
+        todo = []
+        converted = 0
+        for file in files:
+            need, reason = manifest.check(file, config_hash) if resume else (True, "重新处理")
+            if need:
+                logger.info(f"{file.name}: {reason}")
+                todo.append(file)
+            elif manifest.output_format(file) != export_format:
+                from core.text_export import read_text_output
+                try:
+                    output_path = incremental_dir / f"{file.stem}.{export_format}"
+                    old_output = manifest.entries[str(file.absolute())]['output']
+                    results, meta = read_text_output(old_output, file.name)
+                    self._write_text_output(output_path, export_format, results, meta)
+                    manifest.move_output(file, output_path, export_format)
+                    manifest.save()
+                    converted += 1
+                    logger.info(f"{file.name}: 处理结果未变化，由 {old_output} 转换为 {export_format}")
+                except Exception as e:
+                    logger.error(f"转换文件 {file.name} 的输出失败，重新处理: {str(e)}")
+                    todo.append(file)
+        skipped = len(files) - len(todo)
+        
+        custom_prompts = not local and any([analyzer_prompt, title_prompt, format_prompt])
+        processed = failed = 0
+        for n, file in enumerate(todo, 1):
+            ok = False
+            try:
+                raw = file.read_bytes()
+                sha256 = hashlib.sha256(raw).hexdigest()
+                content = raw.decode('utf-8')
+                
+                # 每个文件都重新建立连接并应用提示词
+                if custom_prompts:
+                    await self.text_processor.update_prompts(analyzer_prompt, title_prompt, format_prompt)
+                async with self.text_processor as processor:
+                    _, message = await processor.process_file(content, file.name)
+                if message != "处理完成":
+                    logger.info(f"{file.name}: {message}")
+                    failed += 1
+                    continue
+                    
+                output_path = incremental_dir / f"{file.stem}.{export_format}"
+                self._write_text_output(output_path, export_format, processor.text_results, processor.chunk_meta)
+                manifest.record(file, config_hash, output_path, len(processor.text_results), sha256,
+                                export_format=export_format)
+                # 每个文件完成后立即落盘，中断后不会重复处理
+                manifest.save()
+                processed += 1
+                ok = True
+            except Exception as e:
+                logger.error(f"处理文件 {file.name} 失败: {str(e)}")
+                failed += 1
+            finally:
+                if progress:
+                    progress(n, len(todo), file.name, ok)
+                
+        manifest.save()
+        message = (f"共 {len(files)} 个文件：跳过未变化 {skipped} 个"
+                   f"{f'（其中 {converted} 个仅转换格式）' if converted else ''}，处理 {processed} 个，失败 {failed} 个，"
+                   f"耗时 {time.time() - start:.1f}s")
+        logger.info(message)
+        return message
+
+    @staticmethod
+    def _write_text_output(output_path: Path, export_format: str, text_results: Iterable[Dict],
+                           chunk_meta: Iterable[Dict]) -> None:
+        """写出一个输入文件的增量输出，格式为 json、parquet 或 arrow"""
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        if export_format in ("parquet", "arrow"):
+            from core.text_export import TextColumnarWriter, text_rows
+            TextColumnarWriter(output_path, export_format).write(text_rows(text_results, chunk_meta))
+        else:
+            with open(output_path, 'w', encoding='utf-8') as f:
+                write_json_array(text_results, f)
+
     def test_single_image_description(self, index: int = 0) -> str:
         try:
             if not self.api_handler or not self.image_text_pairs:
@@ -278,10 +788,12 @@ class DatasetCreator:
                 return "图片索引超出范围"
                 
             pair = self.image_text_pairs[index]
-            description = self.api_handler.generate_description(pair['image_path'])
-            pair['text'] = description
+            result = self.api_handler.describe_image(pair['image_path'], self._detail(pair))
+            self._apply_result(pair, result)
+            if not result.ok:
+                return f"测试失败 [{result.error_class}]: {result.error}"
             
-            return f"测试成功: {description[:100]}..."
+            return f"测试成功: {result.text[:100]}..."
             
         except Exception as e:
             return f"测试失败: {str(e)}"
\ No newline at end of file
@@ -0,0 +1,201 @@
+import bisect
+import io
+import json
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Union
+import logging
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+IMAGE_COLUMN = 'image'
+
+
+class _ParquetSource:
+    """分片 Parquet：只读取各文件的 footer，按 row group 随机访问"""
+
+    def __init__(self, files: List[Path]):
+        self.files = [pq.ParquetFile(pa.memory_map(str(f))) for f in files]
+        # (文件下标, row group 下标) 及其起始行号
+        self._groups = []
+        self._starts = []
+        total = 0
+        for fi, pf in enumerate(self.files):
+            for gi in range(pf.metadata.num_row_groups):
+                self._groups.append((fi, gi))
+                self._starts.append(total)
+                total += pf.metadata.row_group(gi).num_rows
+        self.num_rows = total
+        self.column_names = self.files[0].schema_arrow.names if self.files else []
+        self._cache_key = None
+        self._cache_table = None
+
+    def _row_group(self, g: int, columns: List[str]) -> pa.Table:
+        key = (g, tuple(columns))
+        if key != self._cache_key:
+            fi, gi = self._groups[g]
+            self._cache_table = self.files[fi].read_row_group(gi, columns=columns)
+            self._cache_key = key
+        return self._cache_table
+
+    def read(self, indices: Sequence[int], columns: List[str]) -> Dict[str, list]:
+        out = {c: [] for c in columns}
+        for i in indices:
+            g = bisect.bisect_right(self._starts, i) - 1
+            table = self._row_group(g, columns)
+            row = table.slice(i - self._starts[g], 1)
+            for c in columns:
+                out[c].append(row.column(c)[0].as_py())
+        return out
+
+
+class _ArrowSource:
+    """datasets save_to_disk 的 Arrow 文件，整体内存映射，零拷贝切片"""
+
+    def __init__(self, files: List[Path]):
+        tables = []
+        for f in files:
+            source = pa.memory_map(str(f))
+            try:
+                tables.append(pa.ipc.open_stream(source).read_all())
+            except pa.ArrowInvalid:
+                tables.append(pa.ipc.open_file(pa.memory_map(str(f))).read_all())
+        self.table = pa.concat_tables(tables) if len(tables) > 1 else tables[0]
+        self.num_rows = self.table.num_rows
+        self.column_names = self.table.column_names
+
+    def read(self, indices: Sequence[int], columns: List[str]) -> Dict[str, list]:
+        out = {c: [] for c in columns}
+        for i in indices:
+            row = self.table.slice(i, 1)
+            for c in columns:
+                out[c].append(row.column(c)[0].as_py())
+        return out
+
+
+class _MetadataSource:
+    """只有 metadata.json 和图片文件的旧目录，按路径懒加载图片"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path / "metadata.json", 'r', encoding='utf-8') as f:
+            self.metadata = json.load(f)
+        self.num_rows = len(self.metadata)
+        self.column_names = [IMAGE_COLUMN, 'text']
+
+    def read(self, indices: Sequence[int], columns: List[str]) -> Dict[str, list]:
+        out = {c: [] for c in columns}
+        for i in indices:
+            item = self.metadata[i]
+            for c in columns:
+                if c == IMAGE_COLUMN:
+                    out[c].append({'bytes': None, 'path': str(self.path / item['image_file'])})
+                else:
+                    out[c].append(item.get(c))
+        return out
+
+
+def _open_source(path: Path):
+    if path.is_file() and path.suffix == '.parquet':
+        return _ParquetSource([path])
+    manifest = path / "manifest.json"
+    if manifest.exists():
+        with open(manifest, 'r', encoding='utf-8') as f:
+            shards = json.load(f).get('shards', [])
+        return _ParquetSource([path / s['file'] for s in shards])
+    parquet_files = sorted(path.glob("*.parquet"))
+    if parquet_files:
+        return _ParquetSource(parquet_files)
+    arrow_files = sorted(path.glob("data-*.arrow"))
+    if arrow_files:
+        return _ArrowSource(arrow_files)
+    if (path / "hf_dataset").is_dir():
+        return _open_source(path / "hf_dataset")
+    if (path / "metadata.json").exists():
+        return _MetadataSource(path)
+    raise FileNotFoundError(f"未找到可读取的数据集: {path}")
+
+
+class LazyImageDataset:
+    """懒加载的图片数据集
+
+    打开时只读取 Parquet footer 或内存映射 Arrow 文件，不读取图片；
+    支持按下标随机访问和切片，图片在访问时才解码；
+    columns 可以只投影部分列，只读文本时不会触及图片字节。
+    """
+
+    def __init__(self, path: Union[str, Path], columns: Optional[List[str]] = None,
+                 decode: bool = True, _source=None, _indices: Optional[range] = None):
+        """打开数据集
+
+        Args:
+            path: 数据集目录（分片 Parquet、save_to_disk 目录或 create_from_pairs 输出）或单个 Parquet 文件
+            columns: 需要读取的列，为空时读取全部列
+            decode: 是否把图片列解码为 PIL 图片，为 False 时返回原始字节
+        """
+        self.path = Path(path)
+        self._source = _source or _open_source(self.path)
+        self.columns = list(columns) if columns else list(self._source.column_names)
+        missing = set(self.columns) - set(self._source.column_names)
+        if missing:
+            raise KeyError(f"数据集中不存在列: {', '.join(sorted(missing))}")
+        self.decode = decode
+        self._indices = _indices if _indices is not None else range(self._source.num_rows)
+
+    def _view(self, indices: range, columns: Optional[List[str]] = None) -> 'LazyImageDataset':
+        return LazyImageDataset(self.path, columns or self.columns, self.decode, self._source, indices)
+
+    def select_columns(self, columns: List[str]) -> 'LazyImageDataset':
+        """列投影，返回只包含指定列的视图"""
+        return self._view(self._indices, columns)
+
+    def __len__(self) -> int:
+        return len(self._indices)
+
+    def _decode_image(self, cell: Optional[Dict]):
+        if cell is None or not self.decode:
+            return cell
+        if cell.get('bytes'):
+            return Image.open(io.BytesIO(cell['bytes']))
+        return Image.open(cell['path'])
+
+    def _rows(self, indices: Sequence[int]) -> List[Dict]:
+        data = self._source.read(indices, self.columns)
+        rows = []
+        for n in range(len(indices)):
+            row = {c: data[c][n] for c in self.columns}
+            if IMAGE_COLUMN in row:
+                row[IMAGE_COLUMN] = self._decode_image(row[IMAGE_COLUMN])
+            rows.append(row)
+        return rows
+
+    def __getitem__(self, key: Union[int, slice]):
+        if isinstance(key, slice):
+            return self._view(self._indices[key])
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(f"下标超出范围: {key}")
+        return self._rows([self._indices[key]])[0]
+
+    def __iter__(self) -> Iterator[Dict]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def column(self, name: str) -> List:
+        """读取整列，图片列不解码"""
+        if isinstance(self._source, _MetadataSource) or name == IMAGE_COLUMN:
+            return self._source.read(self._indices, [name])[name]
+        if isinstance(self._source, _ArrowSource):
+            values = self._source.table.column(name)
+        else:
+            values = pa.concat_arrays([
+                chunk for pf in self._source.files
+                for chunk in pf.read(columns=[name]).column(name).chunks
+            ])
+        if self._indices == range(self._source.num_rows):
+            return values.to_pylist()
+        return values.take(pa.array(list(self._indices))).to_pylist()
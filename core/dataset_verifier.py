@@ -0,0 +1,377 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+import logging
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# 图片文件头与结束标记，用于在不解码的情况下发现截断
+_PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+_PNG_END = b'IEND\xaeB`\x82'
+_JPEG_MAGIC = b'\xff\xd8'
+_JPEG_END = b'\xff\xd9'
+
+# 单个工作进程一次校验的旧格式图片文件数
+_FILE_CHUNK = 256
+
+# save_to_disk 目录中 Arrow 分片的清单，记录每个分片的行数、大小和 SHA-256
+ARROW_MANIFEST_FILE = "arrow_manifest.json"
+
+
+def record_checksum(data: bytes) -> int:
+    """单条记录图片字节的 CRC32 校验和"""
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def file_sha256(path: Union[str, Path], chunk_size: int = 1 << 20) -> str:
+    """计算文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_arrow_manifest(dataset_path: Union[str, Path]) -> Dict:
+    """为 save_to_disk 目录写出 Arrow 分片清单
+
+    清单先写临时文件再替换，校验时据此核对每个分片的行数、大小和 SHA-256。
+
+    Args:
+        dataset_path: save_to_disk 输出目录
+
+    Returns:
+        Dict: 写入的清单
+    """
+    path = Path(dataset_path)
+    shards = []
+    for arrow_file in sorted(path.glob("data-*.arrow")):
+        with pa.ipc.open_stream(pa.memory_map(str(arrow_file))) as reader:
+            num_rows = sum(batch.num_rows for batch in reader)
+        shards.append({
+            'file': arrow_file.name,
+            'num_rows': num_rows,
+            'bytes': arrow_file.stat().st_size,
+            'sha256': file_sha256(arrow_file)
+        })
+    manifest = {'num_rows': sum(s['num_rows'] for s in shards), 'shards': shards}
+    tmp_file = path / f".{ARROW_MANIFEST_FILE}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path / ARROW_MANIFEST_FILE)
+    return manifest
+
+
+def check_image_bytes(data: Optional[bytes], deep: bool = False) -> Optional[str]:
+    """校验图片字节
+
+    快速模式只检查文件头、结束标记并解析图片头；深度模式完整解码。
+
+    Args:
+        data: 图片字节
+        deep: 是否完整解码
+
+    Returns:
+        Optional[str]: 错误描述，正常时为 None
+    """
+    if not data:
+        return "图片字节为空"
+    if data.startswith(_PNG_MAGIC):
+        # PNG 末尾可能有填充，在最后一段里查找 IEND
+        if _PNG_END not in data[-64:]:
+            return "PNG 缺少 IEND，文件可能被截断"
+    elif data.startswith(_JPEG_MAGIC):
+        if _JPEG_END not in data[-16:]:
+            return "JPEG 缺少 EOI，文件可能被截断"
+    try:
+        img = Image.open(io.BytesIO(data))
+        if img.size[0] <= 0 or img.size[1] <= 0:
+            return f"图片尺寸无效: {img.size}"
+        if deep:
+            img.load()
+    except Exception as e:
+        return f"{type(e).__name__}: {str(e)}"
+    return None
+
+
+@dataclass
+class VerifyReport:
+    """数据集校验结果"""
+    path: str
+    deep: bool = False
+    shards_checked: int = 0
+    records_checked: int = 0
+    bytes_read: int = 0
+    seconds: float = 0.0
+    failures: List[Dict] = field(default_factory=list)
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failures
+
+    @property
+    def records_per_second(self) -> float:
+        return self.records_checked / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes_read / 1e6 / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        mode = "深度" if self.deep else "快速"
+        text = (f"{mode}校验 {self.path}: {self.shards_checked} 个分片，{self.records_checked} 条记录，"
+                f"{self.seconds:.2f}s（{self.records_per_second:.0f} 条/s，{self.mb_per_second:.1f} MB/s），"
+                f"失败 {len(self.failures)} 条")
+        for note in self.notes:
+            text += f"\n  注意: {note}"
+        for failure in self.failures[:10]:
+            where = failure.get('shard', '')
+            if failure.get('row') is not None:
+                where += f"#{failure['row']}"
+            text += f"\n  - {where}: {failure['error']}"
+        if len(self.failures) > 10:
+            text += f"\n  ... 另有 {len(self.failures) - 10} 条"
+        return text
+
+
+def _verify_parquet_shard(path: str, expected: Optional[Dict], deep: bool) -> Tuple[int, int, List[Dict]]:
+    name = os.path.basename(path)
+    failures = []
+    if not os.path.exists(path):
+        return 0, 0, [{'shard': name, 'error': "分片文件不存在"}]
+    size = os.path.getsize(path)
+    if expected:
+        if expected.get('bytes') is not None and size != expected['bytes']:
+            failures.append({'shard': name, 'error': f"文件大小不符: {size} != {expected['bytes']}"})
+        if expected.get('sha256') and file_sha256(path) != expected['sha256']:
+            failures.append({'shard': name, 'error': "分片 SHA-256 不符"})
+    try:
+        pf = pq.ParquetFile(pa.memory_map(path))
+    except Exception as e:
+        return 0, size, failures + [{'shard': name, 'error': f"footer 损坏: {str(e)}"}]
+    num_rows = pf.metadata.num_rows
+    if expected and expected.get('num_rows') is not None and num_rows != expected['num_rows']:
+        failures.append({'shard': name, 'error': f"行数不符: {num_rows} != {expected['num_rows']}"})
+
+    columns = [c for c in ('image', 'image_crc32') if c in pf.schema_arrow.names]
+    row = 0
+    for gi in range(pf.metadata.num_row_groups):
+        try:
+            table = pf.read_row_group(gi, columns=columns)
+        except Exception as e:
+            failures.append({'shard': name, 'row': row, 'error': f"row group {gi} 读取失败: {str(e)}"})
+            row += pf.metadata.row_group(gi).num_rows
+            continue
+        images = table.column('image').combine_chunks().field('bytes') if 'image' in columns else None
+        crcs = table.column('image_crc32').to_pylist() if 'image_crc32' in columns else None
+        for n in range(table.num_rows):
+            data = images[n].as_py() if images is not None else None
+            if crcs is not None and data is not None and record_checksum(data) != crcs[n]:
+                failures.append({'shard': name, 'row': row, 'error': "记录 CRC32 不符"})
+            elif images is not None:
+                error = check_image_bytes(data, deep)
+                if error:
+                    failures.append({'shard': name, 'row': row, 'error': error})
+            row += 1
+    return num_rows, size, failures
+
+
+def _verify_arrow_file(path: str, expected: Optional[Dict], deep: bool) -> Tuple[int, int, List[Dict]]:
+    name = os.path.basename(path)
+    failures = []
+    if not os.path.exists(path):
+        return 0, 0, [{'shard': name, 'error': "分片文件不存在"}]
+    size = os.path.getsize(path)
+    if expected:
+        if expected.get('bytes') is not None and size != expected['bytes']:
+            failures.append({'shard': name, 'error': f"文件大小不符: {size} != {expected['bytes']}"})
+        if expected.get('sha256') and file_sha256(path) != expected['sha256']:
+            failures.append({'shard': name, 'error': "分片 SHA-256 不符"})
+    try:
+        table = pa.ipc.open_stream(pa.memory_map(path)).read_all()
+    except Exception as e:
+        return 0, size, failures + [{'shard': name, 'error': f"Arrow 文件损坏: {str(e)}"}]
+    if expected and expected.get('num_rows') is not None and table.num_rows != expected['num_rows']:
+        failures.append({'shard': name, 'error': f"行数不符: {table.num_rows} != {expected['num_rows']}"})
+    if 'image' in table.column_names:
+        images = table.column('image').combine_chunks().field('bytes')
+        crcs = table.column('image_crc32').to_pylist() if 'image_crc32' in table.column_names else None
+        for n in range(table.num_rows):
+            data = images[n].as_py()
+            if crcs is not None and data is not None and record_checksum(data) != crcs[n]:
+                failures.append({'shard': name, 'row': n, 'error': "记录 CRC32 不符"})
+                continue
+            error = check_image_bytes(data, deep)
+            if error:
+                failures.append({'shard': name, 'row': n, 'error': error})
+    return table.num_rows, size, failures
+
+
+def _verify_tar_shard(path: str, expected: Optional[Dict], deep: bool) -> Tuple[int, int, List[Dict]]:
+    name = os.path.basename(path)
+    failures = []
+    if not os.path.exists(path):
+        return 0, 0, [{'shard': name, 'error': "分片文件不存在"}]
+    size = os.path.getsize(path)
+    if expected:
+        if expected.get('bytes') is not None and size != expected['bytes']:
+            failures.append({'shard': name, 'error': f"文件大小不符: {size} != {expected['bytes']}"})
+        if expected.get('sha256') and file_sha256(path) != expected['sha256']:
+            failures.append({'shard': name, 'error': "分片 SHA-256 不符"})
+    # 按顺序读取同一 key 的图片和元信息
+    images: Dict[str, bytes] = {}
+    metas: Dict[str, Dict] = {}
+    try:
+        with tarfile.open(path, 'r') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                key, _, ext = member.name.rpartition('.')
+                data = tar.extractfile(member).read()
+                if ext == 'json':
+                    metas[key] = json.loads(data)
+                elif ext != 'txt':
+                    images[key] = data
+    except (tarfile.TarError, OSError, ValueError) as e:
+        return 0, size, failures + [{'shard': name, 'error': f"tar 文件损坏: {str(e)}"}]
+    for key in sorted(images):
+        crc = metas.get(key, {}).get('image_crc32')
+        if crc is not None and record_checksum(images[key]) != crc:
+            failures.append({'shard': name, 'row': key, 'error': "记录 CRC32 不符"})
+            continue
+        error = check_image_bytes(images[key], deep)
+        if error:
+            failures.append({'shard': name, 'row': key, 'error': error})
+    if expected and expected.get('num_samples') is not None and len(images) != expected['num_samples']:
+        failures.append({'shard': name, 'error': f"样本数不符: {len(images)} != {expected['num_samples']}"})
+    return len(images), size, failures
+
+
+def _verify_image_files(paths: List[str], deep: bool) -> Tuple[int, int, List[Dict]]:
+    failures = []
+    total = 0
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            failures.append({'shard': os.path.basename(path), 'error': str(e)})
+            continue
+        total += len(data)
+        error = check_image_bytes(data, deep)
+        if error:
+            failures.append({'shard': os.path.basename(path), 'error': error})
+    return len(paths), total, failures
+
+
+def _plan(path: Path, deep: bool) -> Tuple[List[tuple], List[Dict], List[str]]:
+    """根据数据集布局生成校验任务
+
+    Returns:
+        tuple: (校验任务, 清单级失败, 校验覆盖范围的说明)
+    """
+    index_file = path / "shards.json"
+    if index_file.exists():
+        with open(index_file, 'r', encoding='utf-8') as f:
+            shards = json.load(f).get('shards', [])
+        return [(_verify_tar_shard, str(path / s['file']), s, deep) for s in shards], [], []
+    manifest_file = path / "manifest.json"
+    if manifest_file.exists():
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        shards = manifest.get('shards', [])
+        failures = []
+        if manifest.get('num_rows') is not None and manifest['num_rows'] != sum(s['num_rows'] for s in shards):
+            failures.append({'shard': "manifest.json", 'error': "清单总行数与分片行数之和不符"})
+        return [(_verify_parquet_shard, str(path / s['file']), s, deep) for s in shards], failures, []
+    parquet_files = sorted(path.glob("*.parquet"))
+    if parquet_files:
+        return [(_verify_parquet_shard, str(f), None, deep) for f in parquet_files], [], []
+    arrow_manifest_file = path / ARROW_MANIFEST_FILE
+    if arrow_manifest_file.exists():
+        with open(arrow_manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        shards = manifest.get('shards', [])
+        failures = []
+        if manifest.get('num_rows') is not None and manifest['num_rows'] != sum(s['num_rows'] for s in shards):
+            failures.append({'shard': ARROW_MANIFEST_FILE, 'error': "清单总行数与分片行数之和不符"})
+        listed = {s['file'] for s in shards}
+        for extra in sorted(f.name for f in path.glob("data-*.arrow") if f.name not in listed):
+            failures.append({'shard': extra, 'error': "分片不在清单中"})
+        return [(_verify_arrow_file, str(path / s['file']), s, deep) for s in shards], failures, []
+    arrow_files = sorted(path.glob("data-*.arrow"))
+    if arrow_files:
+        # 旧版本导出的 save_to_disk 目录没有分片清单和 image_crc32 列
+        notes = ["未找到 Arrow 分片清单，未核对分片大小和 SHA-256，缺失的分片无法发现"]
+        with pa.ipc.open_stream(pa.memory_map(str(arrow_files[0]))) as reader:
+            if 'image_crc32' not in reader.schema.names:
+                notes.append("数据集没有 image_crc32 列，未核对记录 CRC32，只检查图片头和结束标记")
+        return [(_verify_arrow_file, str(f), None, deep) for f in arrow_files], [], notes
+    if (path / "hf_dataset").is_dir():
+        return _plan(path / "hf_dataset", deep)
+    if (path / "metadata.json").exists():
+        with open(path / "metadata.json", 'r', encoding='utf-8') as f:
+            files = [str(path / item['image_file']) for item in json.load(f)]
+        chunks = [files[i:i + _FILE_CHUNK] for i in range(0, len(files), _FILE_CHUNK)]
+        notes = ["图片文件目录没有校验和，只检查图片头和结束标记"]
+        return [(_verify_image_files, chunk, deep) for chunk in chunks], [], notes
+    raise FileNotFoundError(f"未找到可校验的数据集: {path}")
+
+
+def _run(task: tuple) -> Tuple[int, int, List[Dict]]:
+    fn, *args = task
+    return fn(*args)
+
+
+def verify_dataset(dataset_path: Union[str, Path], deep: bool = False,
+                   workers: Optional[int] = None) -> VerifyReport:
+    """并行校验数据集
+
+    检查清单、分片大小与 SHA-256、Parquet footer 和行数，
+    逐条核对 CRC32 并校验图片头和结束标记；deep 为 True 时完整解码每张图片。
+
+    Args:
+        dataset_path: 数据集目录
+        deep: 是否完整解码图片
+        workers: 工作进程数，默认使用 CPU 核数
+
+    Returns:
+        VerifyReport: 校验结果，包含吞吐量和失败记录
+    """
+    path = Path(dataset_path).absolute()
+    report = VerifyReport(path=str(path), deep=deep)
+    start = time.time()
+    tasks, failures, notes = _plan(path, deep)
+    report.failures.extend(failures)
+    report.notes.extend(notes)
+
+    workers = min(workers or os.cpu_count() or 1, max(1, len(tasks)))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_run, tasks))
+    else:
+        results = [_run(task) for task in tasks]
+
+    for records, size, task_failures in results:
+        report.shards_checked += 1
+        report.records_checked += records
+        report.bytes_read += size
+        report.failures.extend(task_failures)
+    report.seconds = time.time() - start
+    logger.info(report.summary())
+    return report
@@ -1,8 +1,53 @@
 # core/file_handler.py
 import os
 import shutil
-from typing import List
+import time
+from contextlib import contextmanager
+from typing import Iterator, List
 from PIL import Image
+import logging
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+LOCK_FILE = ".lock"
+
+
+@contextmanager
+def directory_lock(directory: str) -> Iterator[None]:
+    """在输出目录上加进程间互斥锁，同一进程的不同线程之间也互斥
+
+    锁文件在目录中，锁由操作系统持有，进程崩溃后自动释放，不会留下需要手动清理的死锁。
+
+    Args:
+        directory: 要加锁的目录，不存在时创建
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, LOCK_FILE), 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
 
 class FileSystemHandler:
     def __init__(self, temp_dir: str = "temp_dataset"):
@@ -20,6 +65,12 @@ class FileSystemHandler:
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
         img.save(save_path)
 
+    def save_temp_bytes(self, data: bytes, save_path: str) -> None:
+        # 原样写入已编码的图片字节
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        with open(save_path, 'wb') as f:
+            f.write(data)
+
     def cleanup(self) -> None:
         if os.path.exists(self.temp_dir):
             shutil.rmtree(self.temp_dir)
@@ -33,7 +84,7 @@ class FileSystemHandler:
         
         # 检查目录是否存在
         if not os.path.exists(directory):
-            print(f"目录不存在: {directory}")
+            logger.warning(f"目录不存在: {directory}")
             return []
             
         return [f for f in os.listdir(directory) 
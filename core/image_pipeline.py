@@ -0,0 +1,208 @@
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+import logging
+
+from core.image_processor import ImageProcessor
+from core.file_handler import FileSystemHandler
+from core.telemetry import QUEUE_DEPTH, child_thread_name
+
+logger = logging.getLogger(__name__)
+
+# 队列结束标记
+_DONE = object()
+
+
+class RecordWriter:
+    """增量写出数据集记录
+
+    每完成一条记录就把图片字节原样写到输出目录，并向 records.jsonl 追加一行，
+    中途中断时已完成的部分仍然可用。
+    """
+
+    def __init__(self, output_dir: str = "image_dataset"):
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
+        self.output_path = Path(output_dir).absolute() / f"stream_{timestamp}"
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        self.records_file = self.output_path / "records.jsonl"
+        self._fp = open(self.records_file, 'a', encoding='utf-8')
+        self.count = 0
+
+    def write(self, item: Dict) -> None:
+        img_filename = f"image_{item['index']:05d}.{item['image_format']}"
+        with open(self.output_path / img_filename, 'wb') as f:
+            f.write(item['image_bytes'])
+        self._fp.write(json.dumps({
+            'index': item['index'],
+            'image_file': img_filename,
+            'text': item['text'],
+            'source': item.get('source_path')
+        }, ensure_ascii=False) + "\n")
+        self._fp.flush()
+        self.count += 1
+
+    def close(self) -> None:
+        if not self._fp.closed:
+            self._fp.close()
+
+
+class ImagePipeline:
+    """上传到数据集的流水线
+
+    解码 → 编码 → 描述请求 → 写出记录 四个阶段在各自的线程中运行，
+    阶段之间使用有界队列连接。后面的文件还在解码时，前面的图片已经在请求描述，
+    总耗时趋近于最慢阶段的耗时，而不是各阶段耗时之和。
+    """
+
+    def __init__(self, api_handler, fs_handler: Optional[FileSystemHandler] = None,
+                 describe_workers: int = 4, queue_size: int = 8, detail_policy: str = "auto"):
+        """初始化流水线
+
+        Args:
+            api_handler: API处理器
+            fs_handler: 临时文件处理器
+            describe_workers: 并发描述请求的线程数
+            queue_size: 阶段间队列的容量
+            detail_policy: 视觉细节策略 auto/low/high
+        """
+        self.api_handler = api_handler
+        self.fs_handler = fs_handler or FileSystemHandler()
+        self.describe_workers = max(1, describe_workers)
+        self.queue_size = max(1, queue_size)
+        self.detail_policy = detail_policy
+        self._stop = threading.Event()
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        # 带超时的 put，便于在取消时及时退出
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue):
+        # 带超时的 get，取消后返回结束标记
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _decode_stage(self, file_paths: List[str], start_index: int, out_q: queue.Queue) -> None:
+        try:
+            for offset, file_path in enumerate(file_paths):
+                if self._stop.is_set():
+                    return
+                index = start_index + offset
+                item = {'index': index, 'source_path': file_path, 'text': ""}
+                try:
+                    img, data, ext = ImageProcessor.preprocess_to_bytes(file_path, self.detail_policy)
+                    item['detail'] = ImageProcessor.choose_detail(img.size, self.detail_policy)
+                    save_path = self.fs_handler.get_temp_path(f"image_{index}.{ext}")
+                    self.fs_handler.save_temp_bytes(data, save_path)
+                    item.update(image=img, image_path=save_path, image_bytes=data, image_format=ext)
+                except Exception as e:
+                    logger.error(f"解码图片失败 {file_path}: {str(e)}")
+                    item['error'] = f"处理图片失败: {str(e)}"
+                if not self._put(out_q, item):
+                    return
+        finally:
+            self._put(out_q, _DONE)
+
+    def _encode_stage(self, in_q: queue.Queue, out_q: queue.Queue) -> None:
+        while True:
+            item = self._get(in_q)
+            if item is _DONE:
+                break
+            if 'error' not in item:
+                try:
+                    item['payload'], item['mime_type'] = ImageProcessor.encode_for_vision(item['image_bytes'],
+                                                                                        item['detail'])
+                except Exception as e:
+                    item['error'] = f"图片编码失败: {str(e)}"
+            if not self._put(out_q, item):
+                return
+        for _ in range(self.describe_workers):
+            self._put(out_q, _DONE)
+
+    def _describe_stage(self, in_q: queue.Queue, out_q: queue.Queue) -> None:
+        while True:
+            item = self._get(in_q)
+            if item is _DONE:
+                self._put(out_q, _DONE)
+                return
+            if 'error' not in item and not self._stop.is_set():
+                result = self.api_handler.describe(
+                    item.pop('payload'),
+                    item.pop('mime_type'),
+                    detail=item.get('detail')
+                )
+                item['result'] = result
+                item['text'] = result.text
+            item.pop('payload', None)
+            item.pop('mime_type', None)
+            if not self._put(out_q, item):
+                return
+
+    def run(self, file_paths: List[str], start_index: int = 0,
+            writer: Optional[RecordWriter] = None) -> Iterator[Dict]:
+        """运行流水线，按完成顺序逐条产出记录
+
+        Args:
+            file_paths: 待处理的图片路径
+            start_index: 第一张图片的编号
+            writer: 增量写出记录的写入器，为空时不落盘
+
+        Yields:
+            Dict: 包含 index/image/image_path/text/result 的记录，解码或编码失败时包含 error
+        """
+        self._stop.clear()
+        decoded_q = queue.Queue(maxsize=self.queue_size)
+        encoded_q = queue.Queue(maxsize=self.queue_size)
+        described_q = queue.Queue(maxsize=self.queue_size)
+
+        threads = [
+            threading.Thread(target=self._decode_stage, args=(file_paths, start_index, decoded_q),
+                             name=child_thread_name("pipeline-decode"), daemon=True),
+            threading.Thread(target=self._encode_stage, args=(decoded_q, encoded_q),
+                             name=child_thread_name("pipeline-encode"), daemon=True),
+        ]
+        threads += [
+            threading.Thread(target=self._describe_stage, args=(encoded_q, described_q),
+                             name=child_thread_name(f"pipeline-describe-{i}"), daemon=True)
+            for i in range(self.describe_workers)
+        ]
+        for t in threads:
+            t.start()
+        depth_sources = [
+            QUEUE_DEPTH.add_source(q.qsize, queue=name)
+            for name, q in (("pipeline_decoded", decoded_q), ("pipeline_encoded", encoded_q),
+                            ("pipeline_described", described_q))
+        ]
+
+        pending = self.describe_workers
+        try:
+            while pending:
+                item = described_q.get()
+                if item is _DONE:
+                    pending -= 1
+                    continue
+                if writer and 'error' not in item and item['result'].ok:
+                    try:
+                        writer.write(item)
+                    except Exception as e:
+                        logger.error(f"写出记录失败 {item['index']}: {str(e)}")
+                yield item
+        finally:
+            # 消费方提前结束时通知各阶段退出
+            self._stop.set()
+            for source_id in depth_sources:
+                QUEUE_DEPTH.remove_source(source_id)
+            if writer:
+                writer.close()
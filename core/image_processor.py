@@ -1,15 +1,29 @@
 # core/image_processor.py
 import base64
+import io
+import math
 from pathlib import Path
 from PIL import Image
 from typing import Tuple, Union
 import logging
 
+from core.telemetry import traced
+
 logger = logging.getLogger(__name__)
 
 class ImageProcessor:
     DEFAULT_MAX_SIZE = (800, 600)
     DATASET_SIZE = (160, 40)
+    # 视觉模型按 512px 分块计费：每块 170 tokens，另加 85 基础 tokens
+    VISION_TILE_SIZE = 512
+    VISION_TILE_TOKENS = 170
+    VISION_BASE_TOKENS = 85
+    # 为减少分块数允许的最小缩放比例
+    TILE_MIN_SCALE = 0.8
+    DETAIL_POLICIES = ("auto", "low", "high")
+    # 可以原样保留字节的源格式及其扩展名
+    PASSTHROUGH_FORMATS = {'JPEG': 'jpg', 'PNG': 'png'}
+    MIME_TYPES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png'}
 
     @staticmethod
     def resize_image(img: Image.Image, max_size: Tuple[int, int] = DEFAULT_MAX_SIZE) -> Image.Image:
@@ -34,6 +48,125 @@ class ImageProcessor:
             logger.error(f"调整图片大小时出错: {str(e)}")
             raise
 
+    @staticmethod
+    def _vision_size(size: Tuple[int, int]) -> Tuple[float, float]:
+        # 服务端先把图片缩放到 2048x2048 以内，再使最短边不超过 768
+        width, height = size
+        scale = min(1.0, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, 768 / min(width, height))
+        return width * scale, height * scale
+
+    @staticmethod
+    def estimate_image_tokens(size: Tuple[int, int], detail: str = "high") -> int:
+        """估算一张图片在视觉模型中消耗的 token 数
+        
+        low 细节固定计费；high 细节按服务端缩放后的 512px 分块计费。
+        
+        Args:
+            size: 图片尺寸 (宽, 高)
+            detail: 细节等级 low/high
+            
+        Returns:
+            int: 估算的 token 数
+        """
+        if detail == "low":
+            return ImageProcessor.VISION_BASE_TOKENS
+        width, height = ImageProcessor._vision_size(size)
+        tiles = math.ceil(width / ImageProcessor.VISION_TILE_SIZE) * math.ceil(height / ImageProcessor.VISION_TILE_SIZE)
+        return ImageProcessor.VISION_BASE_TOKENS + ImageProcessor.VISION_TILE_TOKENS * tiles
+
+    @staticmethod
+    def choose_detail(size: Tuple[int, int], policy: str = "auto") -> str:
+        """按策略为图片选择细节等级
+        
+        auto 策略下，一块以内的小图使用 low（low 本身就是 512px 视图），其余使用 high。
+        
+        Args:
+            size: 图片尺寸 (宽, 高)
+            policy: auto/low/high
+            
+        Returns:
+            str: low 或 high
+        """
+        if policy in ("low", "high"):
+            return policy
+        tile = ImageProcessor.VISION_TILE_SIZE
+        return "low" if max(size) <= tile else "high"
+
+    @staticmethod
+    def tile_fit_size(size: Tuple[int, int], min_scale: float = TILE_MIN_SCALE) -> Tuple[int, int]:
+        """计算对齐到分块网格、使用最少分块的目标尺寸
+        
+        在缩放比例不低于 min_scale 的前提下，选择分块数最少的网格，
+        例如 800x600 需要 2x2 块，缩小到 682x512 后只需 2x1 块。
+        
+        Args:
+            size: 图片尺寸 (宽, 高)
+            min_scale: 相对服务端缩放后尺寸允许的最小缩放比例
+            
+        Returns:
+            Tuple[int, int]: 目标尺寸，不会大于服务端缩放后的尺寸
+        """
+        tile = ImageProcessor.VISION_TILE_SIZE
+        width, height = ImageProcessor._vision_size(size)
+        max_x, max_y = math.ceil(width / tile), math.ceil(height / tile)
+        best = (max_x * max_y, 1.0)
+        for tx in range(1, max_x + 1):
+            for ty in range(1, max_y + 1):
+                scale = min(1.0, tx * tile / width, ty * tile / height)
+                if scale < min_scale:
+                    continue
+                tiles = math.ceil(width * scale / tile) * math.ceil(height * scale / tile)
+                # 分块数相同时保留更大的尺寸
+                if (tiles, -scale) < (best[0], -best[1]):
+                    best = (tiles, scale)
+        scale = best[1]
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    @staticmethod
+    def payload_size(size: Tuple[int, int], detail: str = "auto") -> Tuple[int, int]:
+        """计算 prepare_for_vision 发送给模型的图片尺寸，用于估算 token 和分组
+        
+        Args:
+            size: 图片尺寸 (宽, 高)
+            detail: 细节策略 auto/low/high
+            
+        Returns:
+            Tuple[int, int]: 缩放后的尺寸
+        """
+        width, height = size
+        if ImageProcessor.choose_detail(size, detail) == "low":
+            tile = ImageProcessor.VISION_TILE_SIZE
+            ratio = min(1.0, tile / width, tile / height)
+            return int(width * ratio), int(height * ratio)
+        target = ImageProcessor.tile_fit_size(size)
+        return min(width, target[0]), min(height, target[1])
+
+    @staticmethod
+    def prepare_for_vision(img: Image.Image, policy: str = "auto") -> Image.Image:
+        """按细节策略把图片缩小到计费最少的尺寸，只用于发送给模型的副本
+        
+        Args:
+            img: 输入图片
+            policy: auto/low/high
+            
+        Returns:
+            缩放后的图片
+        """
+        try:
+            detail = ImageProcessor.choose_detail(img.size, policy)
+            if detail == "low":
+                tile = ImageProcessor.VISION_TILE_SIZE
+                return ImageProcessor.resize_image(img, (tile, tile))
+            target = ImageProcessor.tile_fit_size(img.size)
+            if target[0] >= img.size[0] and target[1] >= img.size[1]:
+                return img
+            return img.resize(target, Image.Resampling.LANCZOS)
+        except Exception as e:
+            logger.error(f"按分块网格缩放图片时出错: {str(e)}")
+            raise
+
     @staticmethod
     def resize_for_dataset(img: Image.Image) -> Image.Image:
         """调整图片大小为数据集所需的尺寸
@@ -53,6 +186,7 @@ class ImageProcessor:
             raise
 
     @staticmethod
+    @traced("image.encode")
     def encode_image(image_path: Union[str, Path]) -> str:
         """将图片转换为base64编码
         
@@ -70,6 +204,97 @@ class ImageProcessor:
             logger.error(f"图片编码失败: {str(e)}")
             raise
 
+    @staticmethod
+    @traced("image.encode")
+    def encode_bytes(data: bytes) -> str:
+        """将已编码的图片字节转换为base64字符串"""
+        return base64.b64encode(data).decode('utf-8')
+
+    @staticmethod
+    @traced("image.encode")
+    def encode_for_vision(data: bytes, detail: str = "auto") -> Tuple[str, str]:
+        """把数据集中保存的图片字节转换为发送给模型的 base64 字符串
+        
+        按细节策略缩小的只是请求中的副本，数据集保留原尺寸的字节；
+        不需要缩小时直接使用原字节，不重新编码。
+        
+        Args:
+            data: 已编码的图片字节
+            detail: 细节策略 auto/low/high
+            
+        Returns:
+            Tuple[str, str]: base64 字符串和 MIME 类型
+        """
+        mime = ImageProcessor.guess_mime(data)
+        img = Image.open(io.BytesIO(data))
+        if ImageProcessor.payload_size(img.size, detail) != img.size:
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img = ImageProcessor.prepare_for_vision(img, detail)
+            buffer = io.BytesIO()
+            if mime == 'image/jpeg':
+                img.save(buffer, format='JPEG', quality=95)
+            else:
+                img.save(buffer, format='PNG')
+            data = buffer.getvalue()
+        return base64.b64encode(data).decode('utf-8'), mime
+
+    @staticmethod
+    def mime_type(ext: str) -> str:
+        """根据扩展名返回图片MIME类型"""
+        return ImageProcessor.MIME_TYPES.get(ext.lower().lstrip('.'), 'image/jpeg')
+
+    @staticmethod
+    def guess_mime(data: bytes) -> str:
+        """根据文件头判断图片MIME类型"""
+        if data.startswith(b'\x89PNG'):
+            return 'image/png'
+        return 'image/jpeg'
+
+    @staticmethod
+    @traced("image.preprocess")
+    def preprocess_to_bytes(image_path: Union[str, Path], policy: str = "auto") -> Tuple[Image.Image, bytes, str]:
+        """加载、预处理图片，并得到唯一一份编码后的字节
+        
+        尺寸和模式都不需要调整的 JPEG/PNG 原样保留源文件字节；
+        否则只编码一次（JPEG 源仍存为 JPEG，其余存为 PNG）。
+        临时文件和导出直接使用这份字节；按细节策略缩小的请求副本由 encode_for_vision 生成，
+        不影响数据集中的图片。
+        
+        Args:
+            image_path: 图片路径
+            policy: 视觉细节策略 auto/low/high，保留参数以兼容调用方，不再影响保存的图片
+            
+        Returns:
+            Tuple[Image.Image, bytes, str]: 预处理后的图片、编码字节和扩展名
+        """
+        try:
+            raw = Path(image_path).read_bytes()
+            img = Image.open(io.BytesIO(raw))
+            source_format = (img.format or '').upper()
+            source_size, source_mode = img.size, img.mode
+            
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            img = ImageProcessor.resize_image(img)
+            
+            if (img.size == source_size and source_mode == 'RGB'
+                    and source_format in ImageProcessor.PASSTHROUGH_FORMATS):
+                img.load()
+                return img, raw, ImageProcessor.PASSTHROUGH_FORMATS[source_format]
+                
+            buffer = io.BytesIO()
+            if source_format == 'JPEG':
+                img.save(buffer, format='JPEG', quality=95)
+                ext = 'jpg'
+            else:
+                img.save(buffer, format='PNG')
+                ext = 'png'
+            return img, buffer.getvalue(), ext
+        except Exception as e:
+            logger.error(f"图片预处理编码失败: {str(e)}")
+            raise
+
     @staticmethod
     def load_and_preprocess(image_path: Union[str, Path]) -> Image.Image:
         """加载并预处理图片
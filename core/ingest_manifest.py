@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 分块逻辑变化时递增，使旧的清单记录失效
+CHUNKER_VERSION = 1
+
+
+def config_fingerprint(**config) -> str:
+    """计算处理配置（分块器、提示词、模型等）的指纹"""
+    payload = json.dumps({'chunker_version': CHUNKER_VERSION, **config}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def content_sha256(path: Union[str, Path], chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    """文件级增量处理清单
+
+    按输入文件记录内容哈希、stat 信息、处理配置指纹、输出位置和输出格式。
+    大小和修改时间都未变化时只需一次 stat 即可跳过；stat 变化但内容哈希相同（例如只是 touch）时也会跳过并刷新 stat。
+    导出格式不属于处理配置，只换格式时由调用方从已有输出转换（见 output_format、move_output）。
+    """
+
+    def __init__(self, manifest_path: Union[str, Path] = "text_dataset/ingest_manifest.json"):
+        self.manifest_path = Path(manifest_path).absolute()
+        self.entries: Dict[str, Dict] = {}
+        if self.manifest_path.exists():
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f).get('files', {})
+
+    @staticmethod
+    def _key(path: Union[str, Path]) -> str:
+        return str(Path(path).absolute())
+
+    def check(self, path: Union[str, Path], config_hash: str) -> Tuple[bool, str]:
+        """判断文件是否需要处理
+
+        Args:
+            path: 输入文件路径
+            config_hash: 当前处理配置的指纹
+
+        Returns:
+            Tuple[bool, str]: (是否需要处理, 原因)
+        """
+        entry = self.entries.get(self._key(path))
+        if not entry:
+            return True, "新文件"
+        if entry.get('config_hash') != config_hash:
+            return True, "处理配置已变化"
+        if not entry.get('output') or not os.path.exists(entry['output']):
+            return True, "输出文件不存在"
+        stat = os.stat(path)
+        if stat.st_size == entry.get('size') and stat.st_mtime_ns == entry.get('mtime_ns'):
+            return False, "未变化"
+        if stat.st_size == entry.get('size') and content_sha256(path) == entry.get('sha256'):
+            entry['mtime_ns'] = stat.st_mtime_ns
+            return False, "内容未变化"
+        return True, "内容已修改"
+
+    def output_format(self, path: Union[str, Path]) -> Optional[str]:
+        """已记录输出的格式，旧清单没有格式字段时按扩展名判断"""
+        entry = self.entries.get(self._key(path))
+        if not entry or not entry.get('output'):
+            return None
+        return entry.get('format') or Path(entry['output']).suffix.lstrip('.')
+
+    def move_output(self, path: Union[str, Path], output: Union[str, Path], export_format: str) -> None:
+        """只更新输出位置和格式，处理配置和内容信息不变"""
+        entry = self.entries[self._key(path)]
+        entry['output'] = str(Path(output).absolute())
+        entry['format'] = export_format
+
+    def record(self, path: Union[str, Path], config_hash: str, output: Union[str, Path],
+               records: int, sha256: Optional[str] = None, export_format: Optional[str] = None) -> None:
+        """记录一个已处理完成的文件
+
+        Args:
+            path: 输入文件路径
+            config_hash: 处理配置指纹
+            output: 输出文件路径
+            records: 生成的记录数
+            sha256: 处理时读取到的内容哈希，为空时重新计算
+            export_format: 输出格式，为空时按输出文件扩展名判断
+        """
+        stat = os.stat(path)
+        self.entries[self._key(path)] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': sha256 or content_sha256(path),
+            'config_hash': config_hash,
+            'output': str(Path(output).absolute()),
+            'format': export_format or Path(output).suffix.lstrip('.'),
+            'records': records,
+            'processed_at': time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    def save(self) -> None:
+        """原子地写回清单"""
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.manifest_path.with_name(f".{self.manifest_path.name}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'files': self.entries}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
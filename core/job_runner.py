@@ -0,0 +1,249 @@
+import asyncio
+import inspect
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional
+import logging
+
+from core.telemetry import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# 当前线程正在执行的任务，供 report_progress 使用
+_local = threading.local()
+
+
+def report_progress(update: Any) -> None:
+    """在任务函数内部更新当前任务的进度，不在任务中调用时忽略
+
+    普通函数和协程函数无法像生成器那样 yield 进度，可以调用此函数。
+    """
+    job = getattr(_local, 'job', None)
+    if job is not None:
+        job.progress = update
+
+
+@dataclass
+class Job:
+    """后台任务及其状态"""
+    id: str
+    user: str
+    name: str
+    fn: Callable = field(repr=False)
+    args: tuple = field(default=(), repr=False)
+    kwargs: Dict = field(default_factory=dict, repr=False)
+    state: str = "queued"  # queued / running / done / failed / cancelled
+    progress: Any = None
+    result: Any = None
+    error: Optional[str] = None
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    cancel_requested: bool = False
+    # 非空时在性能分析中运行，报告写到该目录下
+    profile_dir: Optional[str] = None
+    profile_path: Optional[str] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ("done", "failed", "cancelled")
+
+    @property
+    def latest(self) -> Any:
+        """完成后为返回值，运行中为最近一次产出的进度"""
+        return self.result if self.state == "done" else self.progress
+
+
+class JobRunner:
+    """带每用户公平调度的后台任务执行器
+
+    每个用户有自己的先进先出队列，调度时在有待执行任务的用户之间轮转，
+    一个用户提交大量任务不会让其他用户一直排队。max_per_user 限制单个用户同时运行的任务数，
+    默认为 1，同一会话的任务按提交顺序串行执行，不会并发修改同一份会话状态。
+
+    任务函数可以是普通函数、生成器函数（每次 yield 更新进度）或协程函数。
+    """
+
+    def __init__(self, max_concurrent: int = 2, max_per_user: int = 1, keep_finished: int = 20):
+        """初始化执行器
+
+        Args:
+            max_concurrent: 同时运行的任务数上限
+            max_per_user: 单个用户同时运行的任务数上限
+            keep_finished: 每个用户保留的已结束任务数
+        """
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_per_user = max(1, max_per_user)
+        self.keep_finished = max(1, keep_finished)
+        self._jobs: Dict[str, Job] = OrderedDict()
+        self._queues: Dict[str, Deque[Job]] = {}
+        self._running: Dict[str, int] = {}
+        # 轮转顺序：刚被调度过的用户移到末尾
+        self._order: Deque[str] = deque()
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+        QUEUE_DEPTH.add_source(self.queued_count, queue="jobs")
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            for i in range(self.max_concurrent)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, user: str, fn: Callable, *args, name: str = "", profile_dir: Optional[str] = None,
+               **kwargs) -> Job:
+        """提交任务
+
+        Args:
+            user: 用户（会话）标识，用于公平调度
+            fn: 任务函数
+            name: 任务名称，用于显示
+            profile_dir: 非空时在性能分析中运行任务，报告写到该目录下
+
+        Returns:
+            Job: 已排队的任务
+        """
+        with self._cond:
+            job = Job(id=str(next(self._ids)), user=user, name=name or fn.__name__,
+                      fn=fn, args=args, kwargs=kwargs, profile_dir=profile_dir)
+            self._jobs[job.id] = job
+            if user not in self._queues:
+                self._queues[user] = deque()
+                self._order.append(user)
+            self._queues[user].append(job)
+            self._cond.notify()
+        logger.info(f"用户 {user} 提交任务 #{job.id} {job.name}")
+        return job
+
+    def queued_count(self) -> int:
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        with self._cond:
+            return self._jobs.get(job_id) if job_id else None
+
+    def jobs_for(self, user: str) -> List[Job]:
+        with self._cond:
+            return [job for job in self._jobs.values() if job.user == user]
+
+    def position(self, job_id: str) -> int:
+        """任务前面还有多少个排队的任务，按轮转顺序估算"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if not job or job.state != "queued":
+                return 0
+            ahead = self._queues[job.user].index(job)
+            order = list(self._order)
+            mine = order.index(job.user)
+            total = ahead
+            # 每轮每个用户最多调度一个任务，轮转顺序在本用户之前的用户多调度一轮
+            for user, queue in self._queues.items():
+                if user != job.user:
+                    rounds = ahead + 1 if order.index(user) < mine else ahead
+                    total += min(len(queue), rounds)
+            return total
+
+    def cancel(self, job_id: str) -> bool:
+        """取消任务：排队中的直接移除，生成器任务在下一次 yield 时停止"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if not job or job.finished:
+                return False
+            job.cancel_requested = True
+            if job.state == "queued":
+                self._queues[job.user].remove(job)
+                self._finish(job, "cancelled")
+            return True
+
+    def cancel_user(self, user: str) -> None:
+        """取消用户的所有任务，用于会话结束"""
+        for job in self.jobs_for(user):
+            self.cancel(job.id)
+
+    def _next_job(self) -> Optional[Job]:
+        for _ in range(len(self._order)):
+            user = self._order[0]
+            self._order.rotate(-1)
+            queue = self._queues.get(user)
+            if queue and self._running.get(user, 0) < self.max_per_user:
+                return queue.popleft()
+        return None
+
+    def _worker(self) -> None:
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                job.state = "running"
+                job.started_at = time.time()
+                self._running[job.user] = self._running.get(job.user, 0) + 1
+            try:
+                self._execute(job)
+            except Exception as e:
+                logger.error(f"任务 #{job.id} {job.name} 失败: {str(e)}")
+                job.error = f"{type(e).__name__}: {str(e)}"
+                state = "failed"
+            else:
+                state = "cancelled" if job.cancel_requested else "done"
+            with self._cond:
+                self._running[job.user] -= 1
+                self._finish(job, state)
+                # 该用户可能还有被 max_per_user 挡住的任务
+                self._cond.notify_all()
+
+    def _execute(self, job: Job) -> None:
+        _local.job = job
+        # 运行期间线程名唯一，任务派生的线程以此为前缀（child_thread_name），性能分析据此只统计本任务
+        thread = threading.current_thread()
+        worker_name = thread.name
+        thread.name = f"job-{job.id}"
+        try:
+            if job.profile_dir:
+                from core.profiling import profile_job
+                profile: dict = {}
+                try:
+                    with profile_job(job.profile_dir, f"{job.name}_{job.id}", scope=thread.name) as profile:
+                        self._run_fn(job)
+                finally:
+                    # 报告在退出分析时才写出，任务失败时同样保留
+                    job.profile_path = profile.get('path')
+            else:
+                self._run_fn(job)
+        finally:
+            _local.job = None
+            thread.name = worker_name
+
+    def _run_fn(self, job: Job) -> None:
+        if inspect.iscoroutinefunction(job.fn):
+            job.result = asyncio.run(job.fn(*job.args, **job.kwargs))
+            return
+        result = job.fn(*job.args, **job.kwargs)
+        if inspect.isgenerator(result):
+            for update in result:
+                job.progress = update
+                if job.cancel_requested:
+                    result.close()
+                    break
+            job.result = job.progress
+        else:
+            job.result = result
+
+    def _finish(self, job: Job, state: str) -> None:
+        job.state = state
+        job.finished_at = time.time()
+        job.fn = job.args = job.kwargs = None
+        finished = [j for j in self._jobs.values() if j.user == job.user and j.finished]
+        for old in finished[:-self.keep_finished]:
+            self._jobs.pop(old.id, None)
+        if not self._queues.get(job.user) and not self._running.get(job.user):
+            self._queues.pop(job.user, None)
+            self._running.pop(job.user, None)
+            if job.user in self._order:
+                self._order.remove(job.user)
+        logger.info(f"任务 #{job.id} {job.name} 结束: {state}")
@@ -0,0 +1,228 @@
+import math
+import re
+from collections import Counter
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional
+
+# 在每个位置重叠匹配相邻的两个汉字，不是两个汉字时匹配空串，结果与文本位置一一对应，findall 在 C 中完成
+_WINDOW = re.compile(r"(?=([\u3400-\u4dbf\u4e00-\u9fff]{2})|)")
+_LATIN_WORD = re.compile(r"[A-Za-z][A-Za-z0-9\-]{2,}")
+# 出现在开头或结尾时该词通常不是完整的主题词（虚词、代词、数量词）
+_STOP_CHARS = frozenset("的了是在和与及或也就都而被把对从为以之其这那有个上下中不没很将并等于已可又所如"
+                        "我你他她它们么一")
+_STOP_WORDS = frozenset("the and for with that this from are was were been have has not but its into "
+                        "than then they them their there which when where what who will would can "
+                        "could should".split())
+# 中文候选词的最大字数
+_MAX_GRAM = 6
+_PREFIX = {n: itemgetter(slice(0, n)) for n in range(3, _MAX_GRAM + 1)}
+# 切块时优先选择的断点，越靠前越优先
+_BREAKS = ("\n\n", "\n", "。", "！", "？", "；", ".", "!", "?")
+
+
+def split_chunk(text: str, max_chars: int = 1500) -> str:
+    """在本地从文本开头切出一块，代替文本分析 agent
+
+    在 max_chars 以内优先选择段落、换行、句末标点处断开，断点不早于一半长度，找不到时硬切。
+
+    Args:
+        text: 剩余文本
+        max_chars: 每块的最大字符数，默认约对应 1000 token 的中文
+
+    Returns:
+        str: 文本开头的一块
+    """
+    if len(text) <= max_chars:
+        return text
+    window = text[:max_chars]
+    for mark in _BREAKS:
+        cut = window.rfind(mark)
+        if cut >= max_chars // 2:
+            return window[:cut + len(mark)]
+    return window
+
+
+def _windows(text: str) -> List[str]:
+    return _WINDOW.findall(text)
+
+
+def _bigrams(windows: List[str]) -> Counter:
+    bigrams = Counter(windows)
+    bigrams.pop("", None)
+    return bigrams
+
+
+def _usable(term: str) -> bool:
+    return term[0] not in _STOP_CHARS and term[-1] not in _STOP_CHARS
+
+
+def extract_terms(text: str, bigrams: Optional[Counter] = None,
+                  windows: Optional[List[str]] = None) -> Counter:
+    """统计文本中的候选主题词
+
+    中文先统计所有相邻两字，再把出现两次以上的 n 字词与首尾相接的词拼成 n+1 字的候选
+    （出现两次以上的长词，其中每个短词必然也出现两次以上），最长 6 字。长词只在重复两字词
+    的位置上各取一段 6 字，每层对这些片段的前 n 字统计一遍，不再逐个候选词扫描全文，
+    耗时与文本长度成线性，词频与两字词一样按重叠出现计；
+    英文取长度不小于 3 的单词。去掉以虚词、代词开头或结尾的词，以及几乎只作为某个长词
+    一部分出现的短词，例如 "糖尿病" 出现时不再单独保留 "糖尿"。
+    没有重复出现的词时（文本很短）退回使用所有两字词。
+
+    Args:
+        text: 文本
+        bigrams: 已统计好的两字词频，为空时现场统计
+        windows: 已取好的逐位置两字词（_windows），为空时现场统计
+
+    Returns:
+        Counter: 候选词到词频的映射
+    """
+    if windows is None:
+        windows = _windows(text)
+    if bigrams is None:
+        bigrams = _bigrams(windows)
+    level = {gram: tf for gram, tf in bigrams.items() if tf > 1}
+    grams = dict(level)
+    # 以虚词开头的词向右延长后仍以虚词开头，不会成为候选词；长词的每次出现都从一个
+    # 这样的重复两字词开始，且后一个两字词同样重复
+    heads = {gram for gram in level if gram[0] not in _STOP_CHARS}
+    spans = [text[i:i + _MAX_GRAM] for i, pair in enumerate(zip(windows, windows[1:]))
+             if pair[0] in heads and pair[1] in level]
+    # 短词的出现次数大部分来自某个更长的词时，只保留长词
+    subsumed = set()
+    for n in range(3, _MAX_GRAM + 1):
+        longer = {}
+        for candidate, tf in Counter(map(_PREFIX[n], spans)).items():
+            # 首尾两个 n-1 字词都在上一层中，片段才是全为汉字的重复词
+            if tf > 1 and candidate[1:] in level and candidate[:-1] in level:
+                longer[candidate] = tf
+                if level[candidate[:-1]] <= tf * 1.25:
+                    subsumed.add(candidate[:-1])
+                if level[candidate[1:]] <= tf * 1.25:
+                    subsumed.add(candidate[1:])
+        if not longer:
+            break
+        grams.update(longer)
+        level = longer
+    terms = Counter({gram: tf for gram, tf in grams.items()
+                     if gram[0] not in _STOP_CHARS and gram[-1] not in _STOP_CHARS and gram not in subsumed})
+    if not terms:
+        terms = Counter({gram: tf for gram, tf in bigrams.items() if _usable(gram)})
+    terms.update(word.lower() for word in _LATIN_WORD.findall(text) if word.lower() not in _STOP_WORDS)
+    return terms
+
+
+class LocalInstructionGenerator:
+    """不调用模型、在 CPU 上按 TF-IDF 关键词生成指令
+
+    语料统计（每个候选词出现在多少个文本块中）由 fit 累积，之后的文本块和文件复用，
+    每块的指令由词频乘以逆文档频率最高的几个关键词组成。用于大批量语料的快速标注，
+    也在 API 不可用时代替标题生成 agent。
+    """
+
+    def __init__(self, max_chars: int = 10, max_keywords: int = 3):
+        """初始化生成器
+
+        Args:
+            max_chars: 指令最大字符数，与标题提示词的 10 字要求一致
+            max_keywords: 指令最多包含的关键词数
+        """
+        self.max_chars = max_chars
+        self.max_keywords = max_keywords
+        self.doc_freq: Counter = Counter()
+        self.num_docs = 0
+
+    def _count(self, document: str) -> Counter:
+        """统计一个文本块的候选词并计入语料统计"""
+        # 文档频率覆盖所有两字词，加上本块中重复出现的长词和英文单词
+        windows = _windows(document)
+        bigrams = _bigrams(windows)
+        terms = extract_terms(document, bigrams, windows)
+        self.doc_freq.update(bigrams.keys())
+        self.doc_freq.update(term for term in terms if term not in bigrams)
+        self.num_docs += 1
+        return terms
+
+    def fit(self, documents: Iterable[str]) -> "LocalInstructionGenerator":
+        """把一批文本块计入语料统计，可多次调用累积
+
+        Args:
+            documents: 文本块
+
+        Returns:
+            LocalInstructionGenerator: 自身，便于链式调用
+        """
+        for document in documents:
+            self._count(document)
+        return self
+
+    def fit_instructions(self, documents: List[str]) -> List[str]:
+        """先把整批文本块计入语料统计，再为每块生成指令
+
+        每块的候选词只统计一次，比分别调用 fit 和 instruction 快一倍。
+
+        Args:
+            documents: 文本块
+
+        Returns:
+            List[str]: 与 documents 一一对应的指令
+        """
+        counted = [self._count(document) for document in documents]
+        return [self._compose(terms, document) for terms, document in zip(counted, documents)]
+
+    def idf(self, term: str) -> float:
+        return math.log((1 + self.num_docs) / (1 + self.doc_freq.get(term, 0))) + 1
+
+    def keywords(self, text: str, top_k: int = 5, terms: Optional[Counter] = None) -> List[str]:
+        """按 TF-IDF 返回文本的关键词
+
+        Args:
+            text: 文本
+            top_k: 返回的关键词数
+            terms: 已统计好的候选词，为空时现场统计
+
+        Returns:
+            List[str]: 分数从高到低的关键词，互不包含
+        """
+        if terms is None:
+            terms = extract_terms(text)
+        scores: Dict[str, float] = {term: tf * self.idf(term) * len(term) ** 0.5
+                                    for term, tf in terms.items()}
+        selected: List[str] = []
+        for term in sorted(scores, key=lambda t: (-scores[t], -len(t), t)):
+            if any(term in kept or kept in term for kept in selected):
+                continue
+            selected.append(term)
+            if len(selected) >= top_k:
+                break
+        return selected
+
+    def instruction(self, text: str) -> str:
+        """为文本块生成不超过 max_chars 字的指令
+
+        Args:
+            text: 文本块
+
+        Returns:
+            str: 用 "、" 连接的关键词；没有候选词时取第一句的开头
+        """
+        return self._compose(extract_terms(text), text)
+
+    def _compose(self, terms: Counter, text: str) -> str:
+        parts: List[str] = []
+        length = 0
+        for keyword in self.keywords(text, top_k=self.max_keywords * 2, terms=terms):
+            extra = len(keyword) + (1 if parts else 0)
+            if length + extra > self.max_chars:
+                continue
+            parts.append(keyword)
+            length += extra
+            if len(parts) >= self.max_keywords:
+                break
+        if parts:
+            return "、".join(parts)
+        first = re.split(r"[。！？!?\n]", text.strip(), maxsplit=1)[0].strip()
+        return first[:self.max_chars] or "待处理文本"
+
+    def record(self, text: str) -> Dict:
+        """生成与格式化 agent 输出结构相同的记录"""
+        return {"instruction": self.instruction(text), "input": "", "output": text}
@@ -0,0 +1,380 @@
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter as CountMap
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+import logging
+
+from core.telemetry import add_span_listener, in_thread_family, remove_span_listener
+
+logger = logging.getLogger(__name__)
+
+# 线程空闲等待时所在的函数，不在任何步骤中时这类样本不计入
+_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("socketserver.py", "serve_forever"),
+}
+
+# 同一时间只允许一个分析会话，tracemalloc 和采样线程都是进程级的
+_active_lock = threading.Lock()
+
+
+def _rss_bytes() -> Optional[int]:
+    """当前常驻内存，Linux 读 /proc，其他平台退回到进程峰值"""
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 以字节为单位，Linux 以 KB 为单位
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return None
+
+
+def _thread_cpu_seconds(native_id: Optional[int]) -> Optional[float]:
+    """其他线程已用的 CPU 时间，Linux 读 /proc 的 schedstat，线程已退出或其他平台返回 None"""
+    try:
+        with open(f"/proc/self/task/{native_id}/schedstat", "rb") as f:
+            return int(f.read().split()[0]) / 1e9
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _per_thread_cpu_supported() -> bool:
+    return _thread_cpu_seconds(threading.get_native_id()) is not None
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    """取快照，去掉分析器自身和 tracemalloc 的分配"""
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)})"
+
+
+@dataclass
+class StageStats:
+    """一个步骤（span 名称）的统计"""
+    calls: int = 0
+    seconds: float = 0.0
+    samples: int = 0
+    peak_rss: int = 0
+    peak_traced: int = 0
+    snapshots: int = 0
+    # 分配位置 -> 步骤期间的净分配字节
+    allocations: CountMap = field(default_factory=CountMap)
+
+
+class JobProfiler:
+    """任务级的 CPU 采样与内存分析
+
+    采样线程按固定间隔抓取所有线程的调用栈（墙钟采样，等待网络的线程同样可见），
+    写成 flamegraph.pl / speedscope 可直接读取的折叠栈格式，每个样本以所在步骤开头。
+    步骤即 core.telemetry 的 span（图片预处理、编码、API 请求、agent 调用、各导出步骤），
+    每个步骤统计调用次数、耗时、采样数、期间的峰值 RSS 和 tracemalloc 峰值，
+    任务整体做一次 tracemalloc 快照对比，得到主要分配位置；需要细到步骤时可对每个步骤
+    的前几次调用做快照对比。
+
+    多个任务并发运行时（如界面的 JobRunner），scope 限定只采样、只统计名为 scope 的线程
+    及其用 core.telemetry.child_thread_name 派生的线程，报告中不混入其他任务。
+    此时 CPU 时间是这些线程各自 CPU 时间之和：线程在步骤结束时用 time.thread_time() 记录自己的值，
+    采样线程在 Linux 上每次采样读取 /proc 中各线程的值，已退出的线程最多少算最后一个采样间隔。
+    无法读取其他线程 CPU 时间的平台退回到进程整体的 CPU 时间，报告的 cpu_scope 为 process。
+    """
+
+    def __init__(self, interval: float = 0.005, memory: bool = True, snapshots_per_stage: int = 0,
+                 top: int = 15, scope: Optional[str] = None):
+        """初始化分析器
+
+        Args:
+            interval: 采样间隔（秒）
+            memory: 是否启用 tracemalloc，开启后程序会明显变慢
+            snapshots_per_stage: 每个步骤做快照对比的调用次数，整堆快照很慢，默认只做任务整体的对比
+            top: 报告中列出的分配位置数
+            scope: 只分析该名称的线程及其派生线程，为空时分析整个进程
+        """
+        self.interval = interval
+        self.memory = memory
+        self.snapshots_per_stage = snapshots_per_stage
+        self.top = top
+        self.scope = scope
+        self.stacks: CountMap = CountMap()
+        self.stages: Dict[str, StageStats] = {}
+        self._stage_stacks: Dict[int, List[Tuple[str, float, Optional[tracemalloc.Snapshot]]]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._started_tracemalloc = False
+        self._start_snapshot: Optional[tracemalloc.Snapshot] = None
+        self.peak_rss = 0
+        self.peak_traced = 0
+        self.total_samples = 0
+        # 按线程对象记录 CPU 时间，线程号被复用时不会与已退出的线程混在一起
+        self.per_thread_cpu = scope is not None and _per_thread_cpu_supported()
+        self._cpu_base: Dict[threading.Thread, float] = {}
+        self._cpu_last: Dict[threading.Thread, float] = {}
+
+    def _stage(self, name: str) -> StageStats:
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        return stats
+
+    def _in_scope(self, thread_name: Optional[str] = None) -> bool:
+        return self.scope is None or in_thread_family(self.scope, thread_name)
+
+    def _observe_cpu(self, thread: threading.Thread, seconds: Optional[float], base: bool = False) -> None:
+        if seconds is None:
+            return
+        with self._lock:
+            if base:
+                self._cpu_base[thread] = seconds
+            self._cpu_last[thread] = max(self._cpu_last.get(thread, 0.0), seconds)
+
+    def _observe_threads(self, base: bool = False) -> None:
+        """记录范围内所有存活线程的 CPU 时间，当前线程直接用 time.thread_time()"""
+        current = threading.current_thread()
+        for thread in threading.enumerate():
+            if thread is self._sampler or not self._in_scope(thread.name):
+                continue
+            seconds = time.thread_time() if thread is current else _thread_cpu_seconds(thread.native_id)
+            self._observe_cpu(thread, seconds, base)
+
+    def cpu_seconds(self) -> float:
+        """范围内线程在分析期间的 CPU 时间之和"""
+        with self._lock:
+            return sum(last - self._cpu_base.get(thread, 0.0) for thread, last in self._cpu_last.items())
+
+    def _on_span(self, name: str, entering: bool) -> None:
+        if not self._in_scope():
+            return
+        thread_id = threading.get_ident()
+        if entering:
+            snapshot = None
+            with self._lock:
+                stats = self._stage(name)
+                take = tracemalloc.is_tracing() and stats.snapshots < self.snapshots_per_stage
+                if take:
+                    stats.snapshots += 1
+            if take:
+                snapshot = _snapshot()
+            with self._lock:
+                self._stage_stacks.setdefault(thread_id, []).append((name, time.perf_counter(), snapshot))
+            return
+
+        with self._lock:
+            stack = self._stage_stacks.get(thread_id)
+            if not stack:
+                return
+            # 协程交错时退出顺序可能与进入顺序不同，按名称找最近的一层
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == name:
+                    _, start, snapshot = stack.pop(i)
+                    break
+            else:
+                return
+            stats = self._stage(name)
+            stats.calls += 1
+            stats.seconds += time.perf_counter() - start
+        if self.per_thread_cpu:
+            self._observe_cpu(threading.current_thread(), time.thread_time())
+        if snapshot is not None:
+            diff = _snapshot().compare_to(snapshot, 'lineno')
+            with self._lock:
+                for entry in diff[:self.top]:
+                    if entry.size_diff > 0:
+                        frame = entry.traceback[0]
+                        stats.allocations[f"{frame.filename}:{frame.lineno}"] += entry.size_diff
+
+    def _sample(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            if self.per_thread_cpu:
+                self._observe_threads()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            rss = _rss_bytes() or 0
+            traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+            frames = sys._current_frames()
+            with self._lock:
+                self.peak_rss = max(self.peak_rss, rss)
+                self.peak_traced = max(self.peak_traced, traced)
+                active = {}
+                for thread_id, stack in self._stage_stacks.items():
+                    if stack:
+                        active[thread_id] = stack[-1][0]
+                for name in {s for stack in self._stage_stacks.values() for s, _, _ in stack}:
+                    stats = self._stage(name)
+                    stats.peak_rss = max(stats.peak_rss, rss)
+                    stats.peak_traced = max(stats.peak_traced, traced)
+                for thread_id, frame in frames.items():
+                    if thread_id == own or not self._in_scope(names.get(thread_id, "")):
+                        continue
+                    stage = active.get(thread_id)
+                    code = frame.f_code
+                    if stage is None and (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(_frame_label(frame.f_code))
+                        frame = frame.f_back
+                    labels.append(names.get(thread_id, str(thread_id)))
+                    labels.append(f"[{stage or '-'}]")
+                    self.stacks[";".join(reversed(labels))] += 1
+                    self.total_samples += 1
+                    if stage:
+                        self.stages[stage].samples += 1
+
+    def start(self) -> None:
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+            self._started_tracemalloc = True
+        if tracemalloc.is_tracing():
+            self._start_snapshot = _snapshot()
+        if self.per_thread_cpu:
+            self._observe_threads(base=True)
+        add_span_listener(self._on_span)
+        self._sampler = threading.Thread(target=self._sample, name="profiler-sampler", daemon=True)
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+        remove_span_listener(self._on_span)
+        if self.per_thread_cpu:
+            self._observe_threads()
+
+    def report(self, wall_seconds: float, cpu_seconds: float) -> Dict:
+        """汇总为可序列化的报告
+
+        Args:
+            wall_seconds: 任务墙钟耗时
+            cpu_seconds: 进程整体的 CPU 时间，按线程统计 CPU 时（per_thread_cpu）不使用
+        """
+        top_allocations = []
+        if self._start_snapshot is not None and tracemalloc.is_tracing():
+            diff = _snapshot().compare_to(self._start_snapshot, 'lineno')
+            top_allocations = [
+                {'location': f"{e.traceback[0].filename}:{e.traceback[0].lineno}",
+                 'size_mb': round(e.size_diff / 2 ** 20, 3), 'count': e.count_diff}
+                for e in diff[:self.top]
+            ]
+        stages = {}
+        for name, stats in sorted(self.stages.items(), key=lambda kv: -kv[1].seconds):
+            stages[name] = {
+                'calls': stats.calls,
+                'seconds': round(stats.seconds, 4),
+                'samples': stats.samples,
+                'sample_share': round(stats.samples / self.total_samples, 4) if self.total_samples else 0,
+                'peak_rss_mb': round(stats.peak_rss / 2 ** 20, 1),
+                'peak_traced_mb': round(stats.peak_traced / 2 ** 20, 1),
+                'top_allocations': [
+                    {'location': loc, 'size_mb': round(size / 2 ** 20, 3)}
+                    for loc, size in stats.allocations.most_common(self.top)
+                ],
+            }
+        return {
+            'wall_seconds': round(wall_seconds, 3),
+            'cpu_seconds': round(self.cpu_seconds() if self.per_thread_cpu else cpu_seconds, 3),
+            'cpu_scope': "threads" if self.per_thread_cpu else "process",
+            'samples': self.total_samples,
+            'interval': self.interval,
+            'peak_rss_mb': round(self.peak_rss / 2 ** 20, 1),
+            'peak_traced_mb': round(self.peak_traced / 2 ** 20, 1),
+            'stages': stages,
+            'top_allocations': top_allocations,
+        }
+
+    def close(self) -> None:
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+
+def _summary(name: str, report: Dict) -> str:
+    lines = [
+        f"性能分析: {name}",
+        f"耗时 {report['wall_seconds']}s，"
+        f"CPU {report['cpu_seconds']}s（{'任务线程' if report['cpu_scope'] == 'threads' else '进程整体'}），"
+        f"{report['samples']} 个样本，"
+        f"峰值 RSS {report['peak_rss_mb']} MB，tracemalloc 峰值 {report['peak_traced_mb']} MB",
+        "",
+        f"{'步骤':<24}{'次数':>8}{'耗时(s)':>10}{'样本占比':>10}{'峰值RSS(MB)':>13}",
+    ]
+    for stage, stats in report['stages'].items():
+        lines.append(f"{stage:<24}{stats['calls']:>8}{stats['seconds']:>10.3f}"
+                     f"{stats['sample_share']:>10.1%}{stats['peak_rss_mb']:>13.1f}")
+    if report['top_allocations']:
+        lines += ["", "主要内存分配（任务期间净增）:"]
+        lines += [f"  {a['size_mb']:>9.3f} MB  {a['location']}" for a in report['top_allocations']]
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def profile_job(output_dir: Union[str, Path], name: str = "job", interval: float = 0.005,
+                memory: bool = True, snapshots_per_stage: int = 0,
+                scope: Optional[str] = None) -> Iterator[Dict]:
+    """在分析器中运行一段任务，结束后在 output_dir 下写出报告
+
+    报告目录 profile_<name>_<时间> 包含：
+    stacks.collapsed（折叠栈，可用 flamegraph.pl 或 speedscope 打开）、
+    report.json（各步骤耗时、样本占比、峰值 RSS、主要分配位置）和 summary.txt。
+    已有分析在进行时不重复分析，直接运行任务。
+
+    Args:
+        output_dir: 报告所在目录，一般为任务的输出目录
+        name: 任务名称
+        interval: 采样间隔（秒）
+        memory: 是否启用 tracemalloc
+        snapshots_per_stage: 每个步骤做快照对比的调用次数，大于 0 时报告中列出各步骤的分配位置
+        scope: 只分析该名称的线程及其派生线程，为空时分析整个进程
+
+    Yields:
+        Dict: 结束后包含 path（报告目录）和 report
+    """
+    result: Dict = {}
+    if not _active_lock.acquire(blocking=False):
+        logger.warning(f"已有性能分析在进行，任务 {name} 不做分析")
+        yield result
+        return
+    profiler = JobProfiler(interval=interval, memory=memory, snapshots_per_stage=snapshots_per_stage,
+                           scope=scope)
+    try:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        profiler.start()
+        try:
+            yield result
+        finally:
+            profiler.stop()
+            report = profiler.report(time.perf_counter() - wall_start, time.process_time() - cpu_start)
+            safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+            path = Path(output_dir).absolute() / f"profile_{safe_name}_{time.strftime('%Y%m%d_%H%M%S')}"
+            path.mkdir(parents=True, exist_ok=True)
+            with open(path / "stacks.collapsed", 'w', encoding='utf-8') as f:
+                for stack, count in profiler.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            with open(path / "report.json", 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            (path / "summary.txt").write_text(_summary(name, report), encoding='utf-8')
+            result.update(path=str(path), report=report)
+            logger.info(f"性能分析报告已写入 {path}")
+    finally:
+        profiler.close()
+        _active_lock.release()
@@ -0,0 +1,148 @@
+import threading
+import time
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ItemStatus:
+    """单张图片描述的处理状态"""
+    state: str = "pending"              # pending / ok / failed
+    error_class: Optional[str] = None
+    last_error: Optional[str] = None
+    attempts: int = 0
+
+    @property
+    def failed(self) -> bool:
+        return self.state == "failed"
+
+    def record(self, result) -> None:
+        """根据一次描述调用的结果更新状态
+
+        Args:
+            result: DescriptionResult
+        """
+        self.attempts += result.attempts
+        if result.ok:
+            self.state = "ok"
+            self.error_class = None
+            self.last_error = None
+        else:
+            self.state = "failed"
+            self.error_class = result.error_class
+            self.last_error = result.error
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+@dataclass
+class DeadLetter:
+    index: int
+    failures: int
+    next_retry_at: float
+
+
+class DeadLetterQueue:
+    """失败描述的死信队列
+
+    失败的条目按指数退避安排下一次重试时间，重试时只处理队列中的条目，
+    2000 张中失败 50 张时只需要 50 次调用。
+    """
+
+    def __init__(self, base_delay: float = 2.0, max_delay: float = 60.0, max_attempts: int = 5):
+        """初始化死信队列
+
+        Args:
+            base_delay: 首次退避的秒数
+            max_delay: 退避的上限秒数
+            max_attempts: 单个条目进入队列的最大次数，超过后不再自动重试
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._items: Dict[int, DeadLetter] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, index: int) -> bool:
+        return index in self._items
+
+    def backoff(self, failures: int) -> float:
+        return min(self.max_delay, self.base_delay * (2 ** max(0, failures - 1)))
+
+    def add(self, index: int) -> None:
+        """记录一次失败，并按失败次数安排下一次重试"""
+        with self._lock:
+            letter = self._items.get(index)
+            failures = letter.failures + 1 if letter else 1
+            self._items[index] = DeadLetter(index, failures, time.monotonic() + self.backoff(failures))
+
+    def remove(self, index: int) -> None:
+        with self._lock:
+            self._items.pop(index, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def pending(self) -> List[DeadLetter]:
+        """仍可重试的条目，按重试时间排序"""
+        with self._lock:
+            letters = [l for l in self._items.values() if l.failures < self.max_attempts]
+        return sorted(letters, key=lambda l: l.next_retry_at)
+
+    def exhausted(self) -> List[int]:
+        """已达到最大重试次数的条目编号"""
+        with self._lock:
+            return sorted(i for i, l in self._items.items() if l.failures >= self.max_attempts)
+
+    def revive(self) -> int:
+        """手动重试时，把已达到最大重试次数的条目重新计数，立即可重试
+
+        Returns:
+            int: 重新加入重试的条目数
+        """
+        now = time.monotonic()
+        with self._lock:
+            exhausted = [l for l in self._items.values() if l.failures >= self.max_attempts]
+            for letter in exhausted:
+                self._items[letter.index] = DeadLetter(letter.index, 0, now)
+        return len(exhausted)
+
+    def drain(self, retry_fn: Callable[[int], bool], sleep: Callable[[float], None] = time.sleep) -> Dict[str, int]:
+        """按退避时间重试队列中的条目，直到全部成功或达到最大次数
+
+        Args:
+            retry_fn: 重试函数，接收条目编号，成功时返回 True
+            sleep: 等待函数
+
+        Returns:
+            Dict[str, int]: 本次调用、成功和仍失败的数量
+        """
+        calls = succeeded = 0
+        while True:
+            letters = self.pending()
+            if not letters:
+                break
+            letter = letters[0]
+            wait = letter.next_retry_at - time.monotonic()
+            if wait > 0:
+                sleep(wait)
+            calls += 1
+            try:
+                ok = retry_fn(letter.index)
+            except Exception as e:
+                logger.error(f"重试条目 {letter.index} 出错: {str(e)}")
+                ok = False
+            if ok:
+                succeeded += 1
+                self.remove(letter.index)
+            else:
+                self.add(letter.index)
+        return {'calls': calls, 'succeeded': succeeded, 'failed': len(self)}
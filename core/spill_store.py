@@ -0,0 +1,286 @@
+import json
+import os
+import threading
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import IO, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import logging
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# 可以从 image_path 重新读取、超出内存上限时释放的字段
+SPILLABLE_IMAGE_KEYS = ('image', 'image_bytes')
+
+
+class MemoryBudget:
+    """结果数据在内存中的字节上限
+
+    文本记录和图片共用一个上限，各存储在超出时把自己最早的内容写到磁盘。
+    只统计本项目持有的结果数据（记录、已编码字节和解码后的像素），
+    不包括 Python 解释器、依赖库和请求中的临时对象。
+    """
+
+    def __init__(self, limit_mb: Optional[float] = None):
+        """初始化内存上限
+
+        Args:
+            limit_mb: 上限（MB），为空或不大于 0 时不限制
+        """
+        self.limit = int(limit_mb * 2 ** 20) if limit_mb and limit_mb > 0 else None
+        self.used = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limited(self) -> bool:
+        return self.limit is not None
+
+    def charge(self, size: int) -> None:
+        with self._lock:
+            self.used += size
+
+    def release(self, size: int) -> None:
+        with self._lock:
+            self.used = max(0, self.used - size)
+
+    def over(self) -> bool:
+        return self.limit is not None and self.used > self.limit
+
+
+def record_size(record: Dict) -> int:
+    """估算一条 JSON 记录在内存中的字节数，字符串按每字符 2 字节加对象开销估算"""
+    return sum(2 * len(str(k)) + 2 * len(str(v)) + 100 for k, v in record.items()) + 200
+
+
+class RecordStore:
+    """可超出内存上限后落盘的记录列表
+
+    按追加顺序保存 JSON 记录。预算超限时把最早的内存记录追加写入 JSONL 文件，
+    并记下每条的文件偏移；遍历时先从文件顺序读出已落盘的部分，再接上内存中的部分，
+    按下标访问时直接定位到对应行。没有上限时与普通列表一样全部留在内存中。
+    """
+
+    def __init__(self, spill_dir: Union[str, Path, None] = None, budget: Optional[MemoryBudget] = None,
+                 records: Iterable[Dict] = ()):
+        """初始化记录存储
+
+        Args:
+            spill_dir: 落盘文件所在目录，为空时不落盘
+            budget: 共用的内存上限
+            records: 初始记录
+        """
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.budget = budget or MemoryBudget()
+        self._memory: Deque[Dict] = deque()
+        self._sizes: Deque[int] = deque()
+        self._offsets: List[int] = []
+        self._path: Optional[Path] = None
+        self._file: Optional[IO] = None
+        self.extend(records)
+
+    @property
+    def spilled(self) -> int:
+        """已写到磁盘的记录数"""
+        return len(self._offsets)
+
+    def append(self, record: Dict) -> None:
+        size = record_size(record)
+        self._memory.append(record)
+        self._sizes.append(size)
+        self.budget.charge(size)
+        if self.budget.over() and self.spill_dir:
+            self._spill()
+
+    def extend(self, records: Iterable[Dict]) -> None:
+        for record in records:
+            self.append(record)
+
+    def __iadd__(self, records: Iterable[Dict]) -> "RecordStore":
+        self.extend(records)
+        return self
+
+    def _spill(self) -> None:
+        """把最早的内存记录写到磁盘，直到预算回到上限以内"""
+        if self._file is None:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            self._path = self.spill_dir / f"records_{uuid.uuid4().hex[:12]}.jsonl"
+            self._file = open(self._path, 'a+b')
+            logger.info(f"结果超出内存上限，开始写入 {self._path}")
+        self._file.seek(0, os.SEEK_END)
+        while self._memory and self.budget.over():
+            record = self._memory.popleft()
+            self._offsets.append(self._file.tell())
+            self._file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b"\n")
+            self.budget.release(self._sizes.popleft())
+        self._file.flush()
+
+    def _read_at(self, offset: int) -> Dict:
+        self._file.seek(offset)
+        return json.loads(self._file.readline())
+
+    def __len__(self) -> int:
+        return len(self._offsets) + len(self._memory)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __iter__(self) -> Iterator[Dict]:
+        # 先固定两部分的范围，遍历期间继续追加或落盘不会重复或漏掉记录
+        spilled, memory = len(self._offsets), list(self._memory)
+        if spilled:
+            self._file.flush()
+            # 单独打开一个句柄顺序读取，不影响追加和按下标访问
+            with open(self._path, 'rb') as f:
+                for _ in range(spilled):
+                    yield json.loads(f.readline())
+        yield from memory
+
+    def __getitem__(self, index: int) -> Dict:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("记录下标超出范围")
+        if index < len(self._offsets):
+            return self._read_at(self._offsets[index])
+        return self._memory[index - len(self._offsets)]
+
+    def clear(self) -> None:
+        """清空记录并删除落盘文件"""
+        self.budget.release(sum(self._sizes))
+        self._memory.clear()
+        self._sizes.clear()
+        self._offsets = []
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._path.unlink(missing_ok=True)
+            self._path = None
+
+    def __del__(self):
+        try:
+            self.clear()
+        except Exception:
+            pass
+
+
+class SpillablePair(dict):
+    """图片文本对，释放后的图片和字节在访问时从 image_path 重新读取"""
+
+    def __missing__(self, key):
+        if key in SPILLABLE_IMAGE_KEYS and dict.get(self, 'image_path'):
+            if key == 'image':
+                # 读完即关闭文件，不把打开的句柄交给调用方；只取尺寸时用 image_size
+                with Image.open(dict.__getitem__(self, 'image_path')) as image:
+                    return image.copy()
+            with open(dict.__getitem__(self, 'image_path'), 'rb') as f:
+                return f.read()
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    @property
+    def resident(self) -> bool:
+        """图片是否仍在内存中"""
+        return any(dict.__contains__(self, k) for k in SPILLABLE_IMAGE_KEYS)
+
+
+def image_size(pair: Dict) -> Tuple[int, int]:
+    """图片尺寸，图片已释放时使用释放前记下的尺寸，或只读取文件头
+
+    Args:
+        pair: 图片文本对
+
+    Returns:
+        Tuple[int, int]: (宽, 高)
+    """
+    image = dict.get(pair, 'image')
+    if image is not None:
+        return image.size
+    size = dict.get(pair, 'image_size')
+    if size is None:
+        with Image.open(pair['image_path']) as image:
+            size = image.size
+        dict.__setitem__(pair, 'image_size', size)
+    return tuple(size)
+
+
+def pair_size(pair: Dict) -> int:
+    """估算图片文本对占用的内存：已编码字节加解码后的像素"""
+    size = len(dict.get(pair, 'image_bytes') or b"")
+    image = dict.get(pair, 'image')
+    if image is not None:
+        size += image.width * image.height * len(image.getbands())
+    return size + record_size({'text': pair.get('text', "")})
+
+
+class ImageSpiller:
+    """超出内存上限时释放最早的图片
+
+    图片字节在处理时已写入临时目录（image_path），释放只需丢掉内存中的字节和解码结果，
+    之后访问时由 SpillablePair 从文件重新读取。
+    """
+
+    def __init__(self, budget: MemoryBudget):
+        self.budget = budget
+        self._resident: Deque[SpillablePair] = deque()
+        self._sizes: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.spilled = 0
+
+    def track(self, pair: Dict) -> SpillablePair:
+        """登记一个图片文本对，返回可释放的版本"""
+        if not isinstance(pair, SpillablePair):
+            pair = SpillablePair(pair)
+        if not self.budget.limited or not pair.get('image_path'):
+            return pair
+        size = pair_size(pair)
+        with self._lock:
+            self._resident.append(pair)
+            self._sizes[id(pair)] = size
+        self.budget.charge(size)
+        if self.budget.over():
+            self._spill()
+        return pair
+
+    def _spill(self) -> None:
+        with self._lock:
+            while self._resident and self.budget.over():
+                pair = self._resident.popleft()
+                # 记下尺寸，估算成本和选择细节时不必重新打开图片
+                image = dict.get(pair, 'image')
+                if image is not None:
+                    dict.__setitem__(pair, 'image_size', image.size)
+                for key in SPILLABLE_IMAGE_KEYS:
+                    dict.pop(pair, key, None)
+                self.budget.release(self._sizes.pop(id(pair), 0))
+                self.spilled += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self.budget.release(sum(self._sizes.values()))
+            self._resident.clear()
+            self._sizes.clear()
+            self.spilled = 0
+
+
+def write_json_array(records: Iterable[Dict], f: IO[str]) -> int:
+    """逐条写出 JSON 数组，输出与 json.dump(records, f, ensure_ascii=False, indent=2) 相同
+
+    Returns:
+        int: 写出的记录数
+    """
+    count = 0
+    for record in records:
+        body = json.dumps(record, ensure_ascii=False, indent=2).replace("\n", "\n  ")
+        f.write(("[\n  " if count == 0 else ",\n  ") + body)
+        count += 1
+    f.write("\n]" if count else "[]")
+    return count
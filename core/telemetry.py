@@ -0,0 +1,471 @@
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger("pretuning.trace")
+
+# 延迟类请求的默认分桶（秒），覆盖本地导出到慢速模型调用
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# LogRecord 自带的属性，其余属性视为 extra 传入的结构化字段
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def _label_key(names: Sequence[str], labels: Dict[str, str]) -> Tuple[str, ...]:
+    if set(labels) != set(names):
+        raise ValueError(f"标签应为 {list(names)}，实际为 {sorted(labels)}")
+    return tuple(str(labels[n]) for n in names)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """(指标名后缀, 标签串, 值) 列表"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{suffix}{labels} {value:g}" for suffix, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_label_key(self.label_names, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [("", _format_labels(self.label_names, k), v) for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值
+
+    除了直接 set/inc/dec，还可以用 add_source 注册取值函数，在抓取时才计算（例如队列长度），
+    同一组标签的多个来源相加。
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._sources: Dict[int, Tuple[Tuple[str, ...], Callable[[], float]]] = {}
+        self._source_ids = itertools.count()
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_label_key(self.label_names, labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels) -> Iterator[None]:
+        """进入时加一、退出时减一，用于统计进行中的请求数"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def add_source(self, fn: Callable[[], float], **labels) -> int:
+        """注册取值函数，返回用于 remove_source 的编号"""
+        key = _label_key(self.label_names, labels)
+        with self._lock:
+            source_id = next(self._source_ids)
+            self._sources[source_id] = (key, fn)
+        return source_id
+
+    def remove_source(self, source_id: int) -> None:
+        with self._lock:
+            self._sources.pop(source_id, None)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            sources = list(self._sources.values())
+        for key, fn in sources:
+            try:
+                values[key] = values.get(key, 0) + fn()
+            except Exception as e:
+                logger.debug(f"指标 {self.name} 取值失败: {str(e)}")
+        return [("", _format_labels(self.label_names, k), v) for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    """分桶统计的分布，用于延迟"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签: [各桶计数..., +Inf 计数, 总和]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(self.label_names, labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 2)
+            row[i] += 1
+            row[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            row = self._values.get(_label_key(self.label_names, labels))
+            return int(sum(row[:-1])) if row else 0
+
+    def samples(self):
+        result = []
+        with self._lock:
+            rows = [(k, list(v)) for k, v in self._values.items()]
+        for key, row in rows:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), row[:-1]):
+                cumulative += n
+                le = "+Inf" if bound == float('inf') else f"{bound:g}"
+                result.append(("_bucket", _format_labels(self.label_names, key, f'le="{le}"'), cumulative))
+            result.append(("_sum", _format_labels(self.label_names, key), row[-1]))
+            result.append(("_count", _format_labels(self.label_names, key), cumulative))
+        return result
+
+
+class Registry:
+    """指标注册表，render 输出 Prometheus 文本格式"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.label_names != metric.label_names:
+                    raise ValueError(f"指标 {metric.name} 已以不同类型或标签注册")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+API_LATENCY = REGISTRY.histogram("pretuning_api_request_seconds", "模型 API 单次请求耗时", ["kind", "outcome"])
+API_IN_FLIGHT = REGISTRY.gauge("pretuning_api_in_flight", "进行中的模型 API 请求数", ["kind"])
+API_RETRIES = REGISTRY.counter("pretuning_api_retries_total", "因临时错误重试的请求数", ["error"])
+API_RATE_LIMITED = REGISTRY.counter("pretuning_api_rate_limited_total", "被限流（HTTP 429）的请求数")
+QUEUE_DEPTH = REGISTRY.gauge("pretuning_queue_depth", "各队列中等待处理的条目数", ["queue"])
+ITEMS = REGISTRY.counter("pretuning_items_processed_total", "处理完成的条目数", ["kind", "outcome"])
+ITEMS_RATE = REGISTRY.gauge("pretuning_items_per_second", "最近一分钟的平均处理速度（条/秒）", ["kind"])
+SPAN_SECONDS = REGISTRY.histogram("pretuning_span_seconds", "各处理步骤耗时", ["span", "outcome"])
+API_TTFT = REGISTRY.histogram("pretuning_api_time_to_first_token_seconds", "流式请求收到第一个 token 的耗时",
+                              ["kind"])
+API_TOKENS_PER_SECOND = REGISTRY.histogram("pretuning_api_output_tokens_per_second", "单次请求的输出速度（token/秒）",
+                                           ["kind"], buckets=(1, 2.5, 5, 10, 20, 40, 80, 160, 320, 640))
+CASCADE_CALLS = REGISTRY.counter("pretuning_cascade_calls_total",
+                                 "模型级联中各阶段各模型的调用结果（accepted/escalated/rejected）",
+                                 ["stage", "model", "outcome"])
+
+
+class _Throughput:
+    """滑动窗口内的处理速度"""
+
+    def __init__(self, window: float = 60.0):
+        self.window = window
+        self._started = time.monotonic()
+        self._events: Deque[Tuple[float, int]] = deque()
+        self._lock = threading.Lock()
+
+    def add(self, n: int) -> None:
+        with self._lock:
+            self._events.append((time.monotonic(), n))
+
+    def rate(self) -> float:
+        now = time.monotonic()
+        cutoff = now - self.window
+        with self._lock:
+            while self._events and self._events[0][0] < cutoff:
+                self._events.popleft()
+            # 刚开始不足一个窗口时按实际经过的时间计算
+            return sum(n for _, n in self._events) / max(1.0, min(self.window, now - self._started))
+
+
+_throughput: Dict[str, _Throughput] = {}
+_throughput_lock = threading.Lock()
+
+
+def record_items(kind: str, n: int = 1, ok: bool = True) -> None:
+    """记录处理完成的条目，同时更新计数器和每秒条目数"""
+    ITEMS.inc(n, kind=kind, outcome="ok" if ok else "error")
+    with _throughput_lock:
+        meter = _throughput.get(kind)
+        if meter is None:
+            meter = _throughput[kind] = _Throughput()
+            ITEMS_RATE.add_source(meter.rate, kind=kind)
+    meter.add(n)
+
+
+def record_api_error(error: BaseException, retrying: bool) -> None:
+    """记录一次 API 错误：限流单独计数，将要重试的按错误类型计数"""
+    if getattr(error, 'status_code', None) == 429 or type(error).__name__ == "RateLimitError":
+        API_RATE_LIMITED.inc()
+    if retrying:
+        API_RETRIES.inc(error=type(error).__name__)
+
+
+# 当前线程 / 协程所在的 span，子 span 继承其 trace_id
+_current_span: contextvars.ContextVar = contextvars.ContextVar("pretuning_span", default=None)
+# span 开始和结束时的回调 fn(name, entering)，供性能分析等按步骤统计
+_span_listeners: List[Callable[[str, bool], None]] = []
+
+
+def child_thread_name(role: str) -> str:
+    """为当前线程派生的工作线程命名：<当前线程名>/<角色>
+
+    按名称前缀可以找出一个任务及其派生的所有线程，性能分析据此只统计该任务。
+
+    Args:
+        role: 工作线程的角色，如 pipeline-decode
+
+    Returns:
+        str: 线程名，也可作为 ThreadPoolExecutor 的 thread_name_prefix
+    """
+    return f"{threading.current_thread().name}/{role}"
+
+
+def in_thread_family(scope: str, name: Optional[str] = None) -> bool:
+    """线程名是否为 scope 本身或由其派生（见 child_thread_name）"""
+    name = threading.current_thread().name if name is None else name
+    return name == scope or name.startswith(scope + "/")
+
+
+def add_span_listener(fn: Callable[[str, bool], None]) -> None:
+    _span_listeners.append(fn)
+
+
+def remove_span_listener(fn: Callable[[str, bool], None]) -> None:
+    if fn in _span_listeners:
+        _span_listeners.remove(fn)
+
+
+def _notify(name: str, entering: bool) -> None:
+    for fn in list(_span_listeners):
+        try:
+            fn(name, entering)
+        except Exception as e:
+            logger.debug(f"span 回调失败: {str(e)}")
+
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[Dict]:
+    """记录一个处理步骤的耗时
+
+    耗时进入 pretuning_span_seconds 直方图；开启 DEBUG 级别的 pretuning.trace 日志时，
+    结束时输出一条带 trace_id/span_id/parent_id 的结构化记录，可按 trace_id 还原调用树。
+
+    Args:
+        name: 步骤名称，如 api.chat、agent.run、image.encode、export.parquet
+        attrs: 附加字段，也可以在 with 块中修改 yield 出的字典补充
+
+    Yields:
+        Dict: 本 span 的附加字段
+    """
+    parent = _current_span.get()
+    context = {
+        'trace_id': parent['trace_id'] if parent else uuid.uuid4().hex[:16],
+        'span_id': uuid.uuid4().hex[:8],
+    }
+    token = _current_span.set(context)
+    if _span_listeners:
+        _notify(name, True)
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield attrs
+    except BaseException as e:
+        outcome = "error"
+        attrs.setdefault('error', f"{type(e).__name__}: {str(e)[:200]}")
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current_span.reset(token)
+        if _span_listeners:
+            _notify(name, False)
+        SPAN_SECONDS.observe(duration, span=name, outcome=outcome)
+        if trace_logger.isEnabledFor(logging.DEBUG):
+            trace_logger.debug(f"{name} {duration * 1000:.1f}ms {outcome}", extra={
+                'span': name, 'duration_ms': round(duration * 1000, 3), 'outcome': outcome,
+                'parent_id': parent['span_id'] if parent else None, **context, **attrs
+            })
+
+
+def traced(name: str) -> Callable:
+    """把整个函数包在 span 中的装饰器，支持普通函数和协程函数"""
+    def decorator(fn: Callable) -> Callable:
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出一行 JSON，extra 传入的字段原样保留"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: str = "INFO", fmt: str = "text", trace: bool = False) -> None:
+    """配置根日志
+
+    Args:
+        level: 日志级别
+        fmt: text 为单行文本，json 为每行一个 JSON 对象，便于日志系统采集
+        trace: 是否输出每个 span 的结构化记录（DEBUG 级别）
+    """
+    handler = logging.StreamHandler()
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+    trace_logger.setLevel(logging.DEBUG if trace else logging.NOTSET)
+    # 第三方 HTTP 客户端的逐请求日志太多
+    for name in ("httpx", "httpcore", "openai"):
+        logging.getLogger(name).setLevel(max(root.level, logging.WARNING))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = REGISTRY
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1",
+                         registry: Optional[Registry] = None) -> Optional[ThreadingHTTPServer]:
+    """在后台线程中提供 /metrics，端口被占用时只记录警告
+
+    Args:
+        port: 监听端口
+        host: 监听地址，默认只监听本机
+        registry: 指标注册表，默认使用全局注册表
+
+    Returns:
+        Optional[ThreadingHTTPServer]: 服务器，启动失败时为 None
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {'registry': registry or REGISTRY})
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        logger.warning(f"指标服务启动失败 {host}:{port}: {str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"指标服务: http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,143 @@
+import json
+import re
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import logging
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from core.telemetry import traced
+
+logger = logging.getLogger(__name__)
+
+TEXT_SCHEMA = pa.schema([
+    ('instruction', pa.string()),
+    ('input', pa.string()),
+    ('output', pa.string()),
+    ('source_file', pa.string()),
+    ('chunk_offset', pa.int64()),
+    ('char_length', pa.int32()),
+    ('token_length', pa.int32()),
+])
+
+# 中日韩字符按每字一个 token 计，其余按连续的字母数字或标点切分
+_CJK_RANGES = '\u3400-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af'
+_CJK = re.compile(f'[{_CJK_RANGES}]')
+_OTHER = re.compile(f'[A-Za-z0-9]+|[^\\sA-Za-z0-9{_CJK_RANGES}]')
+
+
+def estimate_tokens(text: str) -> int:
+    """不依赖分词器粗略估算 token 数
+
+    中文每字约一个 token；英文单词和数字按每 4 个字符一个 token 估算。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    other = sum(max(1, len(m) // 4) for m in _OTHER.findall(text))
+    return cjk + other
+
+
+def text_rows(text_results: Iterable[Dict], chunk_meta: Optional[Iterable[Dict]] = None) -> Iterable[Dict]:
+    """把 text_results 与对应的分块元信息合并为带类型列的行"""
+    meta_iter = iter(chunk_meta) if chunk_meta is not None else None
+    for result in text_results:
+        meta = next(meta_iter, {}) if meta_iter is not None else {}
+        output = str(result.get('output', ''))
+        yield {
+            'instruction': str(result.get('instruction', '')),
+            'input': str(result.get('input', '')),
+            'output': output,
+            'source_file': meta.get('source_file'),
+            'chunk_offset': meta.get('chunk_offset'),
+            'char_length': len(output),
+            'token_length': estimate_tokens(output),
+        }
+
+
+def read_text_output(path: Union[str, Path], source_file: Optional[str] = None) -> Tuple[List[Dict], List[Dict]]:
+    """读回逐文件的增量输出（json、parquet 或 arrow）
+
+    Args:
+        path: 输出文件路径
+        source_file: JSON 输出不含分块元信息，元信息中的来源文件名使用该值
+
+    Returns:
+        Tuple[List[Dict], List[Dict]]: (text_results, chunk_meta)
+    """
+    path = Path(path)
+    if path.suffix == ".json":
+        with open(path, 'r', encoding='utf-8') as f:
+            results = json.load(f)
+        return results, [{'source_file': source_file, 'chunk_offset': None} for _ in results]
+    if path.suffix == ".arrow":
+        with pa.memory_map(str(path)) as source:
+            rows = pa.ipc.open_file(source).read_all().to_pylist()
+    else:
+        rows = pq.read_table(path).to_pylist()
+    results = [{'instruction': r['instruction'], 'input': r['input'], 'output': r['output']} for r in rows]
+    meta = [{'source_file': r['source_file'] or source_file, 'chunk_offset': r['chunk_offset']} for r in rows]
+    return results, meta
+
+
+class TextColumnarWriter:
+    """文本数据集的列式流式写入器
+
+    逐批把行写成 Parquet row group（或 Arrow IPC record batch），使用 zstd 压缩，
+    下游加载器可以只读取需要的列。
+    """
+
+    def __init__(self, output_path: Union[str, Path], export_format: str = "parquet",
+                 row_group_size: int = 8192, compression: str = "zstd"):
+        """初始化写入器
+
+        Args:
+            output_path: 输出文件路径
+            export_format: parquet 或 arrow
+            row_group_size: 每个 row group / record batch 的行数
+            compression: 压缩算法
+        """
+        if export_format not in ("parquet", "arrow"):
+            raise ValueError(f"不支持的导出格式: {export_format}")
+        self.output_path = Path(output_path).absolute()
+        self.export_format = export_format
+        self.row_group_size = max(1, row_group_size)
+        self.compression = compression
+
+    def _open(self, sink: str):
+        if self.export_format == "parquet":
+            return pq.ParquetWriter(sink, TEXT_SCHEMA, compression=self.compression)
+        options = pa.ipc.IpcWriteOptions(compression=self.compression)
+        return pa.ipc.new_file(sink, TEXT_SCHEMA, options=options)
+
+    @traced("export.text_columnar")
+    def write(self, rows: Iterable[Dict]) -> int:
+        """流式写出所有行
+
+        Args:
+            rows: 行生成器，字段与 TEXT_SCHEMA 一致
+
+        Returns:
+            int: 写出的行数
+        """
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        start = time.time()
+        count = 0
+        writer = self._open(str(self.output_path))
+        try:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= self.row_group_size:
+                    writer.write_table(pa.Table.from_pylist(batch, schema=TEXT_SCHEMA))
+                    count += len(batch)
+                    batch = []
+            if batch:
+                writer.write_table(pa.Table.from_pylist(batch, schema=TEXT_SCHEMA))
+                count += len(batch)
+        finally:
+            writer.close()
+        logger.info(f"写出 {count} 条文本记录到 {self.output_path}，耗时 {time.time() - start:.2f}s")
+        return count
@@ -1,26 +1,135 @@
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple, Union
 import json
 import time
 from tqdm import tqdm
-from pydantic_ai import Agent
-from pydantic_ai.models.openai import OpenAIModel
-import httpx
 import logging
 
+from core.cascade import record_cascade, validate
+from core.local_instructions import LocalInstructionGenerator, split_chunk
+from core.spill_store import MemoryBudget, RecordStore, write_json_array
+from core.telemetry import API_IN_FLIGHT, API_LATENCY, record_api_error, record_items, span, traced
+
 logger = logging.getLogger(__name__)
 
 
 class TextProcessor:
-    def __init__(self, api_handler=None):
+    # 预览最多列出的文本块数，其余只给出数量
+    PREVIEW_CHUNKS = 200
+    # 指令生成方式：llm 调用标题和格式化 agent，local 在本地按关键词生成且不调用 API
+    INSTRUCTION_MODES = ("llm", "local")
+    # 本地切块的最大字符数，约对应文本分析提示词中的 1000 token
+    LOCAL_CHUNK_CHARS = 1500
+    # 同一文件中连续出错达到该次数后视为 API 不可用，其余文本块改为本地处理
+    API_FAILURE_LIMIT = 3
+    # 各 agent 内置的系统提示词，更新提示词时未提供的阶段沿用
+    ANALYZER_PROMPT = """你是文本分析专家。
+                你的任务是分析输入的文本，在接近1000个token的位置找到合适的语义断点，这个断点应该尽量保持段落或语义的完整性。
+                
+                要求：
+                1. 寻找最接近1000 token处的语义完整位置
+                2. 优先在段落结束处断开
+                3. 返回从开始到断点的完整文本
+                4. 关注语义连贯性，不要在句子中间断开
+                
+                直接返回这段完整的文本。"""
+    TITLE_PROMPT = """你是标题生成专家。
+                为文本生成简短的instruction，要求：
+                1. 长度控制在10个字以内
+                2. 直接概括文本核心主题
+                3. 避免过度解释或分析
+
+                直接返回标题文本。"""
+    FORMAT_PROMPT = """你是格式化专家。
+                请将提供的标题和原文按以下格式组织成JSON（直接返回 JSON，不要包含任何其他标记）：
+                {
+                    "instruction": "标题",
+                    "input": "",
+                    "output": "原文"
+                }
+                
+                注意：
+                1. 严格按照格式输出
+                2. 保持原文完整
+                3. 只返回纯 JSON 字符串，不要包含 markdown 代码块标记
+                4. 确保 JSON 中的换行使用 \n
+                """
+
+    def __init__(self, api_handler=None, spill_dir: Union[str, Path, None] = None,
+                 budget: Optional[MemoryBudget] = None):
+        """初始化文本处理器
+
+        Args:
+            api_handler: API 处理器
+            spill_dir: 结果超出内存上限时的落盘目录
+            budget: 与图片共用的内存上限，为空时不限制
+        """
         self.api_handler = api_handler
-        self.text_results = []
+        self.text_results = RecordStore(spill_dir, budget)
+        # 与 text_results 一一对应的分块元信息（来源文件、在原文中的偏移）
+        self.chunk_meta = RecordStore(spill_dir, budget)
+        self.instruction_mode = "llm"
+        # 本地指令生成器的语料统计在多个文件之间累积复用
+        self.local_generator = LocalInstructionGenerator()
+        self._api_failures = 0
+        self._unfitted: List[str] = []
+        # 连接和 agents 在开始处理（进入上下文或更新提示词）时才创建
+        self.reset_agents()
+
+    def reset_agents(self):
+        """丢弃已创建的连接和 agents，下次进入上下文时按当前 API 配置重建"""
         self.http_client = None
         self.model = None
-        self._initialize_agents()
+        # 级联中用到的模型实例，按模型名称缓存，共用 http_client
+        self._models = {}
+        self.analyzer_agent = None
+        self.title_agent = None
+        self.format_agent = None
+
+    def set_instruction_mode(self, mode: str) -> None:
+        """设置指令生成方式
+
+        Args:
+            mode: llm 或 local
+        """
+        if mode not in self.INSTRUCTION_MODES:
+            raise ValueError(f"未知的指令生成方式: {mode}")
+        self.instruction_mode = mode
+
+    def _use_api(self) -> bool:
+        """本次是否调用 agent：本地模式、未配置 API 或 API 连续出错时都不调用"""
+        return (self.instruction_mode != "local"
+                and all([self.analyzer_agent, self.title_agent, self.format_agent])
+                and self._api_failures < self.API_FAILURE_LIMIT)
+
+    def _api_failed(self, error: Exception) -> None:
+        self._api_failures += 1
+        if self._api_failures == self.API_FAILURE_LIMIT:
+            logger.warning(f"API 连续 {self._api_failures} 次出错（{error}），本文件其余文本块改为本地处理")
+
+    def _local_record(self, paragraph: str) -> Dict:
+        """在本地为文本块生成记录，首次使用前把本文件的文本块计入语料统计"""
+        if self._unfitted:
+            self.local_generator.fit(self._unfitted)
+            self._unfitted = []
+        record_items("local_instruction")
+        return self.local_generator.record(paragraph)
+
+    async def _split(self, content: str) -> str:
+        """从剩余文本开头切出一块，API 不可用时在本地切分"""
+        if self._use_api():
+            try:
+                result = await self._run_agent("splitter", self.analyzer_agent, content, stage="analyzer")
+                self._api_failures = 0
+                return result.data
+            except Exception as e:
+                logger.error(f"文本分块出错，改为本地切分: {str(e)}")
+                self._api_failed(e)
+        return split_chunk(content, self.LOCAL_CHUNK_CHARS)
 
     async def __aenter__(self):
-        if not self.http_client or self.http_client.is_closed:
+        # 本地模式不调用 API，不需要建立连接
+        if self.instruction_mode != "local" and (not self.http_client or self.http_client.is_closed):
             self._initialize_agents()  
         return self
 
@@ -37,6 +146,11 @@ class TextProcessor:
                 self.format_agent = None
                 return
 
+            # pydantic_ai 导入较慢，配置好 API 后才需要
+            from pydantic_ai import Agent
+            from pydantic_ai.models.openai import OpenAIModel
+            import httpx
+
             # 创建 HTTP 客户端
             self.http_client = httpx.AsyncClient(
                 base_url=self.api_handler.config.base_url,
@@ -47,54 +161,28 @@ class TextProcessor:
             # 创建 OpenAI 模型实例
             self.model = OpenAIModel(
                 self.api_handler.config.model,
+                base_url=self.api_handler.config.base_url,
                 api_key=self.api_handler.config.api_key,
                 http_client=self.http_client
             )
+            self._models = {self.api_handler.config.model: self.model}
 
             # 创建 agents
             self.analyzer_agent = Agent(
                 self.model,
-                system_prompt="""你是文本分析专家。
-                你的任务是分析输入的文本，在接近1000个token的位置找到合适的语义断点，这个断点应该尽量保持段落或语义的完整性。
-                
-                要求：
-                1. 寻找最接近1000 token处的语义完整位置
-                2. 优先在段落结束处断开
-                3. 返回从开始到断点的完整文本
-                4. 关注语义连贯性，不要在句子中间断开
-                
-                直接返回这段完整的文本。""",
+                system_prompt=self.ANALYZER_PROMPT,
                 result_type=str
             )
 
             self.title_agent = Agent(
                 self.model,
-                system_prompt="""你是标题生成专家。
-                为文本生成简短的instruction，要求：
-                1. 长度控制在10个字以内
-                2. 直接概括文本核心主题
-                3. 避免过度解释或分析
-
-                直接返回标题文本。""",
+                system_prompt=self.TITLE_PROMPT,
                 result_type=str
             )
 
             self.format_agent = Agent(
             self.model,
-            system_prompt="""你是格式化专家。
-                请将提供的标题和原文按以下格式组织成JSON（直接返回 JSON，不要包含任何其他标记）：
-                {
-                    "instruction": "标题",
-                    "input": "",
-                    "output": "原文"
-                }
-                
-                注意：
-                1. 严格按照格式输出
-                2. 保持原文完整
-                3. 只返回纯 JSON 字符串，不要包含 markdown 代码块标记
-                4. 确保 JSON 中的换行使用 \n
-                """,
+            system_prompt=self.FORMAT_PROMPT,
                 result_type=str
             )
             
@@ -104,14 +192,17 @@ class TextProcessor:
             logger.error(f"Failed to initialize agents: {e}")
             raise
 
-    async def update_prompts(self, analyzer_prompt: str, title_prompt: str, format_prompt: str):
+    async def update_prompts(self, analyzer_prompt: Optional[str], title_prompt: Optional[str],
+                             format_prompt: Optional[str]):
+        """按新的提示词重建 agents，为空的阶段使用内置提示词"""
         try:
-            print("开始更新提示词...")
+            logger.debug("开始更新提示词")
             if not self.api_handler:
                 raise Exception("请先配置API设置")
             
-            if not self.model:
-                raise Exception("Model未初始化")
+            from pydantic_ai import Agent
+            from pydantic_ai.models.openai import OpenAIModel
+            import httpx
 
             # 关闭现有连接
             if self.http_client:
@@ -127,67 +218,123 @@ class TextProcessor:
             # 重新创建模型实例
             self.model = OpenAIModel(
                 self.api_handler.config.model,
+                base_url=self.api_handler.config.base_url,
                 api_key=self.api_handler.config.api_key,
                 http_client=self.http_client
             )
+            self._models = {self.api_handler.config.model: self.model}
 
-            print("更新analyzer agent...")
+            logger.debug("更新analyzer agent")
             self.analyzer_agent = Agent(
                 self.model,
-                system_prompt=analyzer_prompt.strip(),
+                system_prompt=(analyzer_prompt or "").strip() or self.ANALYZER_PROMPT,
                 result_type=str
             )
             
-            print("更新title agent...")
+            logger.debug("更新title agent")
             self.title_agent = Agent(
                 self.model,
-                system_prompt=title_prompt.strip(),
+                system_prompt=(title_prompt or "").strip() or self.TITLE_PROMPT,
                 result_type=str
             )
             
-            print("更新format agent...")
+            logger.debug("更新format agent")
             self.format_agent = Agent(
                 self.model,
-                system_prompt=format_prompt.strip(),
+                system_prompt=(format_prompt or "").strip() or self.FORMAT_PROMPT,
                 result_type=str
             )
             
-            print("所有提示词更新完成")
+            logger.info("所有提示词更新完成")
             
         except Exception as e:
             import traceback
-            print(f"更新提示词失败: {str(e)}")
-            print(traceback.format_exc())
+            logger.error(f"更新提示词失败: {str(e)}\n{traceback.format_exc()}")
             raise
 
-    async def process_paragraph(self, paragraph: str) -> Dict:
+    def _model_for(self, name: str):
+        """返回指定名称的模型实例，与默认模型共用连接"""
+        if name not in self._models:
+            from pydantic_ai.models.openai import OpenAIModel
+            self._models[name] = OpenAIModel(
+                name,
+                base_url=self.api_handler.config.base_url,
+                api_key=self.api_handler.config.api_key,
+                http_client=self.http_client
+            )
+        return self._models[name]
+
+    async def _call_agent(self, name: str, agent, prompt: str, model: str):
+        """用指定模型运行一次 agent，记录 span、请求耗时和错误"""
+        start = time.perf_counter()
+        outcome = "ok"
         try:
-            if not all([self.analyzer_agent, self.title_agent, self.format_agent]):
-                raise Exception("请先配置API设置")
+            with span("agent.run", agent=name, model=model, chars=len(prompt)), API_IN_FLIGHT.track(kind="agent"):
+                return await agent.run(prompt, model=self._model_for(model))
+        except Exception as e:
+            outcome = type(e).__name__
+            record_api_error(e, False)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - start, kind="agent", outcome=outcome)
+
+    async def _run_agent(self, name: str, agent, prompt: str, stage: Optional[str] = None,
+                         source: Optional[str] = None):
+        """按阶段配置的模型级联运行 agent
+
+        先用排在前面的模型，请求出错或结果未通过该阶段的校验时升级到下一个模型；
+        最后一个模型出错时抛出异常，结果未通过校验时照常返回。
 
-            print("开始分析文本...")
-            analysis = await self.analyzer_agent.run(paragraph)
-            print(f"分析结果: {analysis.data[:100]}...")
+        Args:
+            name: agent 名称，用于 span
+            agent: 要运行的 agent
+            prompt: 用户提示词
+            stage: 处理阶段，为空时与 name 相同
+            source: 校验用的原文，为空时与 prompt 相同
+
+        Returns:
+            agent 的运行结果
+        """
+        stage = stage or name
+        source = prompt if source is None else source
+        models = self.api_handler.config.models_for(stage)
+        for i, model in enumerate(models):
+            final = i == len(models) - 1
+            try:
+                result = await self._call_agent(name, agent, prompt, model)
+            except Exception as e:
+                if final:
+                    raise
+                record_cascade(stage, model, type(e).__name__, final)
+                continue
+            if record_cascade(stage, model, validate(stage, result.data, source), final) != "escalated":
+                return result
 
-            print("生成标题...")
-            title = await self.title_agent.run(paragraph)
-            print(f"生成的标题: {title.data}")
+    async def process_paragraph(self, paragraph: str) -> Dict:
+        if not self._use_api():
+            record_items("text_chunk")
+            return self._local_record(paragraph)
+        try:
+            title = await self._run_agent("title", self.title_agent, paragraph)
+            logger.debug(f"生成的标题: {title.data}")
 
-            print("格式化结果...")
             prompt = f"""
             标题：{title.data}
             原文：{paragraph}
             请按指定格式生成JSON。
             """
-            formatted = await self.format_agent.run(prompt)
-            print(f"格式化完成: {formatted.data[:100]}...")
+            formatted = await self._run_agent("format", self.format_agent, prompt, source=paragraph)
+            self._api_failures = 0
 
             try:
                 # 移除可能存在的 markdown 标记
                 json_str = formatted.data.replace('```json', '').replace('```', '').strip()
-                return json.loads(json_str)
+                result = json.loads(json_str)
+                record_items("text_chunk")
+                return result
             except json.JSONDecodeError as e:
-                print(f"JSON 解析错误: {e}")
+                logger.warning(f"格式化结果不是合法 JSON，使用标题和原文: {e}")
+                record_items("text_chunk")
                 return {
                     "instruction": title.data if title and hasattr(title, 'data') else "待处理文本",
                     "input": "",
@@ -195,66 +342,90 @@ class TextProcessor:
                 }
                 
         except Exception as e:
-            print(f"处理段落出错: {str(e)}")
-            return {
-                "instruction": "待处理文本",
-                "input": "",
-                "output": paragraph
-            }
-
-    async def process_file(self, content: str) -> Tuple[str, str]:
+            logger.error(f"处理段落出错，改用本地生成的指令: {str(e)}")
+            self._api_failed(e)
+            record_items("text_chunk", ok=False)
+            return self._local_record(paragraph)
+
+    @traced("text.process_file")
+    async def process_file(self, content: str, source_file: str = None) -> Tuple[str, str]:
+        # 先清空上一个文件的结果，提前返回时调用方不会把旧结果当作本文件的输出
+        self.text_results.clear()
+        self.chunk_meta.clear()
         try:
-            if not self.model:
-                print("错误: model未初始化")
+            if not self.model and self.instruction_mode != "local":
+                logger.error("model未初始化")
                 return "", "请先配置API设置"
 
-            print(f"开始处理文件，内容长度: {len(content)}")
-            print("文件内容前100字符:")
-            print(content[:100])
+            logger.info(f"开始处理文件 {source_file}，内容长度: {len(content)}")
 
-            # 使用分块 agent 处理文本
-            current_content = content
+            # 使用分块 agent 处理文本，空白文件不产生文本块
+            current_content = content.strip()
             paragraphs = []
+            offsets = []
+            offset = len(content) - len(content.lstrip())
+            self._api_failures = 0
             
             while len(current_content) > 100:  # 设置最小长度阈值
-                result = await self.analyzer_agent.run(current_content)
-                split_text = result.data
+                split_text = await self._split(current_content)
                 
                 if not split_text or len(split_text) < 50:  # 防止过短分割
                     break
                     
                 paragraphs.append(split_text)
+                offsets.append(offset)
                 # 更新剩余内容
-                current_content = current_content[len(split_text):].strip()
+                remaining = current_content[len(split_text):]
+                offset += len(split_text) + len(remaining) - len(remaining.lstrip())
+                current_content = remaining.strip()
             
             # 处理剩余内容
             if current_content:
                 paragraphs.append(current_content)
+                offsets.append(offset)
 
             if not paragraphs:
                 return "", "未找到有效文本块"
 
-            self.text_results = []
-            preview = ""
+            preview = []
+            if self.instruction_mode == "local":
+                # 整个文件的文本块先计入语料统计，每块的候选词只统计一次
+                instructions = self.local_generator.fit_instructions(paragraphs)
+                record_items("local_instruction", len(paragraphs))
+            else:
+                # 出错改为本地生成时才统计语料
+                self._unfitted = paragraphs
             
             for i, paragraph in enumerate(paragraphs, 1):
-                result = await self.process_paragraph(paragraph)
+                if self.instruction_mode == "local":
+                    result = {"instruction": instructions[i - 1], "input": "", "output": paragraph}
+                    record_items("text_chunk")
+                else:
+                    result = await self.process_paragraph(paragraph)
                 self.text_results.append(result)
-                preview += f"=== 文本块 {i} ===\n"
-                preview += f"指令: {result.get('instruction', '待处理')}\n"
-                preview += f"输出: {result.get('output', paragraph)[:100]}...\n\n"
+                self.chunk_meta.append({'source_file': source_file, 'chunk_offset': offsets[i - 1]})
+                # 预览只保留前面的文本块，大文件不会在内存中累积整份预览
+                if i <= self.PREVIEW_CHUNKS:
+                    preview.append(f"=== 文本块 {i} ===\n"
+                                   f"指令: {result.get('instruction', '待处理')}\n"
+                                   f"输出: {result.get('output', paragraph)[:100]}...\n\n")
             
-            return preview, "处理完成"
+            if len(paragraphs) > self.PREVIEW_CHUNKS:
+                preview.append(f"... 其余 {len(paragraphs) - self.PREVIEW_CHUNKS} 个文本块未列出\n")
+            self._unfitted = []
+            if self.text_results.spilled:
+                logger.info(f"{self.text_results.spilled} 条结果超出内存上限，已写入磁盘")
+            return "".join(preview), "处理完成"
                 
         except Exception as e:
-            print(f"处理文件出错: {str(e)}")
+            logger.error(f"处理文件出错: {str(e)}")
             return "", f"处理失败: {str(e)}"
 
             
     def save_dataset(self, output_path: str) -> str:
         try:
             if not self.text_results:
-                print("没有可保存的数据")
+                logger.info("没有可保存的数据")
                 return "没有可保存的数据"
             
             # 使用 os.path 处理路径
@@ -264,21 +435,19 @@ class TextProcessor:
             os.makedirs(output_dir, exist_ok=True)
             
             # 保存文件
-            print(f"保存数据集到: {output_path}")
-            print(f"数据条数: {len(self.text_results)}")
+            logger.info(f"保存数据集到: {output_path}")
+            logger.debug(f"数据条数: {len(self.text_results)}")
             
             try:
                 with open(output_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.text_results, f, ensure_ascii=False, indent=2)
-                print(f"成功保存 {len(self.text_results)} 条数据")
+                    write_json_array(self.text_results, f)
+                logger.info(f"成功保存 {len(self.text_results)} 条数据")
                 return f"已保存 {len(self.text_results)} 条数据到 {output_path}"
                 
             except Exception as e:
-                print(f"写入文件失败: {str(e)}")
+                logger.error(f"写入文件失败: {str(e)}")
                 return f"保存失败: {str(e)}"
                 
         except Exception as e:
-            import traceback
-            print(f"保存数据集失败: {str(e)}")
-            print(traceback.format_exc())
+            logger.exception(f"保存数据集失败: {str(e)}")
             return f"保存失败: {str(e)}"
\ No newline at end of file
@@ -0,0 +1,209 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import logging
+
+import numpy as np
+
+from core.sequence_packing import sample_text
+from core.telemetry import traced
+
+logger = logging.getLogger(__name__)
+
+# .idx 文件头：魔数、版本、token 类型码、样本数，之后是 int64 的 token 偏移（样本数 + 1 个）
+IDX_MAGIC = b'PRETOKEN'
+IDX_VERSION = 1
+_DTYPES = {1: np.uint16, 2: np.uint32}
+_DTYPE_CODES = {np.dtype(v): k for k, v in _DTYPES.items()}
+_HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('dtype', '<u4'), ('count', '<u8')])
+
+# 工作进程内的分词器，由 _init_worker 加载一次
+_tokenizer = None
+
+
+def _load_tokenizer(tokenizer_path: str):
+    try:
+        from tokenizers import Tokenizer
+    except ImportError:
+        raise ImportError("预分词导出需要安装 tokenizers: pip install tokenizers")
+    return Tokenizer.from_file(tokenizer_path)
+
+
+def _init_worker(tokenizer_path: str) -> None:
+    global _tokenizer
+    # 并行由进程池负责，关闭分词器自身的线程池以免超额占用 CPU
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _tokenizer = _load_tokenizer(tokenizer_path)
+
+
+def _encode_chunk(args: Tuple[List[str], Optional[int], str]) -> Tuple[np.ndarray, np.ndarray]:
+    """在工作进程中分词一批文本，返回拼接后的 token 和每条的长度"""
+    texts, eos_id, dtype = args
+    encodings = _tokenizer.encode_batch(texts, add_special_tokens=False)
+    ids = [e.ids + [eos_id] if eos_id is not None else e.ids for e in encodings]
+    lengths = np.fromiter((len(x) for x in ids), dtype=np.int64, count=len(ids))
+    tokens = np.fromiter((t for x in ids for t in x), dtype=dtype, count=int(lengths.sum()))
+    return tokens, lengths
+
+
+def _iter_tasks(records: Iterable[Dict], chunk_size: int, eos_id: Optional[int],
+                dtype: str) -> Iterator[Tuple[List[str], Optional[int], str]]:
+    """逐批取出样本文本，不一次性展开整个语料"""
+    texts = []
+    for record in records:
+        texts.append(sample_text(record))
+        if len(texts) >= chunk_size:
+            yield texts, eos_id, dtype
+            texts = []
+    if texts:
+        yield texts, eos_id, dtype
+
+
+def token_dtype(vocab_size: int) -> np.dtype:
+    """词表小于 65536 时用 uint16，否则用 uint32"""
+    return np.dtype(np.uint16 if vocab_size < 65536 else np.uint32)
+
+
+def _write_index(idx_path: Path, offsets: np.ndarray, dtype: np.dtype) -> None:
+    header = np.zeros(1, dtype=_HEADER)
+    header[0] = (IDX_MAGIC, IDX_VERSION, _DTYPE_CODES[np.dtype(dtype)], len(offsets) - 1)
+    tmp_path = idx_path.with_name(f".{idx_path.name}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(offsets.astype('<i8').tobytes())
+    os.replace(tmp_path, idx_path)
+
+
+@traced("export.tokens")
+def export_token_memmap(records: List[Dict], output_prefix: Union[str, Path], tokenizer_path: str,
+                        workers: Optional[int] = None, chunk_size: int = 1024,
+                        eos_token: Optional[str] = None) -> Dict:
+    """用本地分词器文件预分词并写出 .bin/.idx
+
+    .bin 是所有样本 token 首尾相连的扁平数组，.idx 记录每个样本的起止偏移，
+    训练时直接内存映射即可随机访问任意样本，无需解析 JSON 或重新分词。
+
+    Args:
+        records: instruction/input/output 记录
+        output_prefix: 输出路径前缀，生成 <prefix>.bin 和 <prefix>.idx
+        tokenizer_path: tokenizers 格式的 tokenizer.json 路径
+        workers: 分词进程数，默认使用 CPU 核数
+        chunk_size: 每个任务分词的样本数
+        eos_token: 追加在每个样本末尾的结束符，为空时不追加
+
+    Returns:
+        Dict: 样本数、token 数、token 类型、耗时等统计
+    """
+    output_prefix = Path(output_prefix).absolute()
+    output_prefix.parent.mkdir(parents=True, exist_ok=True)
+    bin_path = output_prefix.with_name(output_prefix.name + ".bin")
+    idx_path = output_prefix.with_name(output_prefix.name + ".idx")
+    start = time.time()
+
+    tokenizer = _load_tokenizer(tokenizer_path)
+    dtype = token_dtype(tokenizer.get_vocab_size())
+    eos_id = None
+    if eos_token:
+        eos_id = tokenizer.token_to_id(eos_token)
+        if eos_id is None:
+            raise ValueError(f"分词器中不存在结束符: {eos_token}")
+
+    tasks = _iter_tasks(records, chunk_size, eos_id, dtype.str)
+    n_tasks = -(-len(records) // chunk_size)
+    workers = min(workers or os.cpu_count() or 1, max(1, n_tasks))
+
+    lengths = []
+    tmp_bin = bin_path.with_name(f".{bin_path.name}.tmp")
+    with open(tmp_bin, 'wb') as f:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(str(tokenizer_path),)) as executor:
+                # 最多同时提交 2 倍进程数的批次，按提交顺序取结果，样本顺序与 records 一致，
+                # 语料落盘时内存中也只有这几批文本
+                pending = deque()
+                for task in tasks:
+                    pending.append(executor.submit(_encode_chunk, task))
+                    if len(pending) >= workers * 2:
+                        tokens, chunk_lengths = pending.popleft().result()
+                        f.write(tokens.tobytes())
+                        lengths.append(chunk_lengths)
+                while pending:
+                    tokens, chunk_lengths = pending.popleft().result()
+                    f.write(tokens.tobytes())
+                    lengths.append(chunk_lengths)
+        else:
+            global _tokenizer
+            _tokenizer = tokenizer
+            for task in tasks:
+                tokens, chunk_lengths = _encode_chunk(task)
+                f.write(tokens.tobytes())
+                lengths.append(chunk_lengths)
+    os.replace(tmp_bin, bin_path)
+
+    lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    _write_index(idx_path, offsets, dtype)
+
+    stats = {
+        'samples': len(lengths),
+        'tokens': int(offsets[-1]),
+        'dtype': dtype.name,
+        'bin_path': str(bin_path),
+        'idx_path': str(idx_path),
+        'seconds': time.time() - start,
+    }
+    logger.info(f"预分词 {stats['samples']} 个样本共 {stats['tokens']} 个 token（{dtype.name}），"
+                f"耗时 {stats['seconds']:.2f}s")
+    return stats
+
+
+class TokenMemmapDataset:
+    """预分词数据集的只读访问
+
+    打开时只读取 .idx 并内存映射 .bin，取样本返回 numpy 视图，不拷贝也不解析。
+    """
+
+    def __init__(self, prefix: Union[str, Path]):
+        """打开数据集
+
+        Args:
+            prefix: export_token_memmap 使用的输出前缀
+        """
+        prefix = Path(prefix)
+        idx_path = prefix.with_name(prefix.name + ".idx")
+        header = np.fromfile(idx_path, dtype=_HEADER, count=1)[0]
+        if header['magic'] != IDX_MAGIC:
+            raise ValueError(f"不是预分词索引文件: {idx_path}")
+        if header['version'] != IDX_VERSION:
+            raise ValueError(f"不支持的索引版本: {header['version']}")
+        self.dtype = np.dtype(_DTYPES[int(header['dtype'])])
+        self.offsets = np.memmap(idx_path, dtype='<i8', mode='r', offset=_HEADER.itemsize,
+                                 shape=(int(header['count']) + 1,))
+        bin_path = prefix.with_name(prefix.name + ".bin")
+        # 空文件无法内存映射
+        if self.offsets[-1]:
+            self.tokens = np.memmap(bin_path, dtype=self.dtype, mode='r')
+        else:
+            self.tokens = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"下标超出范围: {i}")
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def num_tokens(self) -> int:
+        return int(self.offsets[-1])
+
+    def lengths(self) -> np.ndarray:
+        """每个样本的 token 数"""
+        return np.diff(self.offsets)
@@ -0,0 +1,162 @@
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+import logging
+
+from core.dataset_verifier import file_sha256, record_checksum
+from core.file_handler import directory_lock
+from core.telemetry import child_thread_name
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "shards.json"
+
+
+def _add_member(tar: tarfile.TarFile, name: str, data: bytes, mtime: float) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = mtime
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+class TarShardWriter:
+    """WebDataset 格式的 tar 分片写入器
+
+    每个样本写成同一 key 的一组文件：{key}.jpg/png 为原始图片字节，{key}.txt 为描述，
+    {key}.json 为元信息。训练时按分片顺序读取即可，不需要随机访问或解析目录。
+    分片在线程池中并行写出，同时在内存中的分片不超过 max_workers + 1 个。
+
+    与 ParquetShardWriter 相同，分片文件名带索引版本号，重新导出不会覆盖已有分片：
+    新分片写完后替换索引，再删除新索引不再引用的分片；整个写入过程持有目录锁。
+    """
+
+    def __init__(self, output_dir: str, samples_per_shard: int = 1000,
+                 max_shard_bytes: int = 256 * 1024 * 1024, max_workers: int = 4):
+        """初始化写入器
+
+        Args:
+            output_dir: 输出目录
+            samples_per_shard: 每个分片的最大样本数
+            max_shard_bytes: 每个分片缓冲的最大图片字节数
+            max_workers: 并行写出分片的线程数
+        """
+        self.output_dir = Path(output_dir).absolute()
+        self.samples_per_shard = max(1, samples_per_shard)
+        self.max_shard_bytes = max_shard_bytes
+        self.max_workers = max(1, max_workers)
+
+    def _write_shard(self, version: int, shard_index: int, samples: List[Dict]) -> Dict:
+        filename = f"shard-v{version:05d}-{shard_index:05d}.tar"
+        tmp_path = self.output_dir / f".{filename}.tmp"
+        mtime = time.time()
+        with tarfile.open(tmp_path, 'w', format=tarfile.USTAR_FORMAT) as tar:
+            for sample in samples:
+                key = sample['key']
+                meta = {
+                    'key': key,
+                    'source': sample.get('image_path'),
+                    'image_format': sample['ext'],
+                    'image_crc32': record_checksum(sample['image_bytes']),
+                }
+                _add_member(tar, f"{key}.{sample['ext']}", sample['image_bytes'], mtime)
+                _add_member(tar, f"{key}.txt", sample['text'].encode('utf-8'), mtime)
+                _add_member(tar, f"{key}.json", json.dumps(meta, ensure_ascii=False).encode('utf-8'), mtime)
+        os.replace(tmp_path, self.output_dir / filename)
+        return {
+            'file': filename,
+            'num_samples': len(samples),
+            'first_key': samples[0]['key'],
+            'last_key': samples[-1]['key'],
+            'bytes': (self.output_dir / filename).stat().st_size,
+            'sha256': file_sha256(self.output_dir / filename)
+        }
+
+    def load_index(self) -> Optional[Dict]:
+        """读取输出目录中已有的分片索引，不存在时返回 None"""
+        index_file = self.output_dir / INDEX_FILE
+        if not index_file.exists():
+            return None
+        with open(index_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _commit_index(self, index: Dict) -> None:
+        tmp_file = self.output_dir / f".{INDEX_FILE}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.output_dir / INDEX_FILE)
+
+    def write(self, records: Iterable[Dict]) -> Dict:
+        """写出所有记录
+
+        Args:
+            records: 记录生成器，每条包含 image_bytes、image_path 和 text
+
+        Returns:
+            Dict: 分片索引，包含各分片文件名、样本数、字节数和 SHA-256
+        """
+        with directory_lock(str(self.output_dir)):
+            return self._write_locked(records)
+
+    def _write_locked(self, records: Iterable[Dict]) -> Dict:
+        start = time.time()
+        previous = self.load_index()
+        version = (previous.get('version', 0) + 1) if previous else 1
+        slots = threading.Semaphore(self.max_workers)
+        futures: List[Future] = []
+
+        def submit(executor, samples):
+            slots.acquire()
+            future = executor.submit(self._write_shard, version, len(futures), samples)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix=child_thread_name("wds-shard")) as executor:
+            samples = []
+            buffered = 0
+            for i, record in enumerate(records):
+                ext = Path(record.get('image_path') or '').suffix.lstrip('.').lower() or 'png'
+                samples.append({
+                    'key': f"{i:09d}",
+                    'ext': 'jpg' if ext == 'jpeg' else ext,
+                    'image_bytes': record['image_bytes'],
+                    'image_path': record.get('image_path'),
+                    'text': record['text']
+                })
+                buffered += len(record['image_bytes'])
+                if len(samples) >= self.samples_per_shard or buffered >= self.max_shard_bytes:
+                    submit(executor, samples)
+                    samples = []
+                    buffered = 0
+            if samples:
+                submit(executor, samples)
+            shards = [f.result() for f in futures]
+
+        index = {
+            'format': 'webdataset',
+            'version': version,
+            'updated_at': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'num_samples': sum(s['num_samples'] for s in shards),
+            # webdataset / torchdata 可直接使用的花括号路径
+            'urls': f"shard-v{version:05d}-{{00000..{len(shards) - 1:05d}}}.tar" if shards else "",
+            'shards': shards
+        }
+        self._commit_index(index)
+
+        # 索引替换后再删除不再引用的分片，包括上一次导出的分片和此前中断的写入留下的分片
+        current = {s['file'] for s in shards}
+        for stale in self.output_dir.glob("shard-*.tar"):
+            if stale.name not in current:
+                stale.unlink(missing_ok=True)
+        logger.info(f"写出 {index['num_samples']} 个样本到 {len(shards)} 个 tar 分片，"
+                    f"耗时 {time.time() - start:.2f}s")
+        return index
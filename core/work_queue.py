@@ -0,0 +1,374 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import logging
+
+from core.telemetry import QUEUE_DEPTH, child_thread_name, record_items
+
+logger = logging.getLogger(__name__)
+
+DB_FILE = "queue.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    key TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_token TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS items_state_seq ON items (state, seq);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+@dataclass
+class WorkItem:
+    """一个已租用的工作项"""
+    id: int
+    seq: int
+    key: str
+    payload: Dict
+    lease_token: str
+    attempts: int
+
+
+def default_worker_id() -> str:
+    """主机名加进程号，便于在状态中看出是哪台机器上的哪个进程"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """基于 SQLite 的持久化工作队列
+
+    协调者把输入拆成工作项写入队列，任意数量的工作进程（同一主机或共享存储的多台主机）
+    租用工作项、处理后提交结果。租约到期未提交（进程崩溃、机器断开）的工作项会被其他进程重新租用；
+    每次租用生成新的租约令牌，旧租约的持有者无法再提交或续约，避免重复写入结果。
+
+    工作项按协调者分配的序号 seq 排序，合并结果时与处理顺序、工作进程数量无关。
+    多主机使用时数据库所在的共享文件系统需要支持 POSIX 文件锁（SQLite 依赖它保证事务），
+    因此使用默认的回滚日志模式而不是 WAL。
+    """
+
+    def __init__(self, queue_dir: Union[str, Path], lease_seconds: float = 600, max_attempts: int = 3):
+        """打开或创建队列
+
+        Args:
+            queue_dir: 队列目录，包含 queue.db 和工作进程写出的文件
+            lease_seconds: 租约时长，超过后未提交的工作项可被重新租用
+            max_attempts: 每个工作项最多尝试的次数，超过后标记为失败
+        """
+        self.queue_dir = Path(queue_dir).absolute()
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.queue_dir / DB_FILE
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # 每次操作使用独立连接，可在多个线程和进程中同时使用
+        conn = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        try:
+            conn.row_factory = sqlite3.Row
+            yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connect() as conn:
+            # IMMEDIATE 在事务开始时即取得写锁，并发租用不会拿到同一个工作项
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def set_meta(self, **values) -> None:
+        """保存队列级配置（任务类型、提示词等），所有工作进程读取同一份"""
+        with self._transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)",
+                             [(k, json.dumps(v, ensure_ascii=False)) for k, v in values.items()])
+
+    def meta(self) -> Dict:
+        with self._connect() as conn:
+            return {row['name']: json.loads(row['value']) for row in conn.execute("SELECT name, value FROM meta")}
+
+    def enqueue(self, items: Iterable[Tuple[str, Dict]]) -> int:
+        """按顺序加入工作项，key 已存在的跳过，重复运行协调者不会产生重复
+
+        Args:
+            items: (key, payload) 序列，顺序即合并时的顺序
+
+        Returns:
+            int: 新加入的工作项数
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            seq = conn.execute("SELECT COALESCE(MAX(seq), -1) FROM items").fetchone()[0] + 1
+            added = 0
+            for key, payload in items:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO items (seq, key, payload, updated_at) VALUES (?, ?, ?, ?)",
+                    (seq, key, json.dumps(payload, ensure_ascii=False), now)
+                )
+                if cursor.rowcount:
+                    seq += 1
+                    added += 1
+        logger.info(f"加入 {added} 个工作项")
+        return added
+
+    def lease(self, worker: str, limit: int = 1) -> List[WorkItem]:
+        """租用待处理或租约已过期的工作项
+
+        Args:
+            worker: 工作进程标识
+            limit: 最多租用的数量
+
+        Returns:
+            List[WorkItem]: 租到的工作项，按序号排列
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            # 已用完尝试次数且租约过期的工作项直接判定失败
+            conn.execute(
+                "UPDATE items SET state = 'failed', error = '租约过期，最后由 ' || worker || ' 持有', "
+                "lease_token = NULL, updated_at = ? "
+                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, now, self.max_attempts)
+            )
+            rows = conn.execute(
+                "SELECT id, seq, key, payload, attempts FROM items "
+                "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY seq LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            items = []
+            for row in rows:
+                token = uuid.uuid4().hex
+                conn.execute(
+                    "UPDATE items SET state = 'leased', worker = ?, lease_token = ?, lease_until = ?, "
+                    "attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (worker, token, now + self.lease_seconds, now, row['id'])
+                )
+                items.append(WorkItem(row['id'], row['seq'], row['key'], json.loads(row['payload']),
+                                      token, row['attempts'] + 1))
+        return items
+
+    def renew(self, item: WorkItem) -> bool:
+        """延长租约，租约已被他人取得时返回 False"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE items SET lease_until = ? WHERE id = ? AND lease_token = ? AND state = 'leased'",
+                (time.time() + self.lease_seconds, item.id, item.lease_token)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, item: WorkItem, result: Dict) -> bool:
+        """提交结果，租约已失效时不写入并返回 False"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE items SET state = 'done', result = ?, error = NULL, lease_token = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_token = ? AND state = 'leased'",
+                (json.dumps(result, ensure_ascii=False), time.time(), item.id, item.lease_token)
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, item: WorkItem, error: str) -> bool:
+        """记录失败，未用完尝试次数的放回队列"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE items SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, lease_token = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_token = ? AND state = 'leased'",
+                (self.max_attempts, error, time.time(), item.id, item.lease_token)
+            )
+            return cursor.rowcount == 1
+
+    def release(self, item: WorkItem) -> bool:
+        """放弃租约（例如进程被中断），工作项立即回到队列且不计入尝试次数"""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE items SET state = 'pending', attempts = attempts - 1, lease_token = NULL, "
+                "lease_until = NULL, updated_at = ? WHERE id = ? AND lease_token = ? AND state = 'leased'",
+                (time.time(), item.id, item.lease_token)
+            )
+            return cursor.rowcount == 1
+
+    def requeue_failed(self) -> int:
+        """把失败的工作项重新放回队列并清零尝试次数"""
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE items SET state = 'pending', attempts = 0, error = NULL, updated_at = ? "
+                "WHERE state = 'failed'",
+                (time.time(),)
+            ).rowcount
+
+    def stats(self) -> Dict[str, int]:
+        """各状态的工作项数量，租约已过期的计入 expired"""
+        counts = {'pending': 0, 'leased': 0, 'expired': 0, 'done': 0, 'failed': 0}
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT CASE WHEN state = 'leased' AND lease_until < ? THEN 'expired' ELSE state END AS s, "
+                "COUNT(*) AS n FROM items GROUP BY s",
+                (time.time(),)
+            )
+            for row in rows:
+                counts[row['s']] = row['n']
+        return counts
+
+    def failures(self) -> List[Dict]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, attempts, error FROM items WHERE state = 'failed' ORDER BY seq")
+            return [dict(row) for row in rows]
+
+    def results(self) -> Iterator[Tuple[int, Dict, Dict]]:
+        """按序号依次返回已完成的 (seq, payload, result)"""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT seq, payload, result FROM items WHERE state = 'done' ORDER BY seq")
+            for row in rows:
+                yield row['seq'], json.loads(row['payload']), json.loads(row['result'])
+
+
+class QueueWorker:
+    """从队列租用工作项并调用处理函数的工作进程
+
+    处理期间后台线程定期续约，长时间的 API 调用不会因租约过期被其他进程抢走；
+    若续约失败（租约已被重新分配），处理结果不会提交。
+    """
+
+    def __init__(self, work_queue: WorkQueue, process: Callable[[WorkItem], Dict],
+                 worker_id: Optional[str] = None, threads: int = 1, poll_interval: float = 5.0):
+        """初始化工作进程
+
+        Args:
+            work_queue: 工作队列
+            process: 处理函数，返回要提交的结果，抛出异常表示失败
+            worker_id: 工作进程标识，默认使用主机名和进程号
+            threads: 同时处理的工作项数
+            poll_interval: 队列中只剩他人持有的租约时的等待间隔
+        """
+        self.queue = work_queue
+        self.process = process
+        self.worker_id = worker_id or default_worker_id()
+        self.threads = max(1, threads)
+        self.poll_interval = poll_interval
+        self._active: Dict[int, WorkItem] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # 已占用 max_items 名额但尚未计入 processed / failed 的工作项数
+        self._reserved = 0
+        self.processed = 0
+        self.failed = 0
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _heartbeat(self) -> None:
+        interval = max(1.0, self.queue.lease_seconds / 3)
+        while not self._stop.wait(interval):
+            with self._lock:
+                items = list(self._active.values())
+            for item in items:
+                if not self.queue.renew(item):
+                    logger.warning(f"工作项 {item.key} 的租约已失效，结果将被丢弃")
+
+    def _loop(self, wait: bool, max_items: Optional[int]) -> None:
+        while not self._stop.is_set():
+            # 先在锁内占一个名额再租用，多个线程同时租用时合计不超过 max_items
+            with self._lock:
+                if max_items is not None and self.processed + self.failed + self._reserved >= max_items:
+                    return
+                self._reserved += 1
+            items = self.queue.lease(self.worker_id)
+            if not items:
+                with self._lock:
+                    self._reserved -= 1
+                stats = self.queue.stats()
+                # 其他进程仍持有租约时继续等待，它们崩溃后租约过期即可接手
+                if wait and stats['leased']:
+                    self._stop.wait(self.poll_interval)
+                    continue
+                # 租约刚刚过期，下一轮即可租到，稍等片刻避免空转
+                if wait and stats['expired']:
+                    self._stop.wait(min(self.poll_interval, 0.1))
+                    continue
+                return
+            item = items[0]
+            with self._lock:
+                self._active[item.id] = item
+            try:
+                result = self.process(item)
+            except Exception as e:
+                logger.error(f"工作项 {item.key} 第 {item.attempts} 次处理失败: {str(e)}")
+                self.queue.fail(item, f"{type(e).__name__}: {str(e)}")
+                record_items("queue_item", ok=False)
+                with self._lock:
+                    self.failed += 1
+            else:
+                committed = self.queue.complete(item, result)
+                record_items("queue_item", ok=committed)
+                with self._lock:
+                    self.processed += committed
+                if not committed:
+                    logger.warning(f"工作项 {item.key} 的租约已失效，未提交结果")
+            finally:
+                with self._lock:
+                    self._active.pop(item.id, None)
+                    self._reserved -= 1
+
+    def run(self, wait: bool = True, max_items: Optional[int] = None) -> Dict[str, int]:
+        """处理工作项直到队列为空
+
+        Args:
+            wait: 队列中只剩他人持有的租约时是否等待，以便接手崩溃进程的工作项
+            max_items: 最多处理的工作项数，为空时不限
+
+        Returns:
+            Dict[str, int]: 本进程提交和失败的工作项数
+        """
+        depth_source = QUEUE_DEPTH.add_source(lambda: self.queue.stats()['pending'], queue="work_queue")
+        heartbeat = threading.Thread(target=self._heartbeat, name=child_thread_name("queue-heartbeat"), daemon=True)
+        heartbeat.start()
+        loops = [threading.Thread(target=self._loop, args=(wait, max_items),
+                                  name=child_thread_name(f"queue-worker-{i}"), daemon=True)
+                 for i in range(self.threads)]
+        try:
+            for thread in loops:
+                thread.start()
+            for thread in loops:
+                # 带超时的 join 让主线程能及时响应 Ctrl+C
+                while thread.is_alive():
+                    thread.join(0.5)
+        finally:
+            self._stop.set()
+            # 被中断时把正在处理的工作项交还队列，其他进程无需等待租约过期
+            with self._lock:
+                active = list(self._active.values())
+            for item in active:
+                self.queue.release(item)
+            QUEUE_DEPTH.remove_source(depth_source)
+        logger.info(f"工作进程 {self.worker_id} 结束：提交 {self.processed} 个，失败 {self.failed} 个")
+        return {'processed': self.processed, 'failed': self.failed}
@@ -8,8 +8,23 @@ AI Dataset Creator - Main Entry
 :license: MIT, see LICENSE for more details.
 """
 
-from ui.app import create_ui
+import os
+import sys
 
 if __name__ == "__main__":
-    app = create_ui()
+    # 带参数时作为命令行批处理运行，不启动界面
+    if len(sys.argv) > 1:
+        from cli import main
+        sys.exit(main())
+    from core.telemetry import configure_logging, start_metrics_server
+    configure_logging(os.getenv("PRETUNING_LOG_LEVEL", "INFO"), os.getenv("PRETUNING_LOG_FORMAT", "text"),
+                      trace=os.getenv("PRETUNING_TRACE") == "1")
+    # 指标服务默认监听本机 9464 端口，设为 0 关闭
+    metrics_port = int(os.getenv("PRETUNING_METRICS_PORT", "9464"))
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    from ui.app import create_ui
+    # 每个会话结果数据的内存上限（MB），不设置时不限制
+    memory_limit = os.getenv("PRETUNING_MEMORY_LIMIT_MB")
+    app = create_ui(memory_limit_mb=float(memory_limit) if memory_limit else None)
     app.launch(inbrowser=True)
\ No newline at end of file
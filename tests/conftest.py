@@ -0,0 +1,27 @@
+import io
+import os
+import sys
+
+import pytest
+from PIL import Image
+
+# 直接运行 pytest 时也能导入 core 等顶层包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def png_bytes(color=(255, 0, 0), size=(8, 8)) -> bytes:
+    """生成一张纯色 PNG 的编码字节"""
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def image_records():
+    """生成 n 条 ParquetShardWriter / TarShardWriter 可直接写入的记录"""
+    def make(n: int, prefix: str = "text"):
+        return [
+            {'image_bytes': png_bytes((i % 256, 0, 0)), 'image_path': f"image_{i:05d}.png", 'text': f"{prefix} {i}"}
+            for i in range(n)
+        ]
+    return make
@@ -0,0 +1,56 @@
+import pyarrow.parquet as pq
+
+from core.create_parquet import MANIFEST_FILE, ParquetShardWriter
+
+
+def _texts(output_dir, manifest):
+    texts = []
+    for shard in manifest['shards']:
+        texts += pq.read_table(output_dir / shard['file'], columns=['text']).column('text').to_pylist()
+    return texts
+
+
+def test_write_splits_into_shards(tmp_path, image_records):
+    manifest = ParquetShardWriter(str(tmp_path), rows_per_shard=4).write(image_records(10))
+
+    assert manifest['version'] == 1
+    assert manifest['num_rows'] == 10
+    assert [s['num_rows'] for s in manifest['shards']] == [4, 4, 2]
+    assert _texts(tmp_path, manifest) == [f"text {i}" for i in range(10)]
+
+
+def test_reexport_replaces_shards_with_new_version(tmp_path, image_records):
+    writer = ParquetShardWriter(str(tmp_path), rows_per_shard=4)
+    first = writer.write(image_records(10))
+    second = writer.write(image_records(3, prefix="again"))
+
+    assert second['version'] == first['version'] + 1
+    assert second['num_rows'] == 3
+    assert _texts(tmp_path, second) == [f"again {i}" for i in range(3)]
+    # 新旧分片文件名不同，提交清单后旧分片被删除
+    assert not {s['file'] for s in first['shards']} & {s['file'] for s in second['shards']}
+    assert sorted(p.name for p in tmp_path.glob("data-*.parquet")) == sorted(s['file'] for s in second['shards'])
+    assert writer.load_manifest() == second
+
+
+def test_append_keeps_existing_shards(tmp_path, image_records):
+    writer = ParquetShardWriter(str(tmp_path), rows_per_shard=4)
+    first = writer.write(image_records(5))
+    second = writer.write(image_records(2, prefix="more"), append=True)
+
+    assert second['num_rows'] == 7
+    assert second['shards'][:len(first['shards'])] == first['shards']
+    assert _texts(tmp_path, second) == [f"text {i}" for i in range(5)] + ["more 0", "more 1"]
+
+
+def test_stale_shards_from_interrupted_write_are_removed(tmp_path, image_records):
+    writer = ParquetShardWriter(str(tmp_path))
+    writer.write(image_records(2))
+    orphan = tmp_path / "data-v00009-00000.parquet"
+    orphan.write_bytes(b"partial")
+
+    manifest = writer.write(image_records(2))
+
+    assert not orphan.exists()
+    assert (tmp_path / MANIFEST_FILE).exists()
+    assert manifest['version'] == 2
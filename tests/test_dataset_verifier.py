@@ -0,0 +1,100 @@
+import json
+
+import pytest
+
+from conftest import png_bytes
+from core.create_parquet import DatasetProcessor, ParquetShardWriter
+from core.dataset_verifier import ARROW_MANIFEST_FILE, check_image_bytes, verify_dataset
+from core.webdataset_export import TarShardWriter
+
+
+def _truncated_records(image_records, n: int = 6, bad: int = 2):
+    records = image_records(n)
+    records[bad]['image_bytes'] = records[bad]['image_bytes'][:-20]
+    return records
+
+
+def test_check_image_bytes_detects_truncation():
+    data = png_bytes()
+    assert check_image_bytes(data) is None
+    assert "IEND" in check_image_bytes(data[:-20])
+    assert check_image_bytes(b"") is not None
+
+
+def test_parquet_dataset_ok(tmp_path, image_records):
+    ParquetShardWriter(str(tmp_path), rows_per_shard=4).write(image_records(10))
+
+    report = verify_dataset(tmp_path, workers=1)
+
+    assert report.ok
+    assert report.shards_checked == 3
+    assert report.records_checked == 10
+
+
+def test_parquet_truncated_image_is_reported(tmp_path, image_records):
+    # CRC32 按截断后的字节计算，只有图片检查能发现
+    ParquetShardWriter(str(tmp_path), rows_per_shard=4).write(_truncated_records(image_records))
+
+    report = verify_dataset(tmp_path, workers=1)
+
+    assert not report.ok
+    assert [(f['shard'], f['row']) for f in report.failures] == [("data-v00001-00000.parquet", 2)]
+
+
+def test_parquet_truncated_shard_is_reported(tmp_path, image_records):
+    manifest = ParquetShardWriter(str(tmp_path)).write(image_records(4))
+    shard = tmp_path / manifest['shards'][0]['file']
+    shard.write_bytes(shard.read_bytes()[:-100])
+
+    report = verify_dataset(tmp_path, workers=1)
+
+    errors = [f['error'] for f in report.failures]
+    assert any("文件大小不符" in e for e in errors)
+    assert any("footer" in e for e in errors)
+
+
+def test_tar_truncated_image_is_reported(tmp_path, image_records):
+    TarShardWriter(str(tmp_path), samples_per_shard=4).write(_truncated_records(image_records))
+
+    report = verify_dataset(tmp_path, workers=1)
+
+    assert report.records_checked == 6
+    assert [(f['shard'], f['row']) for f in report.failures] == [("shard-v00001-00000.tar", "000000002")]
+
+
+def test_hf_dataset_checks_manifest_and_crc(tmp_path, image_records):
+    pytest.importorskip("datasets")
+    pairs = [{'image_bytes': r['image_bytes'], 'image_format': 'png', 'text': r['text']} for r in image_records(5)]
+    DatasetProcessor().create_from_pairs(pairs, str(tmp_path))
+    hf_dir = next(tmp_path.glob("dataset_*")) / "hf_dataset"
+    manifest = json.loads((hf_dir / ARROW_MANIFEST_FILE).read_text(encoding='utf-8'))
+
+    report = verify_dataset(hf_dir.parent, workers=1)
+    assert report.ok
+    assert report.records_checked == manifest['num_rows'] == 5
+    assert not report.notes
+
+    # 改动图片中的一个字节：分片 SHA-256 与记录 CRC32 都不符
+    arrow_file = hf_dir / manifest['shards'][0]['file']
+    data = bytearray(arrow_file.read_bytes())
+    offset = data.find(b"IDAT") + 8
+    data[offset] ^= 0xFF
+    arrow_file.write_bytes(bytes(data))
+
+    errors = [f['error'] for f in verify_dataset(hf_dir, workers=1).failures]
+    assert "分片 SHA-256 不符" in errors
+    assert "记录 CRC32 不符" in errors
+
+
+def test_hf_dataset_without_manifest_notes_limitation(tmp_path, image_records):
+    pytest.importorskip("datasets")
+    pairs = [{'image_bytes': r['image_bytes'], 'image_format': 'png', 'text': r['text']} for r in image_records(2)]
+    DatasetProcessor().create_from_pairs(pairs, str(tmp_path))
+    hf_dir = next(tmp_path.glob("dataset_*")) / "hf_dataset"
+    (hf_dir / ARROW_MANIFEST_FILE).unlink()
+
+    report = verify_dataset(hf_dir, workers=1)
+
+    assert report.ok
+    assert report.notes
+    assert "注意" in report.summary()
@@ -0,0 +1,110 @@
+import asyncio
+import os
+
+import pytest
+
+from core.ingest_manifest import IngestManifest, config_fingerprint
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    source = tmp_path / "corpus" / "a.txt"
+    source.parent.mkdir()
+    source.write_text("第一段内容。", encoding='utf-8')
+    output = tmp_path / "out" / "a.json"
+    output.parent.mkdir()
+    output.write_text("[]", encoding='utf-8')
+    return source, output
+
+
+def _recorded(tmp_path, source, output, config_hash):
+    manifest = IngestManifest(tmp_path / "ingest_manifest.json")
+    manifest.record(source, config_hash, output, records=1)
+    manifest.save()
+    # 重新读取，确认清单落盘
+    return IngestManifest(tmp_path / "ingest_manifest.json")
+
+
+def test_new_file_needs_processing(tmp_path, corpus):
+    source, _ = corpus
+    assert IngestManifest(tmp_path / "ingest_manifest.json").check(source, "cfg") == (True, "新文件")
+
+
+def test_unchanged_file_is_skipped(tmp_path, corpus):
+    source, output = corpus
+    manifest = _recorded(tmp_path, source, output, "cfg")
+    assert manifest.check(source, "cfg") == (False, "未变化")
+
+
+def test_touched_file_is_skipped_by_content_hash(tmp_path, corpus):
+    source, output = corpus
+    manifest = _recorded(tmp_path, source, output, "cfg")
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    assert manifest.check(source, "cfg") == (False, "内容未变化")
+    # 刷新后的 stat 写回清单，下次只需 stat
+    manifest.save()
+    assert IngestManifest(tmp_path / "ingest_manifest.json").check(source, "cfg") == (False, "未变化")
+
+
+@pytest.mark.parametrize("change, reason", [
+    ("content", "内容已修改"),
+    ("config", "处理配置已变化"),
+    ("output", "输出文件不存在"),
+])
+def test_changes_trigger_rerun(tmp_path, corpus, change, reason):
+    source, output = corpus
+    manifest = _recorded(tmp_path, source, output, "cfg")
+    config_hash = "cfg"
+    if change == "content":
+        source.write_text("第二段内容，长度也不同。", encoding='utf-8')
+    elif change == "config":
+        config_hash = "other"
+    else:
+        output.unlink()
+
+    assert manifest.check(source, config_hash) == (True, reason)
+
+
+def test_fingerprint_depends_on_config_only():
+    assert config_fingerprint(model="m", prompt="p") == config_fingerprint(prompt="p", model="m")
+    assert config_fingerprint(model="m") != config_fingerprint(model="n")
+
+
+def test_move_output_keeps_entry(tmp_path, corpus):
+    source, output = corpus
+    manifest = _recorded(tmp_path, source, output, "cfg")
+    assert manifest.output_format(source) == "json"
+
+    converted = output.with_suffix(".parquet")
+    converted.write_bytes(b"")
+    manifest.move_output(source, converted, "parquet")
+
+    assert manifest.output_format(source) == "parquet"
+    assert manifest.check(source, "cfg") == (False, "未变化")
+
+
+def test_text_directory_skips_and_reruns(tmp_path):
+    from core.dataset_creator import DatasetCreator
+
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    for name in ("a", "b"):
+        (corpus / f"{name}.txt").write_text(f"{name} 文件。深度学习模型的训练数据需要清洗。" * 3, encoding='utf-8')
+    creator = DatasetCreator(temp_dir=str(tmp_path / "tmp"), output_root=str(tmp_path))
+    creator.set_instruction_mode("local")
+    out = str(tmp_path / "text")
+
+    def run(export_format="json"):
+        return asyncio.run(creator.process_text_directory(str(corpus), None, None, None, out, export_format))
+
+    assert "跳过未变化 0 个，处理 2 个" in run()
+    assert "跳过未变化 2 个，处理 0 个" in run()
+
+    (corpus / "b.txt").write_text("修改后的内容。数据清洗很重要。", encoding='utf-8')
+    assert "跳过未变化 1 个，处理 1 个" in run()
+
+    # 只换导出格式时从已有输出转换，不重新处理
+    assert "（其中 2 个仅转换格式），处理 0 个" in run("parquet")
+    assert (tmp_path / "text" / "incremental" / "a.parquet").exists()
@@ -0,0 +1,89 @@
+import random
+import re
+from collections import Counter
+
+import pytest
+
+from core.local_instructions import _STOP_CHARS, LocalInstructionGenerator, extract_terms, split_chunk
+
+_HAN = re.compile(r"[㐀-䶿一-鿿]+")
+
+
+def _reference(text):
+    """逐层在全文中统计 n 字词的直接实现，与 extract_terms 的中文部分对照"""
+    counts = {n: Counter(text[i:i + n] for i in range(len(text) - n + 1) if _HAN.fullmatch(text[i:i + n]))
+              for n in range(2, 7)}
+    level = {gram: tf for gram, tf in counts[2].items() if tf > 1}
+    grams = dict(level)
+    subsumed = set()
+    for n in range(3, 7):
+        longer = {gram: tf for gram, tf in counts[n].items()
+                  if tf > 1 and gram[0] not in _STOP_CHARS and gram[:-1] in level and gram[1:] in level}
+        for gram, tf in longer.items():
+            for part in (gram[:-1], gram[1:]):
+                if level[part] <= tf * 1.25:
+                    subsumed.add(part)
+        if not longer:
+            break
+        grams.update(longer)
+        level = longer
+    return {gram: tf for gram, tf in grams.items()
+            if gram[0] not in _STOP_CHARS and gram[-1] not in _STOP_CHARS and gram not in subsumed}
+
+
+def test_long_term_subsumes_its_parts():
+    text = "糖尿病是一种常见的慢性病。糖尿病患者需要控制血糖，糖尿病的并发症包括视网膜病变。"
+    assert extract_terms(text) == Counter({'糖尿病': 3})
+
+
+def test_chinese_and_latin_terms():
+    text = ("深度学习模型需要大量训练数据。深度学习模型的训练数据需要清洗，"
+            "训练数据的质量决定模型效果。Transformer 和 transformer 都是 model。")
+    assert extract_terms(text) == Counter({
+        '模型': 3, '训练数据': 3, '需要': 2, '深度学习模型': 2, 'transformer': 2, 'model': 1,
+    })
+
+
+def test_short_text_falls_back_to_bigrams():
+    assert extract_terms("今天天气很好。") == Counter({'今天': 1, '天天': 1, '天气': 1})
+
+
+def test_stop_words_are_dropped():
+    terms = extract_terms("我们的数据和我们的数据。This is the data and the data.")
+    assert terms['数据'] == 2
+    assert terms['data'] == 2
+    assert not {'我们', '的数', 'the', 'and', 'this'} & set(terms)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_matches_reference_on_random_text(seed):
+    rng = random.Random(seed)
+    words = ["神经网络", "梯度", "下降", "的", "优化器", "学习率", "和", "数据集", "在", "训练", "模型", "。", "，"]
+    text = "".join(rng.choice(words) for _ in range(300))
+
+    terms = extract_terms(text)
+
+    assert dict(terms) == _reference(text)
+
+
+def test_split_chunk_prefers_sentence_end():
+    text = "第一句话。" * 10 + "没有标点的长句子" * 10
+    chunk = split_chunk(text, max_chars=60)
+    assert chunk.endswith("。")
+    assert len(chunk) <= 60
+    assert split_chunk("短文本", max_chars=60) == "短文本"
+
+
+def test_instructions_are_short_keywords():
+    documents = [
+        "糖尿病是一种常见的慢性病。糖尿病患者需要控制血糖，糖尿病的并发症包括视网膜病变。",
+        "深度学习模型需要大量训练数据。深度学习模型的训练数据需要清洗，训练数据的质量决定模型效果。",
+    ]
+    generator = LocalInstructionGenerator()
+
+    instructions = generator.fit_instructions(documents)
+
+    assert instructions[0] == "糖尿病"
+    assert "训练数据" in instructions[1]
+    assert all(0 < len(instruction) <= generator.max_chars for instruction in instructions)
+    assert generator.num_docs == 2
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from core.sequence_packing import pack_lengths, pack_records
+
+
+def _reference(lengths, capacity, separator_length):
+    """逐个放置的 best-fit decreasing，返回每个样本的序列编号
+
+    放进剩余容量最小且放得下的序列，放不下时开新序列，超长样本单独成序列。
+    剩余容量相同的序列先到达该容量的优先，与 pack_lengths 的批量放置一致。
+    """
+    remaining = []  # 每个序列的 [剩余容量, 到达该容量的顺序]，超长样本的序列为 None
+    bin_of = [0] * len(lengths)
+    clock = 0
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        length = lengths[i]
+        need = length + separator_length
+        fits = [b for b, r in enumerate(remaining) if r is not None and r[0] >= need]
+        if fits:
+            b = min(fits, key=lambda b: remaining[b])
+            if need:
+                clock += 1
+                remaining[b] = [remaining[b][0] - need, clock]
+        else:
+            b = len(remaining)
+            clock += 1
+            remaining.append([capacity - length, clock] if length <= capacity else None)
+        bin_of[i] = b
+    return bin_of, len(remaining)
+
+
+def _contents(lengths, bin_of, n_bins):
+    groups = [[] for _ in range(n_bins)]
+    for length, b in zip(lengths, bin_of):
+        groups[b].append(int(length))
+    return groups
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    capacity = int(rng.integers(1, 40))
+    separator_length = int(rng.integers(0, 4))
+    lengths = rng.integers(0, capacity + 10, size=int(rng.integers(0, 80)))
+
+    bin_of, n_bins = pack_lengths(lengths, capacity, separator_length)
+    expected_bin_of, expected_n_bins = _reference(lengths.tolist(), capacity, separator_length)
+
+    assert n_bins == expected_n_bins
+    assert bin_of.tolist() == expected_bin_of
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_bins_respect_capacity(seed):
+    rng = np.random.default_rng(100 + seed)
+    lengths = np.maximum(1, rng.lognormal(5, 1, size=2000).astype(np.int64))
+    capacity, separator_length = 2048, 2
+
+    bin_of, n_bins = pack_lengths(lengths, capacity, separator_length)
+
+    for group in _contents(lengths, bin_of, n_bins):
+        total = sum(group) + separator_length * (len(group) - 1)
+        assert total <= capacity or len(group) == 1
+    # 序列按首个样本的长度降序编号
+    firsts = [max(g) for g in _contents(lengths, bin_of, n_bins)]
+    assert firsts == sorted(firsts, reverse=True)
+
+
+def test_pack_records_spans_point_at_samples():
+    records = [{'instruction': "", 'input': "", 'output': "x" * n} for n in (5, 3, 7, 2)]
+
+    packed = list(pack_records(records, target_length=10, separator="|", length_fn=len))
+
+    assert sorted(i for seq in packed for i in seq['sample_ids']) == [0, 1, 2, 3]
+    for seq in packed:
+        assert seq['token_length'] <= 10
+        for i, (start, end) in zip(seq['sample_ids'], seq['char_spans']):
+            assert seq['text'][start:end] == records[i]['output']
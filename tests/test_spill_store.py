@@ -0,0 +1,88 @@
+import io
+import json
+
+from PIL import Image
+
+from conftest import png_bytes
+from core.spill_store import (ImageSpiller, MemoryBudget, RecordStore, SpillablePair, image_size,
+                              write_json_array)
+
+
+def _records(n):
+    return [{'instruction': f"问题 {i}", 'input': "", 'output': f"回答 {i} " * 20} for i in range(n)]
+
+
+def test_unlimited_store_stays_in_memory(tmp_path):
+    store = RecordStore(tmp_path, MemoryBudget(), _records(50))
+
+    assert store.spilled == 0
+    assert list(store) == _records(50)
+    assert not list(tmp_path.iterdir())
+
+
+def test_spill_and_read_back(tmp_path):
+    budget = MemoryBudget(0.01)
+    store = RecordStore(tmp_path, budget)
+    store.extend(_records(100))
+
+    assert 0 < store.spilled < 100
+    assert budget.used <= budget.limit
+    assert len(store) == 100
+    assert list(store) == _records(100)
+    assert [store[i] for i in (0, store.spilled - 1, store.spilled, -1)] == \
+        [_records(100)[i] for i in (0, store.spilled - 1, store.spilled, -1)]
+    assert store[10:13] == _records(100)[10:13]
+
+
+def test_append_while_iterating_does_not_repeat(tmp_path):
+    store = RecordStore(tmp_path, MemoryBudget(0.01), _records(60))
+    seen = []
+    for record in store:
+        seen.append(record)
+        if len(seen) == 1:
+            store.extend(_records(10))
+
+    assert seen == _records(60)
+    assert len(store) == 70
+
+
+def test_clear_removes_spill_file(tmp_path):
+    budget = MemoryBudget(0.01)
+    store = RecordStore(tmp_path, budget, _records(100))
+    assert list(tmp_path.glob("records_*.jsonl"))
+
+    store.clear()
+
+    assert len(store) == 0
+    assert budget.used == 0
+    assert not list(tmp_path.glob("records_*.jsonl"))
+
+
+def test_write_json_array_matches_json_dump(tmp_path):
+    for records in ([], _records(3)):
+        buffer = io.StringIO()
+        assert write_json_array(RecordStore(tmp_path, records=records), buffer) == len(records)
+        assert buffer.getvalue() == json.dumps(records, ensure_ascii=False, indent=2)
+
+
+def test_spilled_image_reloads_from_disk(tmp_path):
+    budget = MemoryBudget(0.0001)
+    spiller = ImageSpiller(budget)
+    pairs = []
+    for i in range(3):
+        path = tmp_path / f"image_{i}.png"
+        data = png_bytes((i, 0, 0), size=(20, 10))
+        path.write_bytes(data)
+        pairs.append(spiller.track({'image': Image.open(io.BytesIO(data)), 'image_bytes': data,
+                                    'image_path': str(path), 'text': f"t{i}"}))
+
+    assert spiller.spilled >= 2
+    pair = pairs[0]
+    assert isinstance(pair, SpillablePair) and not pair.resident
+    assert pair['image_bytes'] == (tmp_path / "image_0.png").read_bytes()
+    # 重新读取的图片已载入内存，文件句柄已关闭
+    image = pair['image']
+    assert image.size == (20, 10)
+    assert getattr(image, 'fp', None) is None
+    assert image_size(pair) == (20, 10)
+    assert pair['text'] == "t0"
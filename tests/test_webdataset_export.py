@@ -0,0 +1,53 @@
+import json
+import tarfile
+import threading
+
+from core.webdataset_export import INDEX_FILE, TarShardWriter
+
+
+def _texts(output_dir, index):
+    texts = []
+    for shard in index['shards']:
+        with tarfile.open(output_dir / shard['file']) as tar:
+            texts += [tar.extractfile(m).read().decode('utf-8') for m in tar if m.name.endswith(".txt")]
+    return texts
+
+
+def test_write_groups_samples_by_key(tmp_path, image_records):
+    index = TarShardWriter(str(tmp_path), samples_per_shard=4).write(image_records(10))
+
+    assert index['num_samples'] == 10
+    assert index['urls'] == "shard-v00001-{00000..00002}.tar"
+    with tarfile.open(tmp_path / index['shards'][0]['file']) as tar:
+        names = tar.getnames()
+    assert names[:3] == ["000000000.png", "000000000.txt", "000000000.json"]
+    assert _texts(tmp_path, index) == [f"text {i}" for i in range(10)]
+
+
+def test_reexport_replaces_shards_with_new_version(tmp_path, image_records):
+    writer = TarShardWriter(str(tmp_path), samples_per_shard=4)
+    first = writer.write(image_records(10))
+    second = writer.write(image_records(3, prefix="again"))
+
+    assert second['version'] == first['version'] + 1
+    assert second['urls'] == "shard-v00002-{00000..00000}.tar"
+    assert _texts(tmp_path, second) == [f"again {i}" for i in range(3)]
+    assert sorted(p.name for p in tmp_path.glob("shard-*.tar")) == [s['file'] for s in second['shards']]
+    assert json.loads((tmp_path / INDEX_FILE).read_text(encoding='utf-8')) == second
+
+
+def test_concurrent_exports_leave_one_consistent_index(tmp_path, image_records):
+    def export(prefix):
+        TarShardWriter(str(tmp_path), samples_per_shard=2).write(image_records(5, prefix=prefix))
+
+    threads = [threading.Thread(target=export, args=(f"run{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    index = TarShardWriter(str(tmp_path)).load_index()
+    assert index['version'] == 4
+    assert sorted(p.name for p in tmp_path.glob("shard-*.tar")) == [s['file'] for s in index['shards']]
+    texts = _texts(tmp_path, index)
+    assert len(texts) == 5 and len({t.split()[0] for t in texts}) == 1
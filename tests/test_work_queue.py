@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from core.work_queue import QueueWorker, WorkQueue
+
+# 测试用的短租约
+LEASE = 0.2
+
+
+@pytest.fixture
+def queue(tmp_path):
+    work_queue = WorkQueue(tmp_path / "q", lease_seconds=LEASE, max_attempts=3)
+    work_queue.enqueue([(f"k{i}", {'i': i}) for i in range(5)])
+    return work_queue
+
+
+def test_enqueue_is_idempotent(queue):
+    assert queue.enqueue([("k0", {'i': 0}), ("k5", {'i': 5})]) == 1
+    assert queue.stats()['pending'] == 6
+
+
+def test_lease_in_order_and_exclusive(queue):
+    first = queue.lease("a", limit=2)
+    second = queue.lease("b", limit=2)
+
+    assert [item.key for item in first] == ["k0", "k1"]
+    assert [item.key for item in second] == ["k2", "k3"]
+    assert queue.stats()['leased'] == 4
+
+
+def test_expired_lease_is_reassigned(queue):
+    stale = queue.lease("a")[0]
+    time.sleep(LEASE * 1.5)
+    assert queue.stats()['expired'] == 1
+
+    fresh = queue.lease("b")[0]
+
+    assert fresh.key == stale.key
+    assert fresh.lease_token != stale.lease_token
+    assert fresh.attempts == 2
+
+
+def test_stale_token_cannot_commit_or_renew(queue):
+    stale = queue.lease("a")[0]
+    time.sleep(LEASE * 1.5)
+    fresh = queue.lease("b")[0]
+
+    assert not queue.renew(stale)
+    assert not queue.complete(stale, {'by': "a"})
+    assert not queue.fail(stale, "late")
+    assert queue.complete(fresh, {'by': "b"})
+    assert list(queue.results()) == [(0, {'i': 0}, {'by': "b"})]
+
+
+def test_renewal_keeps_lease(queue):
+    item = queue.lease("a")[0]
+    for _ in range(3):
+        time.sleep(LEASE / 2)
+        assert queue.renew(item)
+
+    assert queue.lease("b", limit=5)[0].key != item.key
+    assert queue.complete(item, {'ok': True})
+
+
+def test_attempts_exhausted_after_expiry(queue):
+    for _ in range(3):
+        item = queue.lease("a")[0]
+        assert item.key == "k0"
+        time.sleep(LEASE * 1.5)
+
+    assert queue.lease("b")[0].key == "k1"
+    assert [f['key'] for f in queue.failures()] == ["k0"]
+
+
+def test_release_does_not_count_attempt(queue):
+    item = queue.lease("a")[0]
+    assert queue.release(item)
+
+    assert queue.lease("b")[0].attempts == 1
+
+
+def test_worker_processes_everything(queue):
+    worker = QueueWorker(queue, lambda item: {'double': item.payload['i'] * 2}, threads=3, poll_interval=0.05)
+
+    assert worker.run() == {'processed': 5, 'failed': 0}
+    assert [r['double'] for _, _, r in queue.results()] == [0, 2, 4, 6, 8]
+
+
+def test_worker_max_items_across_threads(queue):
+    started = []
+    lock = threading.Lock()
+
+    def process(item):
+        with lock:
+            started.append(item.key)
+        time.sleep(0.05)
+        return {}
+
+    result = QueueWorker(queue, process, threads=4).run(max_items=2)
+
+    assert result == {'processed': 2, 'failed': 0}
+    assert len(started) == 2
+    assert queue.stats()['pending'] == 3
+
+
+def test_worker_failures_are_retried(queue):
+    calls = {}
+
+    def process(item):
+        calls[item.key] = calls.get(item.key, 0) + 1
+        if item.key == "k1" and calls[item.key] == 1:
+            raise RuntimeError("暂时失败")
+        return {}
+
+    result = QueueWorker(queue, process, poll_interval=0.05).run()
+
+    assert result == {'processed': 5, 'failed': 1}
+    assert calls["k1"] == 2
+    assert queue.stats()['done'] == 5
@@ -1,8 +1,58 @@
+import os
+import logging
+from typing import Optional
 import gradio as gr
-from core.dataset_creator import DatasetCreator
+from core.job_runner import JobRunner, report_progress
+from ui.sessions import SessionStore
 
-def create_ui():
-    creator = DatasetCreator()
+logger = logging.getLogger(__name__)
+
+def create_ui(max_jobs: int = 2, max_jobs_per_user: int = 1, memory_limit_mb: Optional[float] = None):
+    """创建界面
+
+    每个浏览器会话使用独立的 DatasetCreator 和临时目录；长任务提交到后台执行器，
+    按会话轮转调度，界面定时轮询任务状态。
+
+    Args:
+        max_jobs: 同时运行的后台任务数
+        max_jobs_per_user: 单个会话同时运行的任务数
+        memory_limit_mb: 每个会话结果数据的内存上限（MB），超出后写入磁盘，为空时不限制
+    """
+    store = SessionStore(JobRunner(max_concurrent=max_jobs, max_per_user=max_jobs_per_user),
+                         memory_limit_mb=memory_limit_mb)
+
+    def session_of(request: gr.Request):
+        return store.get(getattr(request, 'session_hash', None))
+
+    def job_message(job, message: str = None) -> str:
+        if job.state == "queued":
+            return f"任务 #{job.id}（{job.name}）排队中，前面还有 {store.runner.position(job.id)} 个任务"
+        if job.state == "running":
+            return message or f"任务 #{job.id}（{job.name}）运行中..."
+        if job.state == "failed":
+            message = f"任务 #{job.id}（{job.name}）失败: {job.error}"
+            return message + (f"\n性能分析报告: {job.profile_path}" if job.profile_path else "")
+        if job.state == "cancelled":
+            return f"任务 #{job.id}（{job.name}）已取消"
+        message = message or f"任务 #{job.id}（{job.name}）已完成"
+        if job.profile_path:
+            message += f"\n性能分析报告: {job.profile_path}"
+        return message
+
+    def poll(request: gr.Request, tab: str, keys):
+        """把标签页当前任务的最新进度写回界面，只在有新数据时更新对应组件"""
+        session = session_of(request)
+        job = store.current_job(session, tab)
+        if job is None:
+            return [gr.skip()] * (len(keys) + 1)
+        data = job.latest if isinstance(job.latest, dict) else {}
+        fresh = session.delivered.get(tab) is not data
+        session.delivered[tab] = data
+        updates = [data[k] if fresh and k in data else gr.skip() for k in keys]
+        if job.finished:
+            session.jobs.pop(tab, None)
+            session.delivered.pop(tab, None)
+        return updates + [job_message(job, data.get('status'))]
     
     with gr.Blocks() as app:
         gr.Markdown("# Pretuning 微调数据集创建工具")
@@ -26,6 +76,18 @@ def create_ui():
                         value="gpt-4o-mini",  # 默认值
                         placeholder="例如: gpt-4-vision-preview"
                     )
+                    stage_models = gr.Textbox(
+                        label="分阶段模型级联（可选）",
+                        placeholder="例如: *=gpt-4o-mini>gpt-4o; title=gpt-4o-mini",
+                        info="阶段可选 analyzer/title/format/image，* 表示其余阶段；先用 > 前面的模型，"
+                             "结果为空、过长、格式错误或拒绝回答时升级到后面的模型。留空则都用上面的模型",
+                        lines=2
+                    )
+                    profile_jobs = gr.Checkbox(
+                        label="后台任务性能分析",
+                        value=False,
+                        info="开启后本会话的后台任务会记录调用栈采样和内存分配，报告写到本会话输出目录下的 profiles 目录，任务会变慢"
+                    )
         
 
             with gr.Row():
@@ -45,6 +107,13 @@ def create_ui():
             with gr.Row():
                 with gr.Column(scale=1):
                     gr.Markdown("### Agent设置")
+                    instruction_mode = gr.Dropdown(
+                        label="指令生成方式",
+                        choices=[("模型生成（三个 Agent）", "llm"), ("本地关键词（不调用 API）", "local")],
+                        value="llm",
+                        info="本地模式在 CPU 上切块并按 TF-IDF 关键词生成指令，适合量大、对指令要求不高的语料；"
+                             "模型生成时 API 出错的文本块也会改用本地指令"
+                    )
                     analyzer_prompt = gr.Textbox(
                         label="分析器 Agent 提示词",
                         placeholder="设置文本分析专家的提示词",
@@ -109,6 +178,15 @@ def create_ui():
             with gr.Row():
                 process_text = gr.Button("处理文本", variant="secondary")
                 save_text = gr.Button("保存数据集", variant="primary")
+                text_export_format = gr.Dropdown(
+                    label="导出格式",
+                    choices=[("JSON", "json"), ("Parquet (zstd)", "parquet"), ("Arrow IPC (zstd)", "arrow"),
+                             ("打包序列 (JSONL)", "packed"), ("预分词 (.bin/.idx)", "tokens")],
+                    value="json"
+                )
+                pack_length = gr.Number(label="打包目标长度 (token)", value=2048, precision=0)
+                pack_separator = gr.Textbox(label="打包分隔符", value="\n\n")
+                tokenizer_file = gr.Textbox(label="分词器文件 (tokenizer.json)", placeholder="预分词导出时填写本地路径")
             
             status = gr.Textbox(label="状态", interactive=False)
             
@@ -119,100 +197,169 @@ def create_ui():
                     file_types=[".txt"],
                     file_count="single"
                 )
+            
+            with gr.Row():
+                corpus_dir = gr.Textbox(
+                    label="语料目录（增量处理：跳过未变化的文件，只处理新增或修改的 .txt）",
+                    placeholder="例如: input"
+                )
+                process_dir = gr.Button("增量处理目录", variant="secondary")
 
             # 文本处理相关函数
-            async def handle_text_processing(text_file, analyzer_prompt, title_prompt, format_prompt):
+            async def process_text_job(creator, content, source_name, analyzer_prompt, title_prompt, format_prompt):
+                # 1. 在每次处理前都重新初始化连接和更新提示词
                 try:
+                    if creator.text_processor.instruction_mode == "local":
+                        async with creator.text_processor as processor:
+                            preview, message = await processor.process_file(content, source_name)
+                        return {'output': preview, 'status': message}
+                    
+                    # 确保关闭之前的连接
+                    if creator.text_processor.http_client:
+                        await creator.text_processor.http_client.aclose()
+                    
+                    # 重新初始化
+                    creator.text_processor._initialize_agents()
+                    
+                    await creator.text_processor.update_prompts(
+                        analyzer_prompt=analyzer_prompt,
+                        title_prompt=title_prompt,
+                        format_prompt=format_prompt
+                    )
+                    logger.debug("处理器更新成功")
+                except Exception as e:
+                    logger.error(f"处理器更新失败: {e}")
+                    return {'output': "", 'status': f"处理器更新失败: {str(e)}"}
+                
+                # 2. 使用异步上下文管理器处理文本
+                try:
+                    async with creator.text_processor as processor:
+                        preview, message = await processor.process_file(content, source_name)
+                        logger.info(f"{source_name} 处理完成: {message}")
+                        return {'output': preview, 'status': message}
+                        
+                except Exception as e:
+                    logger.exception(f"文本处理失败: {e}")
+                    # 重新初始化处理器
+                    creator.text_processor._initialize_agents()
+                    return {'output': "", 'status': f"文本处理失败: {str(e)}"}
+
+            def handle_text_processing(text_file, analyzer_prompt, title_prompt, format_prompt, mode,
+                                       request: gr.Request):
+                try:
+                    session = session_of(request)
+                    creator = session.creator
                     # 1. 基本检查
                     if not text_file:
-                        print("错误: 未上传文件")
                         return "", "请先上传文件"
                     
-                    if not creator.text_processor:
-                        print("错误: 未配置text_processor")
+                    if mode != "local" and not creator.api_handler:
                         return "", "请先配置API设置"
+                    creator.set_instruction_mode(mode)
                     
                     # 2. 读取文件
                     try:
-                        if isinstance(text_file, str):
-                            print(f"读取文件路径: {text_file}")
-                            with open(text_file, 'r', encoding='utf-8') as f:
-                                content = f.read()
-                        else:
-                            print(f"读取上传文件: {text_file.name}")
-                            with open(text_file.name, 'r', encoding='utf-8') as f:
-                                content = f.read()
-                        print(f"成功读取文件，内容长度: {len(content)} 字符")
+                        source_file = text_file if isinstance(text_file, str) else text_file.name
+                        with open(source_file, 'r', encoding='utf-8') as f:
+                            content = f.read()
+                        logger.debug(f"读取文件 {source_file}，内容长度: {len(content)} 字符")
                         
                     except Exception as e:
-                        print(f"读取文件失败: {e}")
+                        logger.error(f"读取文件失败: {e}")
                         return "", f"读取文件失败: {str(e)}"
                     
-                    # 3. 在每次处理前都重新初始化连接和更新提示词
-                    print("\n=== 重新初始化处理器 ===")
-                    try:
-                        # 确保关闭之前的连接
-                        if creator.text_processor.http_client:
-                            await creator.text_processor.http_client.aclose()
-                        
-                        # 重新初始化
-                        creator.text_processor._initialize_agents()
-                        
-                        print("更新提示词...")
-                        await creator.text_processor.update_prompts(
-                            analyzer_prompt=analyzer_prompt,
-                            title_prompt=title_prompt,
-                            format_prompt=format_prompt
-                        )
-                        print("处理器更新成功")
-                    except Exception as e:
-                        print(f"处理器更新失败: {e}")
-                        return "", f"处理器更新失败: {str(e)}"
-                    
-                    # 4. 使用异步上下文管理器处理文本
-                    print("\n=== 处理文本 ===")
-                    try:
-                        async with creator.text_processor as processor:
-                            preview, message = await processor.process_file(content)
-                            print(f"处理完成: {message}")
-                            return preview, message
-                            
-                    except Exception as e:
-                        print(f"文本处理失败: {e}")
-                        import traceback
-                        print(traceback.format_exc())
-                        # 重新初始化处理器
-                        creator.text_processor._initialize_agents()
-                        return "", f"文本处理失败: {str(e)}"
+                    # 3. 提交到后台任务，界面通过轮询获取结果
+                    job = store.submit(session, "text", process_text_job, creator, content,
+                                       os.path.basename(source_file), analyzer_prompt, title_prompt,
+                                       format_prompt, name="处理文本")
+                    return gr.skip(), job_message(job)
                         
                 except Exception as e:
-                    print(f"处理过程出现异常: {e}")
-                    import traceback
-                    print(traceback.format_exc())
+                    logger.exception(f"处理过程出现异常: {e}")
                     return "", f"处理失败: {str(e)}"
 
-            async def handle_save_text_dataset():
-                print("开始保存文本数据集...")
+            def save_text_job(creator, export_format, target_length, separator, tokenizer_path):
+                logger.info("开始保存文本数据集...")
+                result = creator.save_text_dataset(
+                    export_format=export_format,
+                    target_length=target_length,
+                    separator=separator,
+                    tokenizer_path=tokenizer_path
+                )
+                logger.info(f"保存结果: {result}")
+                return {'status': result}
+
+            def handle_save_text_dataset(export_format, target_length, separator, tokenizer_path, request: gr.Request):
                 try:
-                    result = creator.save_text_dataset()
-                    print(f"保存结果: {result}")
-                    return result
+                    session = session_of(request)
+                    # 界面中输入的 \n 转为真正的换行
+                    separator = (separator or "").replace('\\n', '\n')
+                    job = store.submit(session, "text", save_text_job, session.creator, export_format,
+                                       int(target_length or 2048), separator,
+                                       (tokenizer_path or "").strip() or None, name="保存文本数据集")
+                    return job_message(job)
                 except Exception as e:
-                    print(f"保存数据集失败: {str(e)}")
+                    logger.error(f"保存数据集失败: {str(e)}")
                     return f"保存失败: {str(e)}"
-            # 修改事件绑定部分，确保使用异步处理
+
+            async def process_directory_job(creator, directory, analyzer_prompt, title_prompt, format_prompt,
+                                            export_format):
+                def progress(done, total, name, ok):
+                    report_progress({'status': f"已处理 {done}/{total} 个文件：{name}{'' if ok else '（失败）'}"})
+
+                message = await creator.process_text_directory(
+                    directory, analyzer_prompt, title_prompt, format_prompt,
+                    export_format=export_format, progress=progress
+                )
+                return {'status': message}
+
+            def handle_process_directory(directory, analyzer_prompt, title_prompt, format_prompt, export_format, mode,
+                                         request: gr.Request):
+                if not directory or not directory.strip():
+                    return "请填写语料目录"
+                try:
+                    session = session_of(request)
+                    if mode != "local" and not session.creator.api_handler:
+                        return "请先配置API设置"
+                    session.creator.set_instruction_mode(mode)
+                    job = store.submit(session, "text", process_directory_job, session.creator, directory.strip(),
+                                       analyzer_prompt, title_prompt, format_prompt, export_format,
+                                       name="增量处理目录")
+                    return job_message(job)
+                except Exception as e:
+                    logger.error(f"增量处理目录失败: {str(e)}")
+                    return f"处理失败: {str(e)}"
+
+            def poll_text(request: gr.Request):
+                return poll(request, "text", ['output'])
+
+            # 长任务提交到后台执行，按钮立即返回，结果由定时轮询写回界面
             process_text.click(
                 fn=handle_text_processing,
-                inputs=[text_file, analyzer_prompt, title_prompt, format_prompt],
+                inputs=[text_file, analyzer_prompt, title_prompt, format_prompt, instruction_mode],
                 outputs=[output_text, status],
                 api_name="process_text"
             )
 
+            process_dir.click(
+                fn=handle_process_directory,
+                inputs=[corpus_dir, analyzer_prompt, title_prompt, format_prompt, text_export_format, instruction_mode],
+                outputs=[status]
+            )
+
             save_text.click(
                 fn=handle_save_text_dataset,
+                inputs=[text_export_format, pack_length, pack_separator, tokenizer_file],
                 outputs=[status]
             )
 
+            text_timer = gr.Timer(1.0)
+            text_timer.tick(
+                fn=poll_text,
+                outputs=[output_text, status],
+                concurrency_limit=None
+            )
+
         with gr.Tab("图像数据处理"):
             gr.Markdown("""
             ### 使用说明
@@ -237,6 +384,54 @@ def create_ui():
                         lines=3,
                         value="你是一位三亚地区景点分析专家，请分析图片：\n1. 图片中的自然特征\n2. 建筑风格\n3. 人文元素\n4. 地域植被特征。\n图片的地域来自三亚，围绕这个进行分析"
                     )
+                    
+                    detail_policy = gr.Dropdown(
+                        label="图片细节等级（auto: 小图用 low，其余用 high 并按 512px 分块缩放）",
+                        choices=["auto", "low", "high"],
+                        value="auto"
+                    )
+                    
+                    multi_image_mode = gr.Checkbox(
+                        label="多图合并请求（按上下文预算把多张图片放入一次请求）",
+                        value=False
+                    )
+                    
+                    with gr.Row():
+                        stream_mode = gr.Checkbox(
+                            label="流式生成（表格逐字更新）",
+                            value=False
+                        )
+                        max_tokens = gr.Number(
+                            label="最大输出 tokens（0 不限制）",
+                            value=0,
+                            precision=0
+                        )
+                    stop_sequences = gr.Textbox(
+                        label="停止序列（每行一个，\\n 表示换行，最多 4 个）",
+                        lines=2
+                    )
+                    
+                    export_format = gr.Dropdown(
+                        label="导出格式",
+                        choices=[("HuggingFace 目录", "hf"), ("分片 Parquet (zstd)", "parquet"),
+                                 ("WebDataset tar 分片", "webdataset")],
+                        value="hf"
+                    )
+                    
+                    append_mode = gr.Checkbox(
+                        label="追加到已有数据集（仅 Parquet，已有分片不会改写）",
+                        value=False
+                    )
+                    
+                    deep_verify = gr.Checkbox(
+                        label="深度校验（完整解码每张图片）",
+                        value=False
+                    )
+                    
+                    pipeline_mode = gr.Checkbox(
+                        label="流水线模式（上传后立即生成描述并增量写出记录）",
+                        value=False
+                    )
                 
                 with gr.Column(scale=1):
                     text_boxes = gr.Dataframe(
@@ -250,7 +445,9 @@ def create_ui():
             
             with gr.Row():
                 batch_generate = gr.Button("批量生成描述", variant="secondary")
+                retry_failed = gr.Button("仅重试失败项", variant="secondary")
                 test_llm = gr.Button("测试LLM描述", variant="secondary")
+                estimate_cost = gr.Button("估算Token成本", variant="secondary")
                 save_button = gr.Button("保存数据集", variant="primary")
                 verify_button = gr.Button("验证数据集", variant="secondary")  
 
@@ -265,22 +462,35 @@ def create_ui():
                     elem_classes="upload-box"
                 )
 
-            def handle_upload(files):
+            def upload_job(creator, files, use_pipeline, prompt):
+                if use_pipeline:
+                    logger.info("开始流水线处理上传的文件...")
+                    for preview, text_data, message in creator.pipeline_process(files, prompt):
+                        yield {'preview': preview, 'table': text_data, 'status': message}
+                    return
+                    
+                logger.info("开始处理上传的文件...")
+                images, text_data = creator.process_images(files)
+                logger.info(f"处理的图片数量: {len(images)}")
+                if not images:
+                    yield {'status': "没有可处理的图片"}
+                    return
+                yield {'preview': images[0], 'table': text_data,
+                       'status': f"已上传 {len(images)} 张图片；{creator.estimate_image_cost()}"}
+
+            def handle_upload(files, use_pipeline, prompt, request: gr.Request):
                 if not files:
-                    return None, None
+                    return None, None, ""
                 try:
-                    print("开始处理上传的文件...")
-                    images, text_data = creator.process_images(files)
-                    print(f"处理的图片数量: {len(images)}")
-                    print(f"处理的文本数据: {text_data}")
-                    if not images:
-                        return None, None
-                    return images[0], text_data
+                    session = session_of(request)
+                    job = store.submit(session, "image", upload_job, session.creator, files, use_pipeline, prompt,
+                                       name="流水线处理图片" if use_pipeline else "上传图片")
+                    return gr.skip(), gr.skip(), job_message(job)
                 except Exception as e:
-                    print(f"上传处理错误: {str(e)}")
-                    return None, None
+                    logger.error(f"上传处理错误: {str(e)}")
+                    return None, None, f"上传处理错误: {str(e)}"
 
-            def handle_text_update(data):
+            def handle_text_update(data, request: gr.Request):
 
                 try:
                     
@@ -298,7 +508,7 @@ def create_ui():
                                 
                         
                         if valid_data:
-                            return creator.update_text(valid_data)
+                            return session_of(request).creator.update_text(valid_data)
                     
                     return "无效的数据格式"
                     
@@ -306,65 +516,137 @@ def create_ui():
                   
                     return f"更新失败: {str(e)}"
 
-            def handle_preview_update(evt: gr.SelectData):
+            def handle_preview_update(evt: gr.SelectData, request: gr.Request):
                 try:
+                    pairs = session_of(request).creator.image_text_pairs
                     row_index = evt.index[0]  # 获取选中行的索引
-                    if 0 <= row_index < len(creator.image_text_pairs):
-                        return creator.image_text_pairs[row_index]['image']
+                    if 0 <= row_index < len(pairs):
+                        return pairs[row_index]['image']
                     return None
                 except Exception as e:
-                    print(f"预览更新错误: {str(e)}")
+                    logger.error(f"预览更新错误: {str(e)}")
                     return None
             
-            def handle_batch_generate(prompt):
-                try:
-                    print(f"[handle_batch_generate] Using prompt: {prompt}")
-                    
-                    if not creator.api_handler:
-                        return [], "请先配置API设置"
-                        
-                    # 清理之前的临时文件
-                    creator.fs_handler.ensure_temp_dir()
+            def batch_generate_job(creator, prompt, multi_image):
+                logger.debug(f"[handle_batch_generate] Using prompt: {prompt}")
+                # 清理之前的临时文件
+                creator.fs_handler.ensure_temp_dir()
+                
+                # 更新系统提示词
+                if prompt and creator.api_handler:
+                    creator.api_handler.set_system_prompt(prompt)
                     
-                    # 更新系统提示词
-                    if prompt and creator.api_handler:
-                        creator.api_handler.set_system_prompt(prompt)
-                        
-                    # 生成描述
-                    text_data, message = creator.batch_generate_all(prompt)
-                    return text_data, message
+                # 生成描述
+                text_data, message = creator.batch_generate_all(prompt, multi_image=multi_image)
+                return {'table': text_data, 'status': message}
+
+            def handle_batch_generate(prompt, multi_image, request: gr.Request):
+                try:
+                    session = session_of(request)
+                    if not session.creator.api_handler:
+                        return gr.skip(), "请先配置API设置"
+                    job = store.submit(session, "image", batch_generate_job, session.creator, prompt, multi_image,
+                                       name="批量生成描述")
+                    return gr.skip(), job_message(job)
                 except Exception as e:
-                    print(f"[handle_batch_generate] Error: {str(e)}")
+                    logger.error(f"[handle_batch_generate] Error: {str(e)}")
                     return [], str(e)
 
-            def handle_save_dataset():
+            def retry_failed_job(creator, prompt):
+                text_data, message = creator.retry_failed(prompt)
+                return {'table': text_data, 'status': message}
+
+            def handle_retry_failed(prompt, request: gr.Request):
                 try:
-                    return creator.create_dataset()
+                    session = session_of(request)
+                    job = store.submit(session, "image", retry_failed_job, session.creator, prompt,
+                                       name="重试失败项")
+                    return gr.skip(), job_message(job)
                 except Exception as e:
-                    print(f"保存数据集错误: {str(e)}")
+                    logger.error(f"[handle_retry_failed] Error: {str(e)}")
+                    return [], str(e)
+
+            def status_job(fn, *args):
+                return {'status': fn(*args)}
+
+            def handle_save_dataset(fmt, append, request: gr.Request):
+                try:
+                    session = session_of(request)
+                    job = store.submit(session, "image", status_job, session.creator.create_dataset, fmt, append,
+                                       name="保存数据集")
+                    return job_message(job)
+                except Exception as e:
+                    logger.error(f"保存数据集错误: {str(e)}")
                     return str(e)
 
-            def handle_test_llm():
+            def handle_test_llm(request: gr.Request):
                 try:
-                    return creator.test_single_image_description(0)
+                    session = session_of(request)
+                    job = store.submit(session, "image", status_job, session.creator.test_single_image_description, 0,
+                                       name="测试LLM描述")
+                    return job_message(job)
                 except Exception as e:
-                    print(f"[handle_test_llm] Error: {str(e)}")
+                    logger.error(f"[handle_test_llm] Error: {str(e)}")
                     return f"测试失败: {str(e)}"
-            def handle_verify_dataset():
+            def handle_verify_dataset(fmt, deep, request: gr.Request):
                 try:
-                    return creator.verify_dataset()
+                    session = session_of(request)
+                    job = store.submit(session, "image", status_job, session.creator.verify_dataset, fmt, deep,
+                                       name="验证数据集")
+                    return job_message(job)
                 except Exception as e:
-                    print(f"验证处理错误: {str(e)}")
+                    logger.error(f"验证处理错误: {str(e)}")
                     return str(e)
 
+            def handle_detail_policy(policy, request: gr.Request):
+                return session_of(request).creator.set_detail_policy(policy)
+
+            def handle_generation_options(stream, limit, stop, request: gr.Request):
+                return session_of(request).creator.set_generation_options(stream, limit, stop)
+
+            def handle_estimate_cost(request: gr.Request):
+                return session_of(request).creator.estimate_image_cost()
+
+            def handle_save_api(base_url, key, model_name, cascade, request: gr.Request):
+                return session_of(request).creator.set_api_config(base_url, key, model_name, cascade)
+
+            def handle_test_api(request: gr.Request):
+                return session_of(request).creator.test_api_connection()
+
+            def handle_profile_jobs(enabled, request: gr.Request):
+                session_of(request).profile = enabled
+                return "后台任务性能分析已开启" if enabled else "后台任务性能分析已关闭"
+
+            def poll_image(request: gr.Request):
+                return poll(request, "image", ['preview', 'table'])
+
             # 绑定事件
+            detail_policy.change(
+                fn=handle_detail_policy,
+                inputs=[detail_policy],
+                outputs=[status]
+            )
+            
+            for control in (stream_mode, max_tokens, stop_sequences):
+                control.change(
+                    fn=handle_generation_options,
+                    inputs=[stream_mode, max_tokens, stop_sequences],
+                    outputs=[status]
+                )
+            
+            estimate_cost.click(
+                fn=handle_estimate_cost,
+                outputs=[status]
+            )
+            
             file_output.upload(
                 fn=handle_upload,
-                inputs=[file_output],
-                outputs=[preview_image, text_boxes]
+                inputs=[file_output, pipeline_mode, prompt_template],
+                outputs=[preview_image, text_boxes, status]
             )
             
-            text_boxes.change(
+            # 只响应用户编辑，轮询写回表格时不触发，避免用旧表格覆盖后台任务的新结果
+            text_boxes.input(
                 fn=handle_text_update,
                 inputs=[text_boxes],
                 outputs=[status]
@@ -377,23 +659,36 @@ def create_ui():
             
             batch_generate.click(
                 fn=handle_batch_generate,
+                inputs=[prompt_template, multi_image_mode],
+                outputs=[text_boxes, status]
+            )
+            
+            retry_failed.click(
+                fn=handle_retry_failed,
                 inputs=[prompt_template],
                 outputs=[text_boxes, status]
             )
                         
             save_button.click(
                 fn=handle_save_dataset,
+                inputs=[export_format, append_mode],
                 outputs=[status]
             )
             
             save_api.click(
-                fn=creator.set_api_config,
-                inputs=[api_base, api_key, model],
+                fn=handle_save_api,
+                inputs=[api_base, api_key, model, stage_models],
                 outputs=[api_status]
             )
 
             test_api.click(
-                fn=creator.test_api_connection,
+                fn=handle_test_api,
+                outputs=[api_status]
+            )
+
+            profile_jobs.change(
+                fn=handle_profile_jobs,
+                inputs=[profile_jobs],
                 outputs=[api_status]
             )
             
@@ -403,8 +698,22 @@ def create_ui():
             )
             verify_button.click(
                 fn=handle_verify_dataset,
+                inputs=[export_format, deep_verify],
                 outputs=[status]
             )
+            
+            image_timer = gr.Timer(1.0)
+            image_timer.tick(
+                fn=poll_image,
+                outputs=[preview_image, text_boxes, status],
+                concurrency_limit=None
+            )
+
+        # 会话关闭时取消其任务并删除临时目录
+        def handle_unload(request: gr.Request):
+            store.close(request.session_hash)
+
+        app.unload(handle_unload)
 
         # 样式设置
         app.style = """
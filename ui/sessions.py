@@ -0,0 +1,103 @@
+import os
+import shutil
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+import logging
+
+from core.dataset_creator import DatasetCreator
+from core.job_runner import Job, JobRunner
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Session:
+    """单个浏览器会话的状态"""
+    id: str
+    creator: DatasetCreator
+    # 各标签页最近提交的任务编号
+    jobs: Dict[str, str] = field(default_factory=dict)
+    # 各标签页最近一次写回界面的任务数据
+    delivered: Dict[str, Any] = field(default_factory=dict)
+    last_seen: float = field(default_factory=time.time)
+    # 为真时后台任务在性能分析中运行
+    profile: bool = False
+
+
+class SessionStore:
+    """按会话隔离 DatasetCreator，并把长任务交给后台执行器
+
+    每个会话有自己的图片文本对、文本结果、临时目录（temp_root/<会话编号>）和
+    输出目录（output_root/<会话编号>），多人同时运行导出任务时互不覆盖。
+    长时间无访问且没有未完成任务的会话会被回收，回收时只删除临时目录，导出的数据集保留。
+    """
+
+    def __init__(self, runner: Optional[JobRunner] = None, temp_root: str = "temp_dataset/sessions",
+                 idle_timeout: float = 6 * 3600, profile_dir: str = "profiles",
+                 memory_limit_mb: Optional[float] = None, output_root: str = "outputs/sessions"):
+        """初始化会话存储
+
+        Args:
+            runner: 后台任务执行器
+            temp_root: 各会话临时目录的上级目录
+            idle_timeout: 会话空闲多少秒后回收
+            profile_dir: 开启性能分析的会话的报告目录名，位于该会话的输出目录下
+            memory_limit_mb: 每个会话结果数据的内存上限（MB），超出后写入会话临时目录
+            output_root: 各会话导出数据集的上级目录
+        """
+        self.runner = runner or JobRunner()
+        self.temp_root = os.path.abspath(temp_root)
+        self.output_root = os.path.abspath(output_root)
+        self.profile_dir = profile_dir
+        self.memory_limit_mb = memory_limit_mb
+        self.idle_timeout = idle_timeout
+        self._sessions: Dict[str, Session] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id: Optional[str]) -> Session:
+        """取得会话，不存在时创建"""
+        session_id = session_id or "default"
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                creator = DatasetCreator(temp_dir=os.path.join(self.temp_root, session_id),
+                                         memory_limit_mb=self.memory_limit_mb,
+                                         output_root=os.path.join(self.output_root, session_id))
+                session = self._sessions[session_id] = Session(session_id, creator)
+                logger.info(f"创建会话 {session_id}，当前会话数 {len(self._sessions)}")
+            session.last_seen = time.time()
+        self.evict_idle()
+        return session
+
+    def submit(self, session: Session, tab: str, fn, *args, name: str = "", **kwargs) -> Job:
+        """以会话为用户提交后台任务，并记为该标签页的当前任务"""
+        profile_dir = os.path.join(session.creator.output_root, self.profile_dir) if session.profile else None
+        job = self.runner.submit(session.id, fn, *args, name=name, profile_dir=profile_dir, **kwargs)
+        session.jobs[tab] = job.id
+        return job
+
+    def current_job(self, session: Session, tab: str) -> Optional[Job]:
+        return self.runner.get(session.jobs.get(tab))
+
+    def close(self, session_id: Optional[str]) -> None:
+        """结束会话：取消其任务并删除临时目录"""
+        with self._lock:
+            session = self._sessions.pop(session_id or "default", None)
+        if session is None:
+            return
+        self.runner.cancel_user(session.id)
+        shutil.rmtree(session.creator.fs_handler.temp_dir, ignore_errors=True)
+        logger.info(f"关闭会话 {session.id}")
+
+    def evict_idle(self) -> None:
+        now = time.time()
+        with self._lock:
+            idle = [
+                s.id for s in self._sessions.values()
+                if now - s.last_seen > self.idle_timeout
+                and all(j.finished for j in self.runner.jobs_for(s.id))
+            ]
+        for session_id in idle:
+            self.close(session_id)